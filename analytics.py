@@ -0,0 +1,223 @@
+import os
+import calendar
+import datetime as dt
+
+from storage import month_key
+from currency import format_amount
+from categories import get_category_registry
+
+ANALYTICS_FILE = 'analytics.json'
+WINDOW_DAYS = 56
+HISTORY_MONTHS = 3
+ANOMALY_Z = 3.0
+CATEGORY_RATIO = 1.5
+MIN_DAYS = 7
+
+
+def linear_fit(values):
+    # Least squares line through (0, values[0]), (1, values[1]), ...
+    count = len(values)
+    if count < 2:
+        return (values[0] if values else 0), 0
+    mean_x = (count - 1) / 2
+    mean_y = sum(values) / count
+    variance = sum((x - mean_x) ** 2 for x in range(count))
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values)) / variance
+    return mean_y - slope * mean_x, slope
+
+
+class SpendingAnalytics:
+    def __init__(self, storage, window_days=WINDOW_DAYS, history_months=HISTORY_MONTHS):
+        """
+        Initializes a new SpendingAnalytics object.
+
+        Parameters:
+            storage (ShardedUserStorage): The storage of the user.
+            window_days (int, optional): The number of past days the daily statistics look at. Defaults to 56.
+            history_months (int, optional): The number of past months a category is compared with. Defaults to 3.
+
+        Returns:
+            None
+
+        Daily totals of the window are cached in 'users/<user>/analytics.json'
+        together with the sequence number and the byte length of the change
+        log they include. A refresh only reads the log from there and re-reads
+        the months touched by newer changes, and nothing at all when the log
+        did not move.
+        """
+        self.storage = storage
+        self.window_days = window_days
+        self.history_months = history_months
+        self.cache_file = os.path.join(storage.user_directory, ANALYTICS_FILE)
+        self.cache = None
+        self.result = None
+
+    def load_cache(self):
+        if self.cache is None:
+            cache = self.storage.read_json(self.cache_file, None)
+            if not isinstance(cache, dict) or 'seq' not in cache:
+                cache = None
+            self.cache = cache
+        return self.cache
+
+    def read_daily(self, start_date, end_date):
+        return {date: sum(expenses_for_date.values())
+                for date, expenses_for_date in self.storage.get_dates(start_date, end_date).items()}
+
+    def refresh(self, today):
+        """
+        Bring the cached daily totals up to date with the change log.
+
+        Parameters:
+            today (date): The last day of the window.
+
+        Returns:
+            bool: True if anything had to be recomputed.
+        """
+        # The length is taken first, so the lines after it hold every change after 'seq'
+        position = self.storage.changes.size()
+        seq = self.storage.changes.last_seq()
+        start_date = today - dt.timedelta(days=self.window_days - 1)
+        start_str = start_date.isoformat()
+        cache = self.load_cache()
+        if cache is not None and cache['seq'] == seq and cache['today'] == today.isoformat():
+            return False
+
+        if cache is None or cache['seq'] > seq:
+            daily = self.read_daily(start_date, today)
+        else:
+            daily = {date: total for date, total in cache['daily'].items() if date >= start_str}
+            months = set()
+            for event in self.storage.changes.read(cache['seq'], cache.get('position', 0)):
+                if event.kind == 'reinitialized':
+                    months = None
+                    break
+                if event.kind.startswith('expense_') and event.data['date'] >= start_str:
+                    months.add(event.data['date'][:7])
+            if months is None:
+                daily = self.read_daily(start_date, today)
+            # Only the months touched since the last refresh are read again
+            for month in months or ():
+                month_start = max(start_date, dt.date.fromisoformat(f'{month}-01'))
+                month_end = dt.date(month_start.year, month_start.month,
+                                    calendar.monthrange(month_start.year, month_start.month)[1])
+                daily = {date: total for date, total in daily.items() if date[:7] != month}
+                daily.update(self.read_daily(month_start, min(month_end, today)))
+
+        self.cache = {'seq': seq, 'position': position, 'today': today.isoformat(), 'daily': daily}
+        self.result = None
+        self.storage.write_json(self.cache_file, self.cache)
+        return True
+
+    def daily_series(self, today):
+        # Every day of the window from the first recorded one, days without expenses count as zero
+        daily = self.cache['daily']
+        if not daily:
+            return []
+        day = dt.date.fromisoformat(min(daily))
+        series = []
+        while day <= today:
+            series.append((day.isoformat(), daily.get(day.isoformat(), 0)))
+            day += dt.timedelta(days=1)
+        return series
+
+    def anomalous_days(self, series):
+        if len(series) < MIN_DAYS:
+            return []
+        values = [total for _, total in series]
+        mean = sum(values) / len(values)
+        deviation = (sum((value - mean) ** 2 for value in values) / len(values)) ** 0.5
+        if deviation == 0:
+            return []
+        return [(date, total) for date, total in series if (total - mean) / deviation > ANOMALY_Z]
+
+    def anomalous_categories(self, key, month_info, elapsed_share):
+        # Categories heading well above their average of the previous months
+        months = self.storage.load_manifest()['months']
+        history = sorted(month for month in months if month < key)[-self.history_months:]
+        if not history or elapsed_share <= 0:
+            return []
+        flagged = []
+        for category, total in month_info.get('categories', {}).items():
+            usual = sum(months[month].get('categories', {}).get(category, 0) for month in history) / len(history)
+            projected = total / elapsed_share
+            if usual > 0 and projected > usual * CATEGORY_RATIO:
+                flagged.append((category, projected, usual))
+        return sorted(flagged, key=lambda item: item[1] / item[2], reverse=True)
+
+    def forecast(self, today=None):
+        """
+        Project the spending of the current month.
+
+        Parameters:
+            today (date, optional): The current date. Defaults to today.
+
+        Returns:
+            dict: 'month', 'spent', 'projected', 'limit', 'daily_average', 'trend',
+                  'anomalous_days' and 'anomalous_categories', with the categories as IDs.
+
+        The rest of the month is projected from a least squares line through
+        the daily totals of the window, blended with the pace of the month so
+        far. With fewer than 'MIN_DAYS' days there is no trend to speak of and
+        the pace alone is used. Repeated calls return the cached result until
+        the log moves.
+        """
+        today = today or dt.date.today()
+        if not self.refresh(today) and self.result is not None:
+            return self.result
+
+        key = month_key(today.isoformat())
+        month_info = self.storage.get_month_info(key) or {}
+        spent = month_info.get('total', 0)
+        days_in_month = calendar.monthrange(today.year, today.month)[1]
+        remaining = days_in_month - today.day
+
+        series = self.daily_series(today)
+        values = [total for _, total in series]
+        daily_average = sum(values) / len(values) if values else 0
+        pace_days = spent / today.day * remaining
+        if len(values) < MIN_DAYS:
+            slope = 0
+            projected = spent + pace_days
+        else:
+            intercept, slope = linear_fit(values)
+            trend_days = sum(max(0, intercept + slope * (len(values) + offset)) for offset in range(remaining))
+            projected = spent + (trend_days + pace_days) / 2
+
+        self.result = {
+            'month': key,
+            'spent': spent,
+            'projected': projected,
+            'limit': month_info.get('limit'),
+            'daily_average': daily_average,
+            'trend': slope,
+            'anomalous_days': self.anomalous_days(series),
+            'anomalous_categories': self.anomalous_categories(key, month_info, today.day / days_in_month)
+        }
+        return self.result
+
+
+def describe_forecast(forecast, currency):
+    """
+    Describe a forecast in a few lines for the main menu.
+
+    Parameters:
+        forecast (dict): The result of 'SpendingAnalytics.forecast'.
+        currency (str): The base currency, which the forecast amounts are in.
+
+    Returns:
+        list: Lines of text.
+    """
+    lines = [f"Spent this month: {format_amount(forecast['spent'], currency)}, "
+             f"projected: {format_amount(forecast['projected'], currency)}"]
+    limit = forecast['limit']
+    if isinstance(limit, (int, float)) and forecast['projected'] > limit:
+        lines.append(f"At this pace the limit of {format_amount(limit, currency)} is exceeded by "
+                     f"{format_amount(forecast['projected'] - limit, currency)}.")
+    for category, projected, usual in forecast['anomalous_categories']:
+        category = get_category_registry().decode(category)
+        lines.append(f"{category} is heading for {format_amount(projected, currency)}, "
+                     f"usually {format_amount(usual, currency)}.")
+    for date, total in forecast['anomalous_days'][-3:]:
+        lines.append(f"Unusual spending on {date}: {format_amount(total, currency)}.")
+    return lines
@@ -0,0 +1,435 @@
+import re
+import json
+import math
+import argparse
+import functools
+import threading
+import datetime as dt
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from storage import USERS_DIRECTORY, ShardedUserStorage, month_key, month_days, shift_month
+from budget import BudgetEngine, CategoryBudgetTracker, save_with_budgets, describe_event
+from rollups import range_totals
+from recurring import RecurringScheduler
+from categories import get_category_registry
+from reportcache import report_cache
+
+HOST = '127.0.0.1'
+PORT = 8080
+MAX_BODY = 1 << 16
+MAX_MONTHS = 120
+USER_PATTERN = r'(?P<user>[A-Za-z0-9_][A-Za-z0-9_.-]{0,63})'
+MONTH_PATTERN = r'(?P<month>\d{4}-\d{2})'
+
+ROUTES = [
+    ('POST', re.compile(rf'^/users/{USER_PATTERN}/expenses$'), 'add_expense'),
+    ('GET', re.compile(rf'^/users/{USER_PATTERN}/months$'), 'months'),
+    ('GET', re.compile(rf'^/users/{USER_PATTERN}/months/{MONTH_PATTERN}$'), 'month_data'),
+    ('PUT', re.compile(rf'^/users/{USER_PATTERN}/months/{MONTH_PATTERN}/limit$'), 'set_limit'),
+    ('GET', re.compile(rf'^/users/{USER_PATTERN}/totals$'), 'range_totals')
+]
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def parse_month(month):
+    try:
+        return dt.datetime.strptime(month, "%Y-%m").strftime("%Y-%m")
+    except (TypeError, ValueError):
+        raise ApiError(400, f"Invalid month {month!r}, use YYYY-MM.")
+
+
+def parse_date(value, name):
+    try:
+        return dt.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, f"Invalid {name} {value!r}, use YYYY-MM-DD.")
+
+
+def parse_amount(value, name):
+    # JSON bodies may hold NaN and Infinity, which would spoil every total they are added to
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+        raise ApiError(400, f"'{name}' must be a positive number.")
+    return float(value)
+
+
+def parse_text(value, name):
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise ApiError(400, f"'{name}' must be a string.")
+    return value
+
+
+def parse_tags(value):
+    # Tags are a comma separated string or a list of strings
+    if value is None:
+        return ''
+    if isinstance(value, list) and all(isinstance(tag, str) for tag in value):
+        return value
+    if not isinstance(value, str):
+        raise ApiError(400, "'tags' must be a string or a list of strings.")
+    return value
+
+
+class ExpenseApi:
+    def __init__(self, users_directory=USERS_DIRECTORY, cache=report_cache):
+        """
+        Initializes a new ExpenseApi object.
+
+        Parameters:
+            users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+            cache (ReportCache, optional): The cache of computed responses. Defaults to the shared report cache.
+
+        Returns:
+            None
+
+        Every response carries the version of the data of the user as its ETag:
+        the generation, the revision of the recurring expenses and today's date.
+        A GET saves the due recurring expenses first, like the reports of
+        'ExpensesReport', and one whose 'If-None-Match' still matches is
+        answered with 304 without computing anything. Writes of one user are
+        serialized, requests of different users run in parallel.
+        """
+        self.users_directory = users_directory
+        self.cache = cache
+        self.budget_engine = BudgetEngine()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def storage(self, user):
+        return ShardedUserStorage(user, self.users_directory)
+
+    def write_lock(self, user):
+        with self.locks_lock:
+            return self.locks.setdefault(user, threading.Lock())
+
+    def scheduler(self, storage):
+        # Occurrences are checked against the limits and budgets like any other expense
+        return RecurringScheduler(storage, functools.partial(
+            save_with_budgets, storage, self.budget_engine, CategoryBudgetTracker(storage, self.budget_engine)))
+
+    def version(self, user):
+        """
+        Save the due recurring expenses of a user and get the version of the data.
+
+        Parameters:
+            user (str): The username.
+
+        Returns:
+            tuple: The generation of the user, the revision of the recurring expenses and today's date.
+        """
+        storage = self.storage(user)
+        scheduler = self.scheduler(storage)
+        today = dt.date.today()
+        # Users without recurring expenses are only read, nothing is created for unknown ones
+        if scheduler.rules:
+            with self.write_lock(user):
+                scheduler.materialize(today)
+        return storage.generation, scheduler.version, today.isoformat()
+
+    @staticmethod
+    def etag(version):
+        return '"' + '.'.join(str(part) for part in version) + '"'
+
+    def cached(self, user, report, params, version, compute):
+        # Responses are computed again when the projected recurring expenses or the day change too
+        generation, *recurring = version
+        return self.cache.get_or_compute(self.storage(user).user_directory, f'api_{report}', params + tuple(recurring),
+                                         generation, compute)
+
+    def add_expense(self, user, body):
+        """
+        Save an expense, like 'ExpenseManager.save_expense'.
+
+        Parameters:
+            user (str): The username.
+            body (dict): 'category', 'amount', 'date' and optionally 'note', 'tags' and 'currency'.
+
+        Returns:
+            tuple: The status, the response and the new version.
+        """
+        categories = get_category_registry()
+        category = body.get('category')
+        if category not in categories.by_name:
+            raise ApiError(400, f"Unknown category {category!r}.")
+        amount = parse_amount(body.get('amount'), 'amount')
+        date = parse_date(body.get('date', dt.date.today().isoformat()), 'date').isoformat()
+        note = parse_text(body.get('note'), 'note')
+        tags = parse_tags(body.get('tags'))
+        currency = parse_text(body.get('currency'), 'currency')
+
+        storage = self.storage(user)
+        with self.write_lock(user):
+            if not storage.registered:
+                storage.check_layout()
+            # An unknown currency saves nothing
+            try:
+                expense_id, month_info, events = save_with_budgets(
+                    storage, self.budget_engine, CategoryBudgetTracker(storage, self.budget_engine),
+                    category, amount, date, note, tags, currency)
+            except ValueError as error:
+                raise ApiError(400, str(error))
+        return 201, {'id': expense_id, 'month': month_key(date), 'total': month_info['total'],
+                     'events': [describe_event(event) for event in events]}, self.version(user)
+
+    def set_limit(self, user, month, body):
+        month = parse_month(month)
+        limit = parse_amount(body.get('limit'), 'limit')
+        storage = self.storage(user)
+        with self.write_lock(user):
+            if not storage.registered:
+                storage.check_layout()
+            month_info = storage.set_limit(month, limit)
+            events = self.budget_engine.check_month(storage, month, month_info)
+        return 200, {'month': month, 'limit': limit, 'total': month_info['total'],
+                     'events': [describe_event(event) for event in events]}, self.version(user)
+
+    def month_data(self, user, month, version):
+        """
+        Get the data of a month, like 'ExpensesReport.get_month_data'.
+
+        Parameters:
+            user (str): The username.
+            month (str): The month in the format 'YYYY-MM'.
+            version (tuple): The current version of the data of the user.
+
+        Returns:
+            tuple: The status and the response, with the recurring expenses of the month which are not due yet.
+        """
+        month = parse_month(month)
+
+        def compute():
+            storage = self.storage(user)
+            with storage.snapshot() as snapshot:
+                month_data = snapshot.get_month_data(month)
+            upcoming = self.scheduler(storage).project(*month_days(month))
+            try:
+                projected = storage.rates.category_totals(upcoming, storage.rates.base)
+            except ValueError:
+                # Without a rate the projection is left out, like in the reports
+                projected = {}
+            if month_data is None:
+                if not projected:
+                    return None
+                month_data = {'limit': None, 'total': 0, 'expenses': {}}
+            limit = month_data.get('limit')
+            categories = get_category_registry()
+            return {
+                'month': month,
+                'limit': limit,
+                'total': month_data['total'],
+                'available': limit - month_data['total'] if isinstance(limit, (int, float)) else None,
+                'expenses': categories.names(month_data['expenses']),
+                'projected': categories.names(projected)
+            }
+
+        response = self.cached(user, 'month_data', (month,), version, compute)
+        if response is None:
+            raise ApiError(404, f"No data found for {month}.")
+        return 200, response
+
+    def months(self, user, query, version):
+        """
+        Get the totals and limits of a range of months from the month index.
+
+        Parameters:
+            user (str): The username.
+            query (dict): 'last', a number of calendar months up to the current one, or
+                          'start' and 'end' in the format 'YYYY-MM', both optional.
+            version (tuple): The current version of the data of the user.
+
+        Returns:
+            tuple: The status and the response, with the recorded months oldest first.
+        """
+        if 'last' in query:
+            try:
+                count = int(query['last'][0])
+            except ValueError:
+                count = 0
+            if not 0 < count <= MAX_MONTHS:
+                raise ApiError(400, f"'last' must be a number of months from 1 to {MAX_MONTHS}.")
+            end_key = dt.date.today().strftime("%Y-%m")
+            start_key = shift_month(end_key, 1 - count)
+        else:
+            start_key = parse_month(query['start'][0]) if 'start' in query else None
+            end_key = parse_month(query['end'][0]) if 'end' in query else None
+            if start_key and end_key and start_key > end_key:
+                raise ApiError(400, "'start' is after 'end'.")
+
+        def compute():
+            with self.storage(user).snapshot() as snapshot:
+                months = snapshot.get_months(start_key, end_key)
+            categories = get_category_registry()
+            return {'months': [dict(month_info, month=key, categories=categories.names(month_info['categories']))
+                               for key, month_info in months]}
+
+        return 200, self.cached(user, 'months', (start_key, end_key), version, compute)
+
+    def range_totals(self, user, query, version):
+        """
+        Get category totals of a range, with 'rollups.range_totals' like the days report.
+
+        Parameters:
+            user (str): The username.
+            query (dict): 'start' and 'end' in the format 'YYYY-MM-DD'.
+            version (tuple): The current version of the data of the user.
+
+        Returns:
+            tuple: The status and the response, with the totals rolled up to parent categories too.
+        """
+        start_date = parse_date(query.get('start', [None])[0], 'start')
+        end_date = parse_date(query.get('end', [None])[0], 'end')
+        if start_date > end_date:
+            raise ApiError(400, "'start' is after 'end'.")
+
+        def compute():
+            with self.storage(user).snapshot() as snapshot:
+                totals = range_totals(snapshot, start_date, end_date)
+            return {
+                'start': start_date.isoformat(),
+                'end': end_date.isoformat(),
+                'totals': get_category_registry().names(totals),
+                'total': sum(totals.values()),
+                'rollup': [{'category': name, 'total': total, 'depth': depth}
+                           for name, total, depth in get_category_registry().rollup(totals)]
+            }
+
+        return 200, self.cached(user, 'range_totals', (start_date, end_date), version, compute)
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive, every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def read_body(self):
+        # The body is always read, so the next request on a kept-alive connection starts clean
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The end of the body is unknown, the connection can't be reused
+            self.close_connection = True
+            raise ApiError(400, "Invalid Content-Length.")
+        if length > MAX_BODY:
+            self.close_connection = True
+            raise ApiError(413, "The request body is too large.")
+        return self.rfile.read(length)
+
+    def parse_body(self):
+        try:
+            body = json.loads(self.body or b'{}')
+        except ValueError:
+            raise ApiError(400, "The request body is not valid JSON.")
+        if not isinstance(body, dict):
+            raise ApiError(400, "The request body must be a JSON object.")
+        return body
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        try:
+            self.body = self.read_body()
+            for route_method, pattern, name in ROUTES:
+                match = pattern.match(url.path)
+                if match is None:
+                    continue
+                if route_method != method:
+                    raise ApiError(405, f"{method} is not allowed here.")
+                self.handle_route(name, match.groupdict(), parse_qs(url.query))
+                return
+            raise ApiError(404, "Not found.")
+        except ApiError as error:
+            self.send_json(error.status, {'error': error.message})
+        except Exception as error:
+            self.log_error("%s failed: %r", self.path, error)
+            self.send_json(500, {'error': "Internal server error."})
+
+    def handle_route(self, name, params, query):
+        api = self.server.api
+        user = params['user']
+        if name == 'add_expense':
+            status, response, version = api.add_expense(user, self.parse_body())
+        elif name == 'set_limit':
+            status, response, version = api.set_limit(user, params['month'], self.parse_body())
+        else:
+            # Only the change log and the recurring expenses are read before deciding the client copy is still fresh
+            version = api.version(user)
+            if api.etag(version) in self.if_none_match():
+                self.send_json(304, None, version)
+                return
+            if name == 'month_data':
+                status, response = api.month_data(user, params['month'], version)
+            elif name == 'months':
+                status, response = api.months(user, query, version)
+            else:
+                status, response = api.range_totals(user, query, version)
+        self.send_json(status, response, version)
+
+    def if_none_match(self):
+        header = self.headers.get('If-None-Match') or ''
+        return {tag.strip().removeprefix('W/') for tag in header.split(',')}
+
+    def send_json(self, status, response, version=None):
+        body = b'' if response is None else json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        if version is not None:
+            self.send_header('ETag', self.server.api.etag(version))
+            self.send_header('Cache-Control', 'no-cache')
+        if status != 304:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api, verbose=False):
+        super().__init__(address, ApiRequestHandler)
+        self.api = api
+        self.verbose = verbose
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Serve the expenses of all users as a JSON API.")
+    arg_parser.add_argument('--host', default=HOST)
+    arg_parser.add_argument('--port', type=int, default=PORT)
+    arg_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+    arg_parser.add_argument('--verbose', action='store_true', help="log every request")
+
+    args = arg_parser.parse_args()
+
+    server = ApiServer((args.host, args.port), ExpenseApi(args.users_dir), args.verbose)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
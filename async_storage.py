@@ -0,0 +1,181 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import USERS_DIRECTORY, ShardedUserStorage
+from budget import BudgetEngine, CategoryBudgetTracker, THRESHOLDS, save_with_budgets
+from categories import get_category_registry
+
+MAX_WORKERS = 4
+
+
+class AsyncUserStorage:
+    def __init__(self, users_directory=USERS_DIRECTORY, max_workers=MAX_WORKERS, thresholds=THRESHOLDS,
+                 handlers=None, write_behind=None):
+        """
+        Initializes a new AsyncUserStorage object.
+
+        Parameters:
+            users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+            max_workers (int, optional): The size of the thread pool doing the disk work. Defaults to 4.
+            thresholds (tuple, optional): Budget thresholds in percent. Defaults to 50, 80 and 100.
+            handlers (list, optional): Callables receiving budget events, called on the event loop.
+            write_behind (WriteBehindPool, optional): Buffers the writes of every user when given.
+
+        Returns:
+            None
+
+        Every blocking call of ShardedUserStorage runs on a bounded thread pool,
+        so a server or bot front end never blocks its event loop on file I/O.
+        """
+        self.users_directory = users_directory
+        self.write_behind = write_behind
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='user-storage')
+        # The engine used by the workers has no handlers, events are fired on the loop
+        self.worker_engine = BudgetEngine(thresholds)
+        self.budget_engine = BudgetEngine(thresholds, handlers)
+        self.pending_loads = {}
+        self.write_locks = {}
+        self.category_budgets = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.write_behind is not None:
+            self.write_behind.flush_all()
+
+    def storage(self, user):
+        if self.write_behind is not None:
+            return self.write_behind.get(user)
+        return ShardedUserStorage(user, self.users_directory)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def write_lock(self, user):
+        # Writes of one user are serialized, writes of different users run in parallel
+        if user not in self.write_locks:
+            self.write_locks[user] = asyncio.Lock()
+        return self.write_locks[user]
+
+    def fire(self, events):
+        for event in events:
+            self.budget_engine.fire(event)
+
+    async def load_user(self, user):
+        """
+        Load the whole history of a user.
+
+        Parameters:
+            user (str): The username.
+
+        Returns:
+            dict: Data with 'date' entries and 'month' entries keyed by 'YYYY-MM'. Callers share
+                  it and must not modify it.
+
+        Concurrent loads of the same user are coalesced into one read of the shards.
+        """
+        pending = self.pending_loads.get(user)
+        if pending is None:
+            pending = asyncio.ensure_future(self.run(self.load_user_sync, user))
+            self.pending_loads[user] = pending
+            pending.add_done_callback(lambda future: self.forget_load(user, future))
+        # A cancelled caller must not cancel the load the other callers wait for
+        return await asyncio.shield(pending)
+
+    def forget_load(self, user, future):
+        if self.pending_loads.get(user) is future:
+            del self.pending_loads[user]
+
+    def load_user_sync(self, user):
+        storage = self.storage(user)
+        storage.check_layout()
+        return storage.load_all()
+
+    async def save_expense(self, user, expense, amount, date, note=None, tags=None, currency=None):
+        """
+        Save an expense and check the budgets of the user.
+
+        Parameters:
+            user (str): The username.
+            expense (str): The expense category.
+            amount (float): The amount spent.
+            date (str): The date of the expense in the format 'YYYY-MM-DD'.
+            note (str, optional): A free-text note.
+            tags (list, optional): Tags of the expense.
+            currency (str, optional): The currency of the amount. Defaults to the base currency.
+
+        Returns:
+            list: The budget events fired by the expense.
+        """
+        async with self.write_lock(user):
+            # Loads started before the write would return stale data to new callers
+            self.pending_loads.pop(user, None)
+            events = await self.run(self.save_expense_sync, user, expense, amount, date, note, tags, currency)
+        self.fire(events)
+        return events
+
+    def save_expense_sync(self, user, expense, amount, date, note=None, tags=None, currency=None):
+        storage = self.storage(user)
+        if user not in self.category_budgets:
+            self.category_budgets[user] = CategoryBudgetTracker(storage, self.worker_engine)
+        _, _, events = save_with_budgets(storage, self.worker_engine, self.category_budgets[user],
+                                         expense, amount, date, note, tags, currency)
+        return events
+
+    async def set_limit(self, user, key, limit):
+        """
+        Set a spending limit for a month.
+
+        Parameters:
+            user (str): The username.
+            key (str): The month key in the format 'YYYY-MM'.
+            limit (float): The new limit.
+
+        Returns:
+            list: The budget events fired by the new limit.
+        """
+        async with self.write_lock(user):
+            self.pending_loads.pop(user, None)
+            events = await self.run(self.set_limit_sync, user, key, limit)
+        self.fire(events)
+        return events
+
+    def set_limit_sync(self, user, key, limit):
+        storage = self.storage(user)
+        month_info = storage.set_limit(key, limit)
+        return self.worker_engine.check_month(storage, key, month_info)
+
+    def month_data_sync(self, user, key):
+        return self.storage(user).get_month_data(key)
+
+    async def month_report(self, user, key):
+        """
+        Get the report of a month.
+
+        Parameters:
+            user (str): The username.
+            key (str): The month key in the format 'YYYY-MM'.
+
+        Returns:
+            dict: 'month', 'limit', 'total', 'available' and 'expenses' by category name, or None if
+                  the month has no data.
+        """
+        # Building the storage reads the registry and the rates, so it happens on the pool too
+        month_data = await self.run(self.month_data_sync, user, key)
+        if month_data is None:
+            return None
+        limit = month_data.get('limit')
+        return {
+            'month': key,
+            'limit': limit,
+            'total': month_data['total'],
+            'available': limit - month_data['total'] if isinstance(limit, (int, float)) else None,
+            'expenses': get_category_registry().names(month_data['expenses'])
+        }
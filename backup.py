@@ -0,0 +1,275 @@
+import os
+import time
+import gzip
+import hashlib
+import argparse
+import contextlib
+import datetime as dt
+
+from storage import USERS_DIRECTORY, MANIFEST_FILE, ShardedUserStorage
+from registry import REGISTRY_FILE, get_registry
+from changefeed import ChangeLog
+from versions import get_user_lock
+
+BACKUP_DIRECTORY = 'backups'
+SNAPSHOT_FORMAT = '%Y%m%dT%H%M%S%fZ'
+CONSISTENT_READ_ATTEMPTS = 3
+
+
+class BackupStore:
+    def __init__(self, backup_directory=BACKUP_DIRECTORY, users_directory=USERS_DIRECTORY):
+        """
+        Initializes a new BackupStore object.
+
+        Parameters:
+            backup_directory (str, optional): The directory of the backups. Defaults to 'backups'.
+            users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+
+        Returns:
+            None
+
+        File contents are stored once, gzip compressed, under 'objects/' by their
+        SHA-256. A snapshot in 'snapshots/' maps every file of the users
+        directory to its hash, size and mtime.
+        """
+        self.backup_directory = backup_directory
+        self.users_directory = users_directory
+        self.objects_directory = os.path.join(backup_directory, 'objects')
+        self.snapshots_directory = os.path.join(backup_directory, 'snapshots')
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_directory, digest[:2], f'{digest}.gz')
+
+    def snapshot_path(self, snapshot_id):
+        return os.path.join(self.snapshots_directory, f'{snapshot_id}.json')
+
+    def list_snapshots(self):
+        if not os.path.isdir(self.snapshots_directory):
+            return []
+        # Snapshot IDs are UTC timestamps, so they sort by time
+        return sorted(name[:-len('.json')] for name in os.listdir(self.snapshots_directory)
+                      if name.endswith('.json'))
+
+    def load_snapshot(self, snapshot_id):
+        snapshot = ShardedUserStorage.read_json(self.snapshot_path(snapshot_id), None)
+        if not isinstance(snapshot, dict):
+            raise ValueError(f"Snapshot {snapshot_id} is missing or broken.")
+        return snapshot
+
+    def store_object(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.tmp'
+            with gzip.open(tmp_path, 'wb') as object_file:
+                object_file.write(content)
+            os.replace(tmp_path, path)
+        return digest
+
+    def load_object(self, digest):
+        with gzip.open(self.object_path(digest), 'rb') as object_file:
+            return object_file.read()
+
+    def user_files(self):
+        # Files of the users directory by relative path. Temporary files of an ongoing write
+        # are skipped, and so is the registry, which 'registry.py' rebuilds from the tree.
+        # Pinned versions and lock files only matter to running processes.
+        files = {}
+        for directory, subdirectories, names in os.walk(self.users_directory):
+            subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+            for name in names:
+                if name.endswith('.tmp') or name.startswith((REGISTRY_FILE, '.')):
+                    continue
+                path = os.path.join(directory, name)
+                files[os.path.relpath(path, self.users_directory).replace(os.sep, '/')] = path
+        return files
+
+    def backup_file(self, path, previous):
+        """
+        Back up one file.
+
+        Parameters:
+            path (str): The file.
+            previous (dict, optional): The entry of the file in the last snapshot.
+
+        Returns:
+            dict: The entry with 'hash', 'size' and 'mtime', or None if the file disappeared.
+
+        A file with the same size and mtime as in the last snapshot is not read again.
+        """
+        try:
+            stat = os.stat(path)
+            if previous and previous['size'] == stat.st_size and previous['mtime'] == stat.st_mtime_ns:
+                return dict(previous)
+            with open(path, 'rb') as user_file:
+                content = user_file.read()
+        except FileNotFoundError:
+            return None
+        return {'hash': self.store_object(content), 'size': len(content), 'mtime': stat.st_mtime_ns}
+
+    def snapshot(self):
+        """
+        Take an incremental snapshot of the users directory.
+
+        Returns:
+            tuple: The snapshot ID and the number of new or changed files.
+
+        Writers are never blocked. Every file is replaced atomically by the
+        storage, so each one is read whole. The manifest of a user is written
+        last by every save, so the files of a user are read again when the
+        manifest changed while they were read.
+        """
+        snapshots = self.list_snapshots()
+        previous = self.load_snapshot(snapshots[-1])['files'] if snapshots else {}
+        snapshot_id = dt.datetime.now(dt.timezone.utc).strftime(SNAPSHOT_FORMAT)
+
+        groups = {}
+        for relative_path, path in self.user_files().items():
+            groups.setdefault(os.path.dirname(relative_path), {})[relative_path] = path
+
+        files = {}
+        read = 0
+        for group, paths in sorted(groups.items()):
+            manifest_path = f'{group}/{MANIFEST_FILE}'
+            for _ in range(CONSISTENT_READ_ATTEMPTS):
+                entries = {}
+                for relative_path, path in sorted(paths.items()):
+                    entry = self.backup_file(path, previous.get(relative_path))
+                    if entry is not None:
+                        entries[relative_path] = entry
+                if manifest_path not in paths:
+                    break
+                check = self.backup_file(paths[manifest_path], entries.get(manifest_path))
+                if check == entries.get(manifest_path):
+                    break
+            read += sum(entry != previous.get(relative_path) for relative_path, entry in entries.items())
+            files.update(entries)
+
+        os.makedirs(self.snapshots_directory, exist_ok=True)
+        ShardedUserStorage.write_json(self.snapshot_path(snapshot_id), {'created': snapshot_id, 'files': files})
+        return snapshot_id, read
+
+    def find_snapshot(self, at=None):
+        """
+        Find the last snapshot taken at or before a time.
+
+        Parameters:
+            at (datetime, optional): The point in time, in UTC. Defaults to now.
+
+        Returns:
+            str: The snapshot ID.
+
+        Raises:
+            ValueError: If there is no snapshot that old.
+        """
+        snapshots = self.list_snapshots()
+        if at is not None:
+            limit = at.strftime(SNAPSHOT_FORMAT)
+            snapshots = [snapshot_id for snapshot_id in snapshots if snapshot_id <= limit]
+        if not snapshots:
+            raise ValueError("There is no snapshot to restore from.")
+        return snapshots[-1]
+
+    def restore_user(self, user, snapshot_id):
+        """
+        Restore the files of one user from a snapshot.
+
+        Parameters:
+            user (str): The username.
+            snapshot_id (str): The snapshot.
+
+        Returns:
+            int: The number of restored files.
+
+        Only the objects of the user are decompressed and only the directory of
+        the user is listed. Files of the user which did not exist at the time
+        of the snapshot are removed, and the manifest is written last, like in
+        a save. Writers of the user wait on its lock meanwhile, and a
+        'reinitialized' change numbered after the replaced log keeps the
+        generation growing. The directory is registered again if the registry lost it.
+        """
+        files = self.load_snapshot(snapshot_id)['files']
+        # The files of a user sit in a directory named after the user, in the flat or the fan-out layout
+        user_files = {relative_path: entry for relative_path, entry in files.items()
+                      if relative_path == f'{user}.json' or relative_path.split('/')[-2:-1] == [user]}
+        if not user_files:
+            raise ValueError(f"Snapshot {snapshot_id} has no files of {user}.")
+
+        manifest_paths = {relative_path for relative_path in user_files
+                          if relative_path.endswith(f'/{MANIFEST_FILE}')}
+        user_directories = [os.path.join(self.users_directory, *os.path.dirname(relative_path).split('/'))
+                            for relative_path in manifest_paths]
+        with contextlib.ExitStack() as stack:
+            last_seqs = {}
+            for user_directory in user_directories:
+                stack.enter_context(get_user_lock(user_directory).exclusive())
+                last_seqs[user_directory] = ChangeLog(user, user_directory).last_seq()
+
+            for directory in {os.path.dirname(relative_path) for relative_path in user_files} - {''}:
+                path = os.path.join(self.users_directory, *directory.split('/'))
+                for name in os.listdir(path) if os.path.isdir(path) else []:
+                    # Copies of broken files are left for inspection
+                    if name.endswith(('.json', '.jsonl')) and f'{directory}/{name}' not in user_files:
+                        os.remove(os.path.join(path, name))
+
+            for relative_path in sorted(user_files, key=lambda relative_path: relative_path in manifest_paths):
+                path = os.path.join(self.users_directory, *relative_path.split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f'{path}.tmp'
+                with open(tmp_path, 'wb') as user_file:
+                    user_file.write(self.load_object(user_files[relative_path]['hash']))
+                os.replace(tmp_path, path)
+
+            # The restored log is older than the one it replaced, the generation continues after both
+            for user_directory, last_seq in last_seqs.items():
+                ChangeLog(user, user_directory).append([('reinitialized', {'snapshot': snapshot_id}, time.time())],
+                                                       after=last_seq)
+
+        for relative_path in manifest_paths:
+            get_registry(self.users_directory).register(user, os.path.join(self.users_directory,
+                                                                         os.path.dirname(relative_path)))
+        return len(user_files)
+
+
+def parse_time(value):
+    # Naive times are taken as local time
+    moment = dt.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.astimezone()
+    return moment.astimezone(dt.timezone.utc)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Back up and restore the users directory.")
+    arg_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+    arg_parser.add_argument('--backup-dir', default=BACKUP_DIRECTORY)
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('snapshot', help="take an incremental snapshot")
+    subparsers.add_parser('list', help="list the snapshots")
+    restore_parser = subparsers.add_parser('restore', help="restore one user")
+    restore_parser.add_argument('user')
+    restore_parser.add_argument('--at', type=parse_time, help="restore the state at this time (ISO format)")
+    restore_parser.add_argument('--snapshot', help="restore this snapshot")
+
+    args = arg_parser.parse_args()
+    store = BackupStore(args.backup_dir, args.users_dir)
+
+    if args.command == 'snapshot':
+        snapshot_id, read = store.snapshot()
+        print(f"Snapshot {snapshot_id} taken, {read} changed file(s) backed up.")
+    elif args.command == 'list':
+        for snapshot_id in store.list_snapshots():
+            print(snapshot_id)
+    elif args.command == 'restore':
+        try:
+            snapshot_id = args.snapshot or store.find_snapshot(args.at)
+            restored = store.restore_user(args.user, snapshot_id)
+        except ValueError as error:
+            arg_parser.exit(1, f"{error}\n")
+        print(f"Restored {restored} file(s) of {args.user} from snapshot {snapshot_id}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,579 @@
+import os
+import argparse
+import datetime as dt
+
+from currency import format_amount
+from categories import get_category_registry
+from storage import (USERS_DIRECTORY, ShardedUserStorage, month_key, month_name_from_key, parse_month_key, shift_month,
+                     sharded_users)
+
+THRESHOLDS = (50, 80, 100)
+BUDGETS_FILE = 'budgets.json'
+
+
+class BudgetEvent:
+    def __init__(self, user, month, threshold, total, limit, currency, kind='threshold', category=None, days=None):
+        """
+        Initializes a new BudgetEvent object.
+
+        Parameters:
+            user (str): The username the event belongs to.
+            month (str): The month key in the format 'YYYY-MM'.
+            threshold (int): The crossed threshold in percent.
+            total (float): The amount spent in the month.
+            limit (float): The limit of the month.
+            currency (str): The base currency of the user, which the total and the limit are in.
+            kind (str, optional): 'threshold' when fired on save, 'month_end' when fired by a month-end run.
+            category (str, optional): The category ID of a category budget.
+            days (int, optional): The window length of a rolling budget.
+
+        Returns:
+            None
+        """
+        self.user = user
+        self.month = month
+        self.threshold = threshold
+        self.total = total
+        self.limit = limit
+        self.currency = currency
+        self.kind = kind
+        self.category = category
+        self.days = days
+
+    @property
+    def percent(self):
+        return self.total / self.limit * 100 if self.limit else 0
+
+    def __repr__(self):
+        scope = f", category={self.category!r}" if self.category else ""
+        if self.days:
+            scope += f", days={self.days}"
+        return (f"BudgetEvent({self.kind}, user={self.user!r}, month={self.month}{scope}, "
+                f"threshold={self.threshold}%, total={self.total:.2f}, limit={self.limit:.2f})")
+
+
+class BudgetEngine:
+    def __init__(self, thresholds=THRESHOLDS, handlers=None):
+        """
+        Initializes a new BudgetEngine object.
+
+        Parameters:
+            thresholds (tuple, optional): Thresholds in percent of the limit. Defaults to 50, 80 and 100.
+            handlers (list, optional): Callables receiving every fired BudgetEvent.
+
+        Returns:
+            None
+
+        The engine works on the running month totals kept in the manifest,
+        so every check is O(1) and never sums expenses again.
+        """
+        self.thresholds = tuple(sorted(thresholds))
+        self.handlers = list(handlers) if handlers else []
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def remove_handler(self, handler):
+        self.handlers.remove(handler)
+
+    def fire(self, event):
+        for handler in self.handlers:
+            handler(event)
+
+    def reached_thresholds(self, total, limit):
+        if not limit or limit <= 0:
+            return []
+        percent = total / limit * 100
+        return [threshold for threshold in self.thresholds if percent >= threshold]
+
+    def crossed_thresholds(self, month_info):
+        """
+        Get the thresholds reached by the running total of a month.
+
+        Parameters:
+            month_info (dict): The manifest entry of the month.
+
+        Returns:
+            list: Reached thresholds in percent, lowest first.
+        """
+        return self.reached_thresholds(month_info.get('total', 0), month_info.get('limit'))
+
+    def check_month(self, storage, key, month_info):
+        """
+        Compare the running total of a month with its limit and fire new threshold events.
+
+        Parameters:
+            storage (ShardedUserStorage): The storage of the user.
+            key (str): The month key in the format 'YYYY-MM'.
+            month_info (dict): The manifest entry of the month as returned by 'save_expense' or 'set_limit'.
+
+        Returns:
+            list: The fired events.
+
+        Every threshold is reported once per month. The manifest is only
+        rewritten when a new threshold is reached.
+        """
+        already_alerted = set(month_info.get('alerted', []))
+        new_thresholds = [threshold for threshold in self.crossed_thresholds(month_info)
+                          if threshold not in already_alerted]
+        if not new_thresholds:
+            return []
+
+        storage.mark_alerted(key, new_thresholds)
+        month_info['alerted'] = sorted(already_alerted | set(new_thresholds))
+
+        events = [BudgetEvent(storage.user, key, threshold, month_info.get('total', 0), month_info['limit'],
+                              storage.rates.base)
+                  for threshold in new_thresholds]
+        for event in events:
+            self.fire(event)
+        return events
+
+    def evaluate_all(self, key, users_directory=USERS_DIRECTORY):
+        """
+        Evaluate the limits of every user for a month, e.g. at the month end.
+
+        Parameters:
+            key (str): The month key in the format 'YYYY-MM'.
+            users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+
+        Returns:
+            list: One 'month_end' event for every user with a limit in the month.
+
+        Only the manifest of every user is read, the month shards are never opened.
+        """
+        events = []
+        for user in sharded_users(users_directory):
+            storage = ShardedUserStorage(user, users_directory)
+            month_info = storage.get_month_info(key)
+            if not month_info or not month_info.get('limit'):
+                continue
+            reached = self.crossed_thresholds(month_info)
+            event = BudgetEvent(user, key, reached[-1] if reached else 0,
+                                month_info.get('total', 0), month_info['limit'], storage.rates.base, kind='month_end')
+            self.fire(event)
+            events.append(event)
+        return events
+
+
+class RollingWindow:
+    def __init__(self, days, end=None, totals=None):
+        """
+        Initializes a new RollingWindow object.
+
+        Parameters:
+            days (int): The length of the window in days.
+            end (int, optional): The ordinal of the newest day in the window.
+            totals (list, optional): Daily totals, indexed by day ordinal modulo 'days'.
+
+        Returns:
+            None
+
+        The window is a ring buffer of daily totals with a running sum, so adding
+        an expense and reading the sum of the last 'days' days are both O(1)
+        (sliding forward clears at most one slot per elapsed day).
+        """
+        self.days = days
+        self.end = end
+        self.totals = list(totals) if totals and len(totals) == days else [0] * days
+        self.total = sum(self.totals)
+
+    def advance(self, day):
+        if self.end is None:
+            self.end = day
+            return
+        if day <= self.end:
+            return
+        if day - self.end >= self.days:
+            self.totals = [0] * self.days
+            self.total = 0
+        else:
+            for ordinal in range(self.end + 1, day + 1):
+                slot = ordinal % self.days
+                self.total -= self.totals[slot]
+                self.totals[slot] = 0
+        self.end = day
+
+    def add(self, day, amount):
+        """
+        Add an amount to a day of the window.
+
+        Parameters:
+            day (int): The day ordinal of the expense.
+            amount (float): The amount spent.
+
+        Returns:
+            bool: False if the day is too old for the window, True otherwise.
+        """
+        self.advance(day)
+        if day <= self.end - self.days:
+            return False
+        self.totals[day % self.days] += amount
+        self.total += amount
+        return True
+
+    def value(self, day):
+        self.advance(day)
+        return self.total
+
+    def to_dict(self):
+        return {'end': self.end, 'totals': self.totals}
+
+
+class CategoryBudget:
+    def __init__(self, category, limit, days=None):
+        """
+        Initializes a new CategoryBudget object.
+
+        Parameters:
+            category (str): The expense category as its ID, like the totals are keyed.
+            limit (float): The spending limit.
+            days (int, optional): The length of a rolling window, e.g. 30 for "last 30 days".
+                                  The budget covers the calendar month when not set.
+
+        Returns:
+            None
+        """
+        self.category = category
+        self.limit = limit
+        self.days = days
+
+    @property
+    def budget_id(self):
+        return f"{self.category}:{self.days}d" if self.days else f"{self.category}:month"
+
+    def to_dict(self):
+        return {'category': self.category, 'limit': self.limit, 'days': self.days}
+
+    @classmethod
+    def from_dict(cls, data):
+        # Budgets saved before the totals were keyed by category ID hold the name
+        return cls(get_category_registry().key(data['category']), data['limit'], data.get('days'))
+
+
+class CategoryBudgetTracker:
+    def __init__(self, storage, engine):
+        """
+        Initializes a new CategoryBudgetTracker object.
+
+        Parameters:
+            storage (ShardedUserStorage): The storage of the user.
+            engine (BudgetEngine): The engine whose thresholds and handlers are used.
+
+        Returns:
+            None
+
+        Budgets are stored in 'users/<user>/budgets.json' together with the ring
+        buffers of the rolling budgets and the thresholds already reported.
+        Month budgets are compared with the running category totals of the manifest.
+        Every change reads the file again and writes it under the lock of the
+        user, so trackers of the same user in other processes or front ends
+        never overwrite each other's spending.
+        """
+        self.storage = storage
+        self.engine = engine
+        self.budgets_file = os.path.join(storage.user_directory, BUDGETS_FILE)
+        self.budgets = {}
+        self.windows = {}
+        self.alerted = {}
+        self.load()
+
+    def load(self):
+        data = self.storage.read_json(self.budgets_file, {})
+        if not isinstance(data, dict):
+            data = {}
+        self.budgets = {}
+        saved_ids = {}
+        for budget_data in data.get('budgets', []):
+            budget = CategoryBudget.from_dict(budget_data)
+            self.budgets[budget.budget_id] = budget
+            saved_ids[budget.budget_id] = CategoryBudget(budget_data['category'], 0, budget.days).budget_id
+        # Thresholds reported under the ID of a budget saved by name move to its current ID
+        renamed = {saved_id: budget_id for budget_id, saved_id in saved_ids.items() if saved_id != budget_id}
+        self.alerted = {}
+        for alerted_key, thresholds in data.get('alerted', {}).items():
+            saved_id, _, key = alerted_key.partition(':month:')
+            if key:
+                saved_id += ':month'
+            budget_id = renamed.get(saved_id, saved_id)
+            self.alerted[f"{budget_id}:{key}" if key else budget_id] = thresholds
+
+        self.windows = {}
+        for budget_id, budget in self.budgets.items():
+            if not budget.days:
+                continue
+            window_data = data.get('windows', {}).get(saved_ids[budget_id])
+            if window_data:
+                self.windows[budget_id] = RollingWindow(budget.days, window_data.get('end'),
+                                                        window_data.get('totals'))
+            else:
+                self.windows[budget_id] = self.build_window(budget)
+
+    def save(self):
+        self.storage.ensure_directory()
+        self.storage.write_json(self.budgets_file, {
+            'budgets': [budget.to_dict() for budget in self.budgets.values()],
+            'windows': {budget_id: window.to_dict() for budget_id, window in self.windows.items()},
+            'alerted': self.alerted
+        })
+
+    def build_window(self, budget, today=None):
+        """
+        Fill the ring buffer of a new rolling budget from the stored history.
+
+        Parameters:
+            budget (CategoryBudget): A rolling budget.
+            today (date, optional): The newest day of the window. Defaults to today.
+
+        Returns:
+            RollingWindow: The filled window.
+
+        This is the only time the days of the window are walked; afterwards
+        the window is kept up to date by 'record_expense'.
+        """
+        today = today or dt.date.today()
+        start = today - dt.timedelta(days=budget.days - 1)
+        window = RollingWindow(budget.days, today.toordinal())
+        dates = self.storage.get_dates(dt.datetime.combine(start, dt.time()), dt.datetime.combine(today, dt.time()))
+        for date, expenses_for_date in dates.items():
+            amount = expenses_for_date.get(budget.category)
+            if amount:
+                window.add(dt.date.fromisoformat(date).toordinal(), amount)
+        return window
+
+    def set_budget(self, category, limit, days=None):
+        """
+        Add or replace a category budget.
+
+        Parameters:
+            category (str): The expense category.
+            limit (float): The spending limit.
+            days (int, optional): The length of a rolling window. Calendar month when not set.
+
+        Returns:
+            CategoryBudget: The stored budget.
+        """
+        budget = CategoryBudget(get_category_registry().key(category), limit, days)
+        with self.storage.exclusive():
+            self.load()
+            self.budgets[budget.budget_id] = budget
+            self.alerted.pop(budget.budget_id, None)
+            if days:
+                self.windows[budget.budget_id] = self.build_window(budget)
+            self.save()
+        return budget
+
+    def remove_budget(self, category, days=None):
+        """
+        Remove a category budget.
+
+        Parameters:
+            category (str): The expense category.
+            days (int, optional): The length of a rolling window. Calendar month when not set.
+
+        Returns:
+            bool: False if the user has no such budget.
+        """
+        budget_id = CategoryBudget(get_category_registry().key(category), 0, days).budget_id
+        with self.storage.exclusive():
+            self.load()
+            if self.budgets.pop(budget_id, None) is None:
+                return False
+            self.windows.pop(budget_id, None)
+            self.alerted.pop(budget_id, None)
+            self.save()
+        return True
+
+    def spent(self, budget, month_info=None, day=None):
+        """
+        Get the amount counted against a budget.
+
+        Parameters:
+            budget (CategoryBudget): The budget.
+            month_info (dict, optional): The manifest entry of the month, needed for month budgets.
+            day (date, optional): The newest day of a rolling window. Defaults to today.
+
+        Returns:
+            float: The amount spent in the category.
+        """
+        if budget.days:
+            day = day or dt.date.today()
+            return self.windows[budget.budget_id].value(day.toordinal())
+        if month_info is None:
+            month_info = self.storage.get_month_info(month_key(str(day or dt.date.today()))) or {}
+        return month_info.get('categories', {}).get(budget.category, 0)
+
+    def record_expense(self, expense, amount, date, month_info):
+        """
+        Update the budgets of a category with a saved expense and fire new threshold events.
+
+        Parameters:
+            expense (str): The expense category.
+            amount (float): The amount spent.
+            date (str): The date of the expense in the format 'YYYY-MM-DD'.
+            month_info (dict): The manifest entry of the month as returned by 'save_expense'.
+
+        Returns:
+            list: The fired events.
+        """
+        category = get_category_registry().key(expense)
+        with self.storage.exclusive():
+            # Another tracker of the user may have counted expenses since
+            self.load()
+            budgets = [budget for budget in self.budgets.values() if budget.category == category]
+            if not budgets:
+                return []
+            events = self.count_expense(budgets, amount, date, month_info)
+            self.save()
+        for event in events:
+            self.engine.fire(event)
+        return events
+
+    def count_expense(self, budgets, amount, date, month_info):
+        # Adds the amount to the windows and returns the events of newly reached thresholds
+        category = budgets[0].category
+        day = dt.date.fromisoformat(date)
+        key = month_key(date)
+        events = []
+        for budget in budgets:
+            if budget.days:
+                window = self.windows[budget.budget_id]
+                window.add(day.toordinal(), amount)
+                # "Last N days" is counted back from today, or from the newest recorded day
+                spent = window.value(max(dt.date.today().toordinal(), window.end))
+                alerted_key = budget.budget_id
+            else:
+                spent = month_info.get('categories', {}).get(category, 0)
+                alerted_key = f"{budget.budget_id}:{key}"
+
+            reached = self.engine.reached_thresholds(spent, budget.limit)
+            already_alerted = set(self.alerted.get(alerted_key, []))
+            # Rolling windows re-arm thresholds once the spending drops below them
+            self.alerted[alerted_key] = reached if budget.days else sorted(already_alerted | set(reached))
+            for threshold in reached:
+                if threshold in already_alerted:
+                    continue
+                events.append(BudgetEvent(self.storage.user, key, threshold, spent, budget.limit,
+                                          self.storage.rates.base, category=budget.category, days=budget.days))
+        return events
+
+
+def save_with_budgets(storage, engine, category_budgets, expense, amount, date, note=None, tags=None,
+                      currency=None):
+    """
+    Save an expense and check it against the month limit and the category budgets of the user.
+
+    Parameters:
+        storage (ShardedUserStorage): The storage of the user.
+        engine (BudgetEngine): The engine checking the month limit.
+        category_budgets (CategoryBudgetTracker): The category budgets of the same user.
+        expense (str): The expense category.
+        amount (float): The amount spent.
+        date (str): The date of the expense in the format 'YYYY-MM-DD'.
+        note (str, optional): A free-text note.
+        tags (list, optional): Tags of the expense.
+        currency (str, optional): The currency of the amount. Defaults to the base currency.
+
+    Returns:
+        tuple: The ID of the saved record, the updated month information and the fired events.
+
+    Raises:
+        ValueError: If there is no exchange rate for the currency at the date, nothing is saved then.
+    """
+    # Budgets are kept in the base currency, the amount is converted before anything is saved
+    currency = (currency or storage.rates.base).upper()
+    base_amount = storage.rates.to_base(amount, currency, date)
+    expense_id, month_info = storage.add_record(expense, amount, date, note, tags, currency)
+    events = engine.check_month(storage, month_key(date), month_info)
+    events += category_budgets.record_expense(expense, base_amount, date, month_info)
+    return expense_id, month_info, events
+
+
+def describe_event(event):
+    month = month_name_from_key(event.month)
+    limit = format_amount(event.limit, event.currency)
+    if event.category:
+        category = get_category_registry().decode(event.category)
+        period = f"the last {event.days} days" if event.days else month
+        if event.threshold >= 100:
+            return f"You have exceeded your {category} limit of {limit} for {period}!"
+        return f"You have used {event.threshold}% of your {category} limit of {limit} for {period}."
+    if event.kind == 'month_end':
+        return f"{event.user} spent {event.percent:.0f}% of the limit for {month}."
+    if event.threshold >= 100:
+        return f"You have exceeded your limit of {limit} for {month}!"
+    return f"You have used {event.threshold}% of your limit of {limit} for {month}."
+
+
+def describe_budget(tracker, budget):
+    spent = tracker.spent(budget)
+    period = f"the last {budget.days} days" if budget.days else "this month"
+    return (f"{get_category_registry().decode(budget.category)}: "
+            f"{format_amount(spent, tracker.storage.rates.base)} of "
+            f"{format_amount(budget.limit, tracker.storage.rates.base)} spent in {period}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Manage the category budgets of a user and run the "
+                                                     "month-end evaluation of the limits.")
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    set_parser = subparsers.add_parser('set', help="add or replace a category budget")
+    set_parser.add_argument('user')
+    set_parser.add_argument('category', help="the category name, e.g. Food")
+    set_parser.add_argument('limit', type=float, help="the limit in the base currency")
+    set_parser.add_argument('--days', type=int, default=None, help="a rolling window of this many days "
+                                                                   "(the calendar month by default)")
+    set_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+
+    remove_parser = subparsers.add_parser('remove', help="remove a category budget")
+    remove_parser.add_argument('user')
+    remove_parser.add_argument('category')
+    remove_parser.add_argument('--days', type=int, default=None)
+    remove_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+
+    list_parser = subparsers.add_parser('list', help="list the category budgets and what was spent")
+    list_parser.add_argument('user')
+    list_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+
+    month_end_parser = subparsers.add_parser('month-end', help="report the spending of every user with a limit "
+                                                               "in a month")
+    month_end_parser.add_argument('--month', type=parse_month_key, default=None,
+                                  help="the month as 'YYYY-MM' (the previous month by default)")
+    month_end_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+
+    args = arg_parser.parse_args()
+
+    if args.command == 'month-end':
+        key = args.month or shift_month(dt.date.today().strftime("%Y-%m"), -1)
+        engine = BudgetEngine(handlers=[lambda event: print(describe_event(event))])
+        events = engine.evaluate_all(key, args.users_dir)
+        print(f"Evaluated the limits of {len(events)} user(s) for {month_name_from_key(key)}.")
+        return
+
+    storage = ShardedUserStorage(args.user, args.users_dir)
+    tracker = CategoryBudgetTracker(storage, BudgetEngine())
+    if args.command in ('set', 'remove'):
+        if args.category not in get_category_registry().by_name:
+            arg_parser.error(f"Unknown category {args.category!r}.")
+        if args.days is not None and args.days < 1:
+            arg_parser.error("'--days' must be at least 1.")
+    if args.command == 'set':
+        if args.limit <= 0:
+            arg_parser.error("The limit must be a positive number.")
+        budget = tracker.set_budget(args.category, args.limit, args.days)
+        print(f"Budget set. {describe_budget(tracker, budget)}.")
+    elif args.command == 'remove':
+        if tracker.remove_budget(args.category, args.days):
+            print(f"Removed the {args.category} budget of {args.user}.")
+        else:
+            print(f"{args.user} has no such {args.category} budget.")
+    elif args.command == 'list':
+        if not tracker.budgets:
+            print(f"{args.user} has no category budgets.")
+        for budget in tracker.budgets.values():
+            print(describe_budget(tracker, budget))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import os
+import json
+
+CATEGORIES_FILE = 'categories.json'
+
+DEFAULT_CATEGORIES = [
+    {'id': 1, 'name': 'Food', 'description': 'including groceries, dining out, and takeout'},
+    {'id': 2, 'name': 'Housing', 'description': 'rent or mortgage payments, utilities, maintenance'},
+    {'id': 3, 'name': 'Transportation', 'description': 'gasoline, public transit, vehicle maintenance'},
+    {'id': 4, 'name': 'Health and wellness', 'description': 'healthcare expenses, gym memberships, medications'},
+    {'id': 5, 'name': 'Entertainment', 'description': 'movies, concerts, streaming services'},
+    {'id': 6, 'name': 'Shopping', 'description': 'clothing, electronics, personal care products'},
+    {'id': 7, 'name': 'Travel', 'description': 'flights, hotels, vacation activities'},
+    {'id': 8, 'name': 'Utilities', 'description': 'electricity, water, internet, phone'},
+    {'id': 9, 'name': 'Education', 'description': 'tuition, books, supplies'},
+    {'id': 10, 'name': 'Debt payments', 'description': 'credit card bills, loans'},
+    {'id': 11, 'name': 'Insurance', 'description': 'health, auto, home'},
+    {'id': 12, 'name': 'Personal care', 'description': 'haircuts, spa treatments, grooming products'},
+    {'id': 13, 'name': 'Gifts and donations', 'description': 'birthday presents, charity donations'},
+    {'id': 14, 'name': 'Household supplies', 'description': 'cleaning products, toiletries'},
+    {'id': 15, 'name': 'Other Expenses', 'description': ''}
+]
+
+
+class Category:
+    def __init__(self, category_id, name, description='', parent_id=None):
+        self.category_id = category_id
+        self.name = name
+        self.description = description
+        self.parent_id = parent_id
+
+    @property
+    def label(self):
+        return f"{self.name} ({self.description})" if self.description else self.name
+
+
+class CategoryRegistry:
+    def __init__(self, categories):
+        """
+        Initializes a new CategoryRegistry object.
+
+        Parameters:
+            categories (list): Dicts with 'id', 'name' and optionally 'description' and 'parent',
+                               the ID of the parent category.
+
+        Returns:
+            None
+
+        Raises:
+            ValueError: If an ID or name is used twice, a parent is unknown or the parents form a cycle.
+
+        IDs are stable and are what month shards store for every record. The
+        daily, month and rollup totals are keyed by the ID as a string, since
+        JSON object keys are strings, and only reports turn them into names.
+        The ancestors of every category are computed once here, so rolling
+        totals up to parents is a dict lookup per category.
+        """
+        self.by_id = {}
+        self.by_name = {}
+        for data in categories:
+            # IDs may be written as strings in the JSON file, like the keys of the totals
+            parent_id = int(data['parent']) if data.get('parent') is not None else None
+            category = Category(int(data['id']), data['name'], data.get('description', ''), parent_id)
+            if category.category_id in self.by_id or category.name in self.by_name:
+                raise ValueError(f"Category {category.category_id} {category.name!r} is defined twice.")
+            self.by_id[category.category_id] = category
+            self.by_name[category.name] = category
+
+        self.children = {category_id: [] for category_id in self.by_id}
+        self.roots = []
+        for category in sorted(self.by_id.values(), key=lambda item: item.category_id):
+            if category.parent_id is None:
+                self.roots.append(category.category_id)
+            elif category.parent_id in self.by_id:
+                self.children[category.parent_id].append(category.category_id)
+            else:
+                raise ValueError(f"Category {category.name!r} has an unknown parent {category.parent_id}.")
+
+        # Every category with its ancestors, the category first and the top-level one last
+        self.ancestors = {}
+        for category_id in self.by_id:
+            chain = [category_id]
+            while self.by_id[chain[-1]].parent_id is not None:
+                chain.append(self.by_id[chain[-1]].parent_id)
+                if chain[-1] in chain[:-1]:
+                    raise ValueError(f"Categories {chain} form a cycle.")
+            self.ancestors[category_id] = tuple(chain)
+
+        # Depth-first order of the menu and the reports, children right after their parent
+        self.order = []
+        stack = list(reversed(self.roots))
+        while stack:
+            category_id = stack.pop()
+            self.order.append(category_id)
+            stack.extend(reversed(self.children[category_id]))
+
+    @classmethod
+    def load(cls, path=CATEGORIES_FILE):
+        """
+        Load the categories from a JSON file.
+
+        Parameters:
+            path (str, optional): The file with a 'categories' list. Defaults to 'categories.json'.
+
+        Returns:
+            CategoryRegistry: The default categories with the categories of the file added. An entry
+                              with the ID of a default category replaces it.
+        """
+        try:
+            with open(path, 'r') as json_file:
+                data = json.load(json_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+        configured = data.get('categories', []) if isinstance(data, dict) else []
+        categories = {category['id']: category for category in DEFAULT_CATEGORIES}
+        categories.update({int(category['id']): category for category in configured})
+        return cls(categories.values())
+
+    def get(self, category_id):
+        return self.by_id.get(category_id)
+
+    def depth(self, category_id):
+        return len(self.ancestors[category_id]) - 1
+
+    def menu_rows(self):
+        # Rows of the category table, subcategories indented under their parent
+        return [["    " * self.depth(category_id) + self.by_id[category_id].label, category_id]
+                for category_id in self.order]
+
+    def encode(self, name):
+        # Names which are not in the registry, e.g. from an older configuration, are stored as they are
+        category = self.by_name.get(name)
+        return name if category is None else category.category_id
+
+    def key(self, name):
+        # The key of a category in the totals, names which are not in the registry are kept as they are
+        category = self.by_name.get(name)
+        return name if category is None else str(category.category_id)
+
+    def category_id(self, value):
+        # The ID of a record column value or of a totals key, None for names which are not in the registry
+        if isinstance(value, str) and value.isdigit():
+            value = int(value)
+        return value if isinstance(value, int) and value in self.by_id else None
+
+    def decode(self, value):
+        category_id = self.category_id(value)
+        return value if category_id is None else self.by_id[category_id].name
+
+    def keyed(self, totals):
+        """
+        Key category totals by category ID.
+
+        Parameters:
+            totals (dict): Totals by category name or key, e.g. as saved before the totals were keyed by ID.
+
+        Returns:
+            dict: Totals by key. Totals of a name and of the key of the same category are added up.
+        """
+        keyed = {}
+        for category, amount in totals.items():
+            key = self.key(category)
+            keyed[key] = keyed.get(key, 0) + amount
+        return keyed
+
+    def names(self, totals):
+        # Totals by key as totals by name, for display
+        return {self.decode(key): amount for key, amount in totals.items()}
+
+    def rollup(self, totals):
+        """
+        Roll category totals up to the parent categories.
+
+        Parameters:
+            totals (dict): Totals by category key, as saved.
+
+        Returns:
+            list: Tuples (name, total including subcategories, depth) in menu order. Names which are
+                  not in the registry come last as top-level categories.
+        """
+        rolled = {}
+        unknown = []
+        for key, amount in totals.items():
+            category_id = self.category_id(key)
+            if category_id is None:
+                unknown.append((key, amount, 0))
+                continue
+            for ancestor in self.ancestors[category_id]:
+                rolled[ancestor] = rolled.get(ancestor, 0) + amount
+        return [(self.by_id[category_id].name, rolled[category_id], self.depth(category_id))
+                for category_id in self.order if category_id in rolled] + unknown
+
+
+category_registries = {}
+
+
+def get_category_registry(path=CATEGORIES_FILE):
+    # The registry of a file is loaded once per process
+    path = os.path.abspath(path)
+    if path not in category_registries:
+        category_registries[path] = CategoryRegistry.load(path)
+    return category_registries[path]
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import argparse
+
+from registry import get_registry
+
+CHANGES_FILE = 'changes.jsonl'
+EVENT_KINDS = ('expense_added', 'expense_updated', 'expense_deleted', 'limit_set', 'reinitialized')
+POLL_INTERVAL = 1.0
+
+
+class ChangeEvent:
+    def __init__(self, user, seq, kind, data, timestamp=None):
+        """
+        Initializes a new ChangeEvent object.
+
+        Parameters:
+            user (str): The username the change belongs to.
+            seq (int): The sequence number of the change in the log of the user, starting at 1.
+            kind (str): One of 'EVENT_KINDS'.
+            data (dict): The record for expense events, 'month' and 'limit' for 'limit_set'.
+            timestamp (float, optional): The time of the change. Defaults to now.
+
+        Returns:
+            None
+        """
+        self.user = user
+        self.seq = seq
+        self.kind = kind
+        self.data = data
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def to_dict(self):
+        return {'seq': self.seq, 'time': self.timestamp, 'user': self.user, 'kind': self.kind, 'data': self.data}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['user'], data['seq'], data['kind'], data.get('data', {}), data.get('time'))
+
+    def __repr__(self):
+        return f"ChangeEvent({self.kind}, user={self.user!r}, seq={self.seq}, data={self.data!r})"
+
+
+class ChangeFeed:
+    def __init__(self, handlers=None):
+        """
+        Initializes a new ChangeFeed object.
+
+        Parameters:
+            handlers (list, optional): Callables receiving every published ChangeEvent.
+
+        Returns:
+            None
+
+        In-process subscribers are called once the change is in the log of the user.
+        """
+        self.handlers = list(handlers or [])
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def remove_handler(self, handler):
+        if handler in self.handlers:
+            self.handlers.remove(handler)
+
+    def publish(self, event):
+        for handler in self.handlers:
+            handler(event)
+
+
+# The feed every storage publishes to unless it is given its own
+feed = ChangeFeed()
+
+
+def last_line(path):
+    # Read the log backwards in blocks, so finding the last sequence number is O(1)
+    try:
+        with open(path, 'rb') as log_file:
+            log_file.seek(0, os.SEEK_END)
+            end = log_file.tell()
+            data = b''
+            while end > 0 and data.count(b'\n') < 2:
+                start = max(0, end - 4096)
+                log_file.seek(start)
+                data = log_file.read(end - start) + data
+                end = start
+    except FileNotFoundError:
+        return None
+    lines = data.strip().splitlines()
+    return lines[-1] if lines else None
+
+
+class ChangeLog:
+    def __init__(self, user, user_directory, change_feed=None):
+        """
+        Initializes a new ChangeLog object.
+
+        Parameters:
+            user (str): The username.
+            user_directory (str): The directory of the user.
+            change_feed (ChangeFeed, optional): The feed to publish to. Defaults to the module feed.
+
+        Returns:
+            None
+
+        The log is 'users/<user>/changes.jsonl', one event per line with
+        increasing sequence numbers, so a consumer resumes from the last one it saw.
+        """
+        self.user = user
+        self.path = os.path.join(user_directory, CHANGES_FILE)
+        self.feed = change_feed if change_feed is not None else feed
+
+    def last_seq(self):
+        line = last_line(self.path)
+        if line is None:
+            return 0
+        try:
+            return json.loads(line)['seq']
+        except (ValueError, KeyError):
+            return 0
+
+    def append(self, changes, after=0):
+        """
+        Append changes to the log and publish them.
+
+        Parameters:
+            changes (list): Tuples (kind, data, timestamp).
+            after (int, optional): A sequence number the new ones must follow even if the log
+                                   doesn't hold it, e.g. the last one of a log that was replaced.
+
+        Returns:
+            list: The new ChangeEvent objects.
+        """
+        if not changes:
+            return []
+        seq = max(self.last_seq(), after)
+        events = []
+        for kind, data, timestamp in changes:
+            seq += 1
+            events.append(ChangeEvent(self.user, seq, kind, data, timestamp))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a') as log_file:
+            log_file.write(''.join(json.dumps(event.to_dict()) + '\n' for event in events))
+        for event in events:
+            self.feed.publish(event)
+        return events
+
+    def size(self):
+        # The byte length of the log, a later read can start there
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def read(self, offset=0, position=0):
+        """
+        Read the events after an offset.
+
+        Parameters:
+            offset (int, optional): The last sequence number already seen. Defaults to 0.
+            position (int, optional): A byte position returned by 'size' before the offset was
+                                      seen, the lines before it are skipped. Defaults to 0.
+
+        Returns:
+            generator: ChangeEvent objects in sequence order.
+
+        A position which isn't the start of a line of the current log, e.g.
+        after the log was replaced, is ignored and the whole log is read.
+        """
+        try:
+            with open(self.path, 'rb') as log_file:
+                if position > 0:
+                    log_file.seek(position - 1)
+                    if log_file.read(1) != b'\n':
+                        log_file.seek(0)
+                for line in log_file:
+                    try:
+                        data = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash is skipped
+                        continue
+                    if data['seq'] > offset:
+                        yield ChangeEvent.from_dict(data)
+        except FileNotFoundError:
+            return
+
+    def tail(self, offset=0, interval=POLL_INTERVAL):
+        """
+        Follow the log of the user.
+
+        Parameters:
+            offset (int, optional): The last sequence number already seen. Defaults to 0.
+            interval (float, optional): Seconds between polls. Defaults to 1.
+
+        Returns:
+            generator: ChangeEvent objects, waiting for new ones forever.
+        """
+        while True:
+            for event in self.read(offset):
+                offset = event.seq
+                yield event
+            time.sleep(interval)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Read the change log of a user.")
+    arg_parser.add_argument('user')
+    arg_parser.add_argument('--offset', type=int, default=0, help="the last sequence number already seen")
+    arg_parser.add_argument('--follow', action='store_true', help="keep waiting for new changes")
+    arg_parser.add_argument('--users-dir', default='users')
+
+    args = arg_parser.parse_args()
+
+    change_log = ChangeLog(args.user, get_registry(args.users_dir).user_directory(args.user))
+    events = change_log.tail(args.offset) if args.follow else change_log.read(args.offset)
+    try:
+        for event in events:
+            print(json.dumps(event.to_dict()), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
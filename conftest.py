@@ -0,0 +1,26 @@
+import pytest
+
+from storage import ShardedUserStorage, BufferedUserStorage
+
+
+@pytest.fixture
+def users_directory(tmp_path, monkeypatch):
+    # Rates and categories are read from the working directory, the defaults are used
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path / 'users')
+
+
+@pytest.fixture
+def storage_of(users_directory):
+    # A new storage for every call, like separate writers of the same user
+    def storage_of(user='alice', rates=None):
+        return ShardedUserStorage(user, users_directory, rates=rates)
+    return storage_of
+
+
+@pytest.fixture
+def buffer_of(users_directory):
+    # Buffers which only flush when told to
+    def buffer_of(user='alice'):
+        return BufferedUserStorage(user, users_directory, max_events=None, window_ms=None)
+    return buffer_of
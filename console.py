@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import contextlib
+
+
+class TerminalConsole:
+    # Prompts and output go through 'sys.stdin' and 'sys.stdout', only clearing the screen needs the terminal
+    def clear(self):
+        # For Windows
+        if os.name == 'nt':
+            _ = os.system('cls')
+        # For Unix/Linux/MacOS
+        else:
+            _ = os.system('clear')
+
+
+class ScriptedConsole:
+    CLEAR_MARK = '\n[clear screen]\n'
+
+    def __init__(self, keystrokes, clock=time.perf_counter):
+        """
+        Initializes a new ScriptedConsole object.
+
+        Parameters:
+            keystrokes (list): The lines typed by the user, in order.
+            clock (callable, optional): The clock of the step timings. Defaults to 'time.perf_counter'.
+
+        Returns:
+            None
+
+        Stands in for 'sys.stdin' and 'sys.stdout' while a session is replayed.
+        'input()' reads the next keystroke from it, and running out of keystrokes
+        ends the session with EOFError like a closed terminal would. Every step
+        records the time from a keystroke until the application asks for the
+        next one, which is what the user waits for.
+        """
+        self.keystrokes = list(keystrokes)
+        self.clock = clock
+        self.position = 0
+        self.output = []
+        self.steps = []
+        self.step_start = None
+        self.step_output = 0
+        self.clears = 0
+
+    def write(self, text):
+        self.output.append(text)
+        self.step_output += len(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def clear(self):
+        self.write(self.CLEAR_MARK)
+        self.clears += 1
+
+    def last_prompt(self):
+        # The prompt is the last line written before input() reads
+        text = ''.join(self.output[-3:])
+        return text.rsplit('\n', 1)[-1].strip()
+
+    def readline(self):
+        now = self.clock()
+        if self.step_start is not None:
+            self.steps[-1]['seconds'] = now - self.step_start
+            self.steps[-1]['output'] = self.step_output
+        if self.position >= len(self.keystrokes):
+            self.step_start = None
+            return ''
+        keystroke = self.keystrokes[self.position]
+        self.position += 1
+        self.steps.append({'prompt': self.last_prompt(), 'input': keystroke, 'seconds': None, 'output': 0})
+        # Echoed like a terminal does, so the transcript reads like the session
+        self.output.append(keystroke + '\n')
+        self.step_output = 0
+        self.step_start = self.clock()
+        return keystroke + '\n'
+
+    def finish(self):
+        # The step after the last keystroke ends when the session does
+        if self.step_start is not None:
+            self.steps[-1]['seconds'] = self.clock() - self.step_start
+            self.steps[-1]['output'] = self.step_output
+            self.step_start = None
+
+    @property
+    def transcript(self):
+        return ''.join(self.output)
+
+
+active_console = TerminalConsole()
+
+
+def get_console():
+    return active_console
+
+
+@contextlib.contextmanager
+def use_console(console):
+    """
+    Route the input, output and screen clearing of the current process through a console.
+
+    Parameters:
+        console (ScriptedConsole): The console of a replayed session.
+
+    Returns:
+        context manager: Restores the terminal when the block ends.
+    """
+    global active_console
+    previous = active_console, sys.stdin, sys.stdout
+    active_console = console
+    sys.stdin = sys.stdout = console
+    try:
+        yield console
+    finally:
+        console.finish()
+        active_console, sys.stdin, sys.stdout = previous
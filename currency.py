@@ -0,0 +1,170 @@
+import os
+import json
+import bisect
+
+from categories import get_category_registry
+
+BASE_CURRENCY = 'USD'
+RATES_FILE = 'rates.json'
+SYMBOLS = {'USD': '$', 'EUR': '€', 'GBP': '£', 'UAH': '₴', 'PLN': 'zł', 'JPY': '¥'}
+
+
+def format_amount(amount, currency):
+    symbol = SYMBOLS.get(currency)
+    if symbol == '$':
+        return f"${amount:.2f}"
+    if symbol:
+        return f"{amount:.2f} {symbol}"
+    return f"{amount:.2f} {currency}"
+
+
+class RateTable:
+    def __init__(self, rates=None, base=BASE_CURRENCY):
+        """
+        Initializes a new RateTable object.
+
+        Parameters:
+            rates (dict, optional): Rates by currency and date 'YYYY-MM-DD', the value of one unit in the base currency.
+            base (str, optional): The base currency. Defaults to 'USD'.
+
+        Returns:
+            None
+
+        A date without its own rate uses the closest earlier one. Every
+        (currency, date) pair is looked up once and then memoized.
+        """
+        self.base = base
+        self.dates = {}
+        self.values = {}
+        for currency, rates_by_date in (rates or {}).items():
+            currency = currency.upper()
+            self.dates[currency] = sorted(rates_by_date)
+            self.values[currency] = [rates_by_date[date] for date in self.dates[currency]]
+        self.cache = {}
+
+    @classmethod
+    def load(cls, path=RATES_FILE):
+        """
+        Load a rate table from a JSON file.
+
+        Parameters:
+            path (str, optional): The file with 'base' and 'rates' entries. Defaults to 'rates.json'.
+
+        Returns:
+            RateTable: The table, only knowing the base currency if the file is missing or broken.
+        """
+        try:
+            with open(path, 'r') as json_file:
+                data = json.load(json_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        return cls(data.get('rates', {}), data.get('base', BASE_CURRENCY))
+
+    @property
+    def currencies(self):
+        return sorted({self.base} | set(self.dates))
+
+    def rate(self, currency, date):
+        """
+        Get the value of one unit of a currency in the base currency.
+
+        Parameters:
+            currency (str): The currency code.
+            date (str): The date in the format 'YYYY-MM-DD'.
+
+        Returns:
+            float: The rate.
+
+        Raises:
+            ValueError: If the table has no rate for the currency on or before the date.
+        """
+        if currency == self.base:
+            return 1.0
+        cache_key = (currency, date)
+        if cache_key not in self.cache:
+            dates = self.dates.get(currency)
+            position = bisect.bisect_right(dates, date) if dates else 0
+            if position == 0:
+                raise ValueError(f"No {currency} exchange rate for {date}.")
+            self.cache[cache_key] = self.values[currency][position - 1]
+        return self.cache[cache_key]
+
+    def to_base(self, amount, currency, date):
+        return amount * self.rate(currency, date)
+
+    def convert_many(self, amounts, dates, currency, target):
+        """
+        Convert many amounts of one currency at once.
+
+        Parameters:
+            amounts (list): The amounts.
+            dates (list): The date of every amount in the format 'YYYY-MM-DD'.
+            currency (str): The currency of all amounts.
+            target (str): The currency to convert to.
+
+        Returns:
+            list: The converted amounts.
+
+        The cross rate is computed once for every distinct date.
+        """
+        if currency == target:
+            return list(amounts)
+        cross_rates = {date: self.rate(currency, date) / self.rate(target, date) for date in set(dates)}
+        return [amount * cross_rates[date] for amount, date in zip(amounts, dates)]
+
+    def convert_records(self, records, target):
+        """
+        Convert the amounts of many records to one currency.
+
+        Parameters:
+            records (list): Records with 'date', 'amount' and 'currency'.
+            target (str): The currency to convert to.
+
+        Returns:
+            list: The converted amount of every record, in the order of the records.
+
+        Records are grouped by currency first and every group is converted in bulk.
+        """
+        groups = {}
+        for position, record in enumerate(records):
+            group = groups.setdefault(record.get('currency') or self.base, ([], [], []))
+            group[0].append(position)
+            group[1].append(record['amount'])
+            group[2].append(record['date'])
+
+        converted = [0] * len(records)
+        for currency, (positions, amounts, dates) in groups.items():
+            for position, amount in zip(positions, self.convert_many(amounts, dates, currency, target)):
+                converted[position] = amount
+        return converted
+
+    def category_totals(self, records, target):
+        """
+        Sum records by category in one currency.
+
+        Parameters:
+            records (list): Records with 'date', 'category', 'amount' and 'currency'.
+            target (str): The currency of the totals.
+
+        Returns:
+            dict: Totals by category ID, like the totals of the storage.
+        """
+        categories = get_category_registry()
+        category_totals = {}
+        for record, amount in zip(records, self.convert_records(records, target)):
+            key = categories.key(record['category'])
+            category_totals[key] = category_totals.get(key, 0) + amount
+        return category_totals
+
+
+rate_tables = {}
+
+
+def get_rate_table(path=RATES_FILE):
+    # The table of a file is loaded once per process
+    path = os.path.abspath(path)
+    if path not in rate_tables:
+        rate_tables[path] = RateTable.load(path)
+    return rate_tables[path]
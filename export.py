@@ -0,0 +1,262 @@
+import os
+import csv
+import json
+import time
+import argparse
+
+from storage import USERS_DIRECTORY, ShardedUserStorage, sharded_users, legacy_users
+from categories import get_category_registry
+from jsonstream import LegacyUserFile
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+EXPORT_COLUMNS = ('user', 'id', 'date', 'category', 'amount', 'currency', 'base', 'note', 'tags', 'deleted')
+BATCH_SIZE = 1000
+
+
+class CsvExportWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=EXPORT_COLUMNS)
+        self.writer.writeheader()
+
+    def write_batch(self, rows):
+        self.writer.writerows(dict(row, tags=','.join(row['tags'])) for row in rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesExportWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def write_batch(self, rows):
+        self.file.write(''.join(json.dumps(row) + '\n' for row in rows))
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetExportWriter:
+    def __init__(self, path):
+        if pyarrow is None:
+            raise RuntimeError("Parquet export needs pyarrow, install it with 'pip install pyarrow'.")
+        self.schema = pyarrow.schema([
+            ('user', pyarrow.string()),
+            ('id', pyarrow.string()),
+            ('date', pyarrow.string()),
+            ('category', pyarrow.string()),
+            ('amount', pyarrow.float64()),
+            ('currency', pyarrow.string()),
+            ('base', pyarrow.float64()),
+            ('note', pyarrow.string()),
+            ('tags', pyarrow.list_(pyarrow.string())),
+            ('deleted', pyarrow.bool_())
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_batch(self, rows):
+        # Every batch becomes one row group of the file
+        self.writer.write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'csv': CsvExportWriter, 'jsonl': JsonLinesExportWriter, 'parquet': ParquetExportWriter}
+
+
+def shard_rows(user, key, shard, dates=None):
+    """
+    Turn the records of a month shard into export rows.
+
+    Parameters:
+        user (str): The username.
+        key (str): The month key in the format 'YYYY-MM'.
+        shard (dict): The month shard.
+        dates (set, optional): Only export these dates, deleted records included.
+
+    Returns:
+        generator: Rows with the fields of 'EXPORT_COLUMNS'.
+
+    A full export skips deleted records. An incremental export keeps them, so
+    the consumer can drop rows it has already loaded by their ID.
+    """
+    records = shard['records']
+    categories = get_category_registry()
+    for position in range(len(records['day'])):
+        date = f"{key}-{records['day'][position]:02d}"
+        if dates is None:
+            if records['deleted'][position]:
+                continue
+        elif date not in dates:
+            continue
+        yield {
+            'user': user,
+            'id': f"{key}.{position}",
+            'date': date,
+            'category': categories.decode(records['category'][position]),
+            'amount': records['amount'][position],
+            'currency': records['currency'][position],
+            'base': records['base'][position],
+            'note': records['note'][position],
+            'tags': list(records['tags'][position]),
+            'deleted': bool(records['deleted'][position])
+        }
+
+
+def user_rows(storage, since=None):
+    """
+    Walk the month shards of a user one at a time.
+
+    Parameters:
+        storage (ShardedUserStorage): The storage of the user.
+        since (float, optional): The watermark, only dates changed after it are exported.
+
+    Returns:
+        generator: Export rows.
+
+    The manifest stamps show which months changed, so unchanged shards are never opened.
+    """
+    for key, month_info in sorted(storage.load_manifest()['months'].items()):
+        if since is not None and month_info.get('modified', 0) <= since:
+            continue
+        shard = storage.load_shard(key)
+        dates = None
+        if since is not None:
+            dates = {date for date, modified in shard.get('modified', {}).items() if modified > since}
+        yield from shard_rows(storage.user, key, shard, dates)
+
+
+def legacy_rows(storage, since=None):
+    """
+    Stream the daily expenses of a single-file history.
+
+    Parameters:
+        storage (ShardedUserStorage): The storage of a user who was not migrated yet.
+        since (float, optional): The watermark, the file is only exported if it changed after it.
+
+    Returns:
+        generator: Export rows, one per date and category.
+
+    The file is read one date at a time, like in the statistics, and nothing
+    is migrated. Single-file histories have no records, so the rows have no
+    ID and their amounts are in the base currency. The file has no stamps
+    per date, so an incremental export exports all of it again once it changed.
+    """
+    if since is not None and os.path.getmtime(storage.legacy_file) <= since:
+        return
+    base = storage.rates.base
+    for date, expenses_for_date in LegacyUserFile(storage.legacy_file).iter_dates():
+        for category, amount in expenses_for_date.items():
+            yield {
+                'user': storage.user,
+                'id': None,
+                'date': date,
+                'category': category,
+                'amount': amount,
+                'currency': base,
+                'base': amount,
+                'note': '',
+                'tags': [],
+                'deleted': False
+            }
+
+
+def batched(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_watermark(state_path):
+    state = ShardedUserStorage.read_json(state_path, None)
+    if not isinstance(state, dict):
+        return None
+    return state.get('watermark')
+
+
+def save_watermark(state_path, watermark):
+    ShardedUserStorage.write_json(state_path, {'watermark': watermark})
+
+
+def export_expenses(output, export_format='csv', users_directory=USERS_DIRECTORY, users=None,
+                    batch_size=BATCH_SIZE, since=None):
+    """
+    Export the expense records of many users.
+
+    Parameters:
+        output (str): The output file.
+        export_format (str, optional): 'csv', 'jsonl' or 'parquet'. Defaults to 'csv'.
+        users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+        users (list, optional): The users to export. Defaults to every user, single-file users included.
+        batch_size (int, optional): The number of rows written at once. Defaults to 1000.
+        since (float, optional): The watermark of an incremental export.
+
+    Returns:
+        int: The number of exported rows.
+
+    Rows are streamed from one shard, or one date of a single-file history,
+    at a time and written in fixed-size batches, so memory use does not
+    grow with the history.
+    """
+    writer = WRITERS[export_format](output)
+    count = 0
+    try:
+        for user in users or sorted(set(sharded_users(users_directory)) | set(legacy_users(users_directory))):
+            storage = ShardedUserStorage(user, users_directory)
+            if not storage.registered and os.path.exists(storage.legacy_file):
+                rows = legacy_rows(storage, since)
+            else:
+                rows = user_rows(storage, since)
+            for batch in batched(rows, batch_size):
+                writer.write_batch(batch)
+                count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Export the expenses of every user.")
+    arg_parser.add_argument('output', help="the output file")
+    arg_parser.add_argument('--format', choices=FORMATS,
+                            help="the output format (taken from the file extension by default)")
+    arg_parser.add_argument('--users', nargs='*', help="users to export (all users by default)")
+    arg_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+    arg_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help="only export the dates changed since the last incremental export")
+    arg_parser.add_argument('--state', default='export_state.json', help="the file keeping the watermark")
+
+    args = arg_parser.parse_args()
+
+    export_format = args.format or os.path.splitext(args.output)[1].lstrip('.').lower()
+    if export_format not in FORMATS:
+        arg_parser.error(f"unknown format '{export_format}', use --format")
+
+    since = load_watermark(args.state) if args.incremental else None
+    # Changes made while the export runs are picked up again by the next one
+    started = time.time()
+    try:
+        count = export_expenses(args.output, export_format, args.users_dir, args.users, args.batch_size, since)
+    except RuntimeError as error:
+        arg_parser.exit(1, f"{error}\n")
+    if args.incremental:
+        save_watermark(args.state, started)
+    print(f"Exported {count} row(s) to {args.output}.")
+
+
+if __name__ == '__main__':
+    main()
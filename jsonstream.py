@@ -0,0 +1,287 @@
+import os
+import re
+import json
+from json.decoder import scanstring
+
+CHUNK_SIZE = 1 << 16
+# Files up to this size are parsed with json.load, which is faster when memory is not a concern
+STREAMING_THRESHOLD = 32 << 20
+
+NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?')
+LITERALS = {'true': True, 'false': False, 'null': None}
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + '{}[]:,"'
+
+
+class JsonTokenizer:
+    def __init__(self, json_file, chunk_size=CHUNK_SIZE):
+        """
+        Initializes a new JsonTokenizer object.
+
+        Parameters:
+            json_file (file): A file opened in text mode.
+            chunk_size (int, optional): The number of characters read at once. Defaults to 64 KiB.
+
+        Returns:
+            None
+
+        The file is read in chunks and only the current token is kept, so
+        memory use does not depend on the size of the file.
+        """
+        self.file = json_file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.peeked = None
+
+    def fill(self):
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def error(self, message):
+        raise ValueError(f"Invalid JSON: {message}.")
+
+    def next(self):
+        """
+        Read the next token.
+
+        Returns:
+            tuple: The kind, one of '{', '}', '[', ']', ':', ',', 'string', 'value' or 'end', and the value.
+        """
+        if self.peeked is not None:
+            token, self.peeked = self.peeked, None
+            return token
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                break
+        if self.pos >= len(self.buffer):
+            return 'end', None
+
+        char = self.buffer[self.pos]
+        if char in '{}[]:,':
+            self.pos += 1
+            return char, None
+
+        while True:
+            if char == '"':
+                try:
+                    value, end = scanstring(self.buffer, self.pos + 1)
+                except json.JSONDecodeError as decode_error:
+                    # The string may go on in the next chunk
+                    if not self.fill():
+                        self.error(decode_error.msg)
+                    continue
+                self.pos = end
+                return 'string', value
+
+            # A number or literal is only complete once the character after it was read
+            end = self.pos
+            while end < len(self.buffer) and self.buffer[end] not in DELIMITERS:
+                end += 1
+            if end == len(self.buffer) and self.fill():
+                continue
+            text = self.buffer[self.pos:end]
+            self.pos = end
+            if text in LITERALS:
+                return 'value', LITERALS[text]
+            if NUMBER.fullmatch(text):
+                return 'value', float(text) if any(sign in text for sign in '.eE') else int(text)
+            self.error(f"unexpected {text[:20]!r}")
+
+    def peek(self):
+        if self.peeked is None:
+            self.peeked = self.next()
+        return self.peeked
+
+    def expect(self, kind):
+        token = self.next()
+        if token[0] != kind:
+            self.error(f"expected {kind!r}, got {token[0]!r}")
+        return token
+
+
+def parse_value(tokenizer, token=None):
+    """
+    Build the next value of a tokenizer.
+
+    Parameters:
+        tokenizer (JsonTokenizer): The tokenizer.
+        token (tuple, optional): The first token of the value, if it was already read.
+
+    Returns:
+        The value, like json.load would return it.
+    """
+    kind, value = token or tokenizer.next()
+    if kind in ('string', 'value'):
+        return value
+    if kind == '{':
+        return {key: parse_value(tokenizer) for key in iter_members(tokenizer, opened=True)}
+    if kind == '[':
+        items = []
+        if tokenizer.peek()[0] == ']':
+            tokenizer.next()
+            return items
+        while True:
+            items.append(parse_value(tokenizer))
+            if tokenizer.next()[0] == ']':
+                return items
+    tokenizer.error(f"unexpected {kind!r}")
+
+
+def skip_value(tokenizer):
+    # Skip the next value without building it
+    depth = 0
+    while True:
+        kind, _ = tokenizer.next()
+        if kind in '{[':
+            depth += 1
+        elif kind in '}]':
+            depth -= 1
+        elif kind == 'end':
+            tokenizer.error("unexpected end of file")
+        if depth == 0 and kind not in ':,':
+            return
+
+
+def iter_members(tokenizer, opened=False):
+    """
+    Walk the members of an object.
+
+    Parameters:
+        tokenizer (JsonTokenizer): The tokenizer, in front of the object.
+        opened (bool, optional): True if the '{' was already read.
+
+    Returns:
+        generator: The keys. The consumer must read or skip the value of every key before the next one.
+    """
+    if not opened:
+        tokenizer.expect('{')
+    if tokenizer.peek()[0] == '}':
+        tokenizer.next()
+        return
+    while True:
+        key = tokenizer.expect('string')[1]
+        tokenizer.expect(':')
+        yield key
+        kind = tokenizer.next()[0]
+        if kind == '}':
+            return
+        if kind != ',':
+            tokenizer.error(f"expected ',' or '}}', got {kind!r}")
+
+
+class LegacyUserFile:
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        """
+        Initializes a new LegacyUserFile object.
+
+        Parameters:
+            path (str): A single-file history 'users/<user>.json'.
+            chunk_size (int, optional): The number of characters read at once. Defaults to 64 KiB.
+
+        Returns:
+            None
+
+        Reads the 'date' and 'month' sections of the file one entry at a time,
+        skipping everything else without building it.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def iter_section(self, section, wanted=None):
+        # Entries of one top-level section as (key, value) pairs, a missing or broken file has none.
+        # Values of keys which are not wanted are skipped without being built.
+        try:
+            with open(self.path, 'r') as json_file:
+                tokenizer = JsonTokenizer(json_file, self.chunk_size)
+                if tokenizer.peek()[0] != '{':
+                    return
+                for key in iter_members(tokenizer):
+                    if key != section or tokenizer.peek()[0] != '{':
+                        skip_value(tokenizer)
+                        continue
+                    for entry_key in iter_members(tokenizer):
+                        if wanted is None or wanted(entry_key):
+                            yield entry_key, parse_value(tokenizer)
+                        else:
+                            skip_value(tokenizer)
+        except (FileNotFoundError, ValueError):
+            return
+
+    def iter_dates(self, start_str=None, end_str=None):
+        """
+        Walk the daily expenses of the file.
+
+        Parameters:
+            start_str (str, optional): The first date in the format 'YYYY-MM-DD'.
+            end_str (str, optional): The last date in the format 'YYYY-MM-DD'.
+
+        Returns:
+            generator: Pairs (date, expenses of the date) in file order.
+        """
+        return self.iter_section('date', lambda date: (start_str is None or date >= start_str)
+                                 and (end_str is None or date <= end_str))
+
+    def iter_months(self):
+        return self.iter_section('month')
+
+    def get_month_data(self, month_name):
+        """
+        Get the data of one month.
+
+        Parameters:
+            month_name (str): The month in the format 'Month Year'.
+
+        Returns:
+            dict: The month data with 'limit' and 'expenses', or None if the month has no data.
+
+        Reading stops at the month, the other months are skipped unparsed.
+        """
+        for _, month_data in self.iter_section('month', lambda name: name == month_name):
+            return month_data
+        return None
+
+
+def iter_legacy(path):
+    """
+    Walk a single-file history.
+
+    Parameters:
+        path (str): The file 'users/<user>.json'.
+
+    Returns:
+        generator: Tuples (section, key, value), section being 'date' or 'month'.
+
+    Small files are loaded at once, large ones are streamed.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    if size > STREAMING_THRESHOLD:
+        legacy_file = LegacyUserFile(path)
+        for section in ('date', 'month'):
+            for key, value in legacy_file.iter_section(section):
+                yield section, key, value
+        return
+    try:
+        with open(path, 'r') as json_file:
+            data = json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+    if not isinstance(data, dict):
+        return
+    for section in ('date', 'month'):
+        entries = data.get(section)
+        if isinstance(entries, dict):
+            for key, value in entries.items():
+                yield section, key, value
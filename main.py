@@ -1,36 +1,62 @@
 from prettytable import PrettyTable
 import os
+import sys
+import argparse
+import functools
 import datetime as dt
 from prettytable import prettytable
 from termcolor import colored
-import json
 from dateutil import parser
 import re
+from storage import ShardedUserStorage, month_key, month_name_from_key, parse_month_key, month_days
+from budget import BudgetEngine, CategoryBudgetTracker, save_with_budgets, describe_event
+from rollups import range_totals
+from search import search_expenses
+from currency import format_amount
+from analytics import SpendingAnalytics, describe_forecast
+from recurring import RecurringScheduler, FREQUENCIES
+from categories import get_category_registry
+from console import get_console
+from profiling import Profiler, add_profile_arguments, profiler_from_args
+from reportcache import report_cache
+from schema import SchemaError
 
 TODAY = dt.datetime.today().date()
 
+# Names of the menu commands, as selected with '--profile'
+OPERATIONS = {
+    '1': 'add_todays_expenses',
+    '2': 'add_expenses',
+    '3': 'display_month_data',
+    '4': 'days_report',
+    '5': 'search_report',
+    '6': 'manage_expenses',
+    '7': 'select_currency',
+    '8': 'manage_recurring',
+    '9': 'months_overview'
+}
+OVERVIEW_MONTHS = 6
+
 
 def clear_screen():
-    # For Windows
-    if os.name == 'nt':
-        _ = os.system('cls')
-    # For Unix/Linux/MacOS
-    else:
-        _ = os.system('clear')
+    # The terminal, or the scripted console of a replayed session
+    get_console().clear()
 
 
 os.environ['TERM'] = 'xterm'
 
 
 class ExpenseTracker:
-    def __init__(self, user=None):
+    def __init__(self, user=None, profiler=None):
 
-        self.user = user
+        self.user = user if user else "default_user"  # Assign a default username or handle authentication
+        self.profiler = profiler or Profiler()
+        self.storage = ShardedUserStorage(self.user)
         self.check_emptiness()
+        self.analytics = SpendingAnalytics(self.storage)
 
-        self.user = user if user else "default_user"  # Assign a default username or handle authentication
-        self.expense_report = ExpensesReport(self.user)
         self.expense_manager = ExpenseManager(self.user)
+        self.expense_report = ExpensesReport(self.user, self.expense_manager.save_expense)
         self.user_table = PrettyTable()
         self.user_table.field_names = ["Name of the command", "Command"]
         self.user_table.padding_width = 5
@@ -40,34 +66,27 @@ class ExpenseTracker:
             ['Add expenses for selected day', 2],
             ['Display month data', 3],
             ['Get days report', 4],
+            ['Search expenses', 5],
+            ['Edit or delete expenses', 6],
+            ['Change report currency', 7],
+            ['Recurring expenses', 8],
+            ['Months overview', 9],
             ['Log out', 'e']
         ])
 
     def check_emptiness(self):
-        user_directory = 'users'
-        user_file = f'{user_directory}/{self.user}.json'
-
-        # Create the directory if it doesn't exist
-        if not os.path.exists(user_directory):
-            os.makedirs(user_directory)
-
-        # Now proceed with the rest of your file handling
-        try:
-            with open(user_file, 'r'):
-                pass
-        except FileNotFoundError:
+        # Registered users already have their layout, the file system is only checked for new ones
+        if self.storage.registered:
+            return
+        # Users with a single-file history are migrated to month shards here
+        if not os.path.exists(self.storage.manifest_file) and not os.path.exists(self.storage.legacy_file):
             self.initialize_file_with_format()
+        else:
+            self.storage.check_layout()
 
     def initialize_file_with_format(self):
-        user_directory = 'users'
-        if not os.path.exists(user_directory):
-            os.makedirs(user_directory)
-
-        user_file = f'{user_directory}/{self.user}.json'
-
-        with open(user_file, 'w') as json_file:
-            json_file.write('{}')  # Empty JSON object to initialize
-        print(f"User file {user_file} created successfully.")
+        self.storage.initialize_layout()
+        print(f"User directory {self.storage.user_directory} created successfully.")
 
 
     def run(self):
@@ -79,27 +98,57 @@ class ExpenseTracker:
         """
         # Call check_emptiness here on the ExpenseManager instance (not a string)
         self.expense_manager.check_emptiness()
+        # Recurring expenses due since the last start are saved with the usual budget checks
+        self.expense_manager.recurring.materialize(TODAY)
 
         while True:
             clear_screen()
             print(self.user_table)
             print()
+            # The forecast is cached and only recomputed after new changes
+            for line in describe_forecast(self.analytics.forecast(TODAY), self.storage.rates.base):
+                print(line)
+            print()
             choice = input("Enter command: ")
-            match choice:
-                case '1':
-                    self.expense_manager.add_expenses(str(TODAY))
-                case '2':
-                    self.expense_manager.add_expenses()
-                case '3':
-                    self.expense_report.display_month_data()
-                case '4':
-                    self.expense_report.days_report()
-                case 'e':
-                    return True
-                case _:
-                    clear_screen()
-                    print("Invalid input.\n".upper())
-                    input("Press to continue... ")
+            if choice == 'e':
+                return True
+            # Only the operations selected with '--profile' are profiled
+            with self.profiler.profile(OPERATIONS.get(choice, 'invalid'), self.user):
+                self.run_command(choice)
+
+    def run_command(self, choice):
+        """
+        Run one command of the menu.
+
+        Parameters:
+            choice (str): The command entered by the user.
+
+        Returns:
+            None
+        """
+        match choice:
+            case '1':
+                self.expense_manager.add_expenses(str(TODAY))
+            case '2':
+                self.expense_manager.add_expenses()
+            case '3':
+                self.expense_report.display_month_data()
+            case '4':
+                self.expense_report.days_report()
+            case '5':
+                self.expense_report.search_report()
+            case '6':
+                self.expense_manager.manage_expenses()
+            case '7':
+                self.expense_report.select_currency()
+            case '8':
+                self.expense_manager.manage_recurring()
+            case '9':
+                self.expense_report.months_overview()
+            case _:
+                clear_screen()
+                print("Invalid input.\n".upper())
+                input("Press to continue... ")
 
 
 class ExpenseManager:
@@ -116,48 +165,19 @@ class ExpenseManager:
         Method initializes the attributes of the ExpenseManager object.
         """
         self.user = user
+        self.storage = ShardedUserStorage(user)
+        self.budget_engine = BudgetEngine(handlers=[self.print_budget_event])
+        self.category_budgets = CategoryBudgetTracker(self.storage, self.budget_engine)
+        self.recurring = RecurringScheduler(self.storage, self.save_expense)
+        self.categories = get_category_registry()
         self.expenses_table = PrettyTable()
         self.expenses_table.hrules = prettytable.ALL
         self.expenses_table.field_names = ["Category", "Command"]
         self.expenses_table.padding_width = 2
         self.expenses_table.align["Command"] = 'c'
         self.expenses_table.align["Category"] = 'l'
-        self.expenses_table.add_rows([
-            ['Food (including groceries, dining out, and takeout)', 1],
-            ['Housing (rent or mortgage payments, utilities, maintenance)', 2],
-            ['Transportation (gasoline, public transit, vehicle maintenance)', 3],
-            ['Health and wellness (healthcare expenses, gym memberships, medications)', 4],
-            ['Entertainment (movies, concerts, streaming services)', 5],
-            ['Shopping (clothing, electronics, personal care products)', 6],
-            ['Travel (flights, hotels, vacation activities)', 7],
-            ['Utilities (electricity, water, internet, phone)', 8],
-            ['Education (tuition, books, supplies)', 9],
-            ['Debt payments (credit card bills, loans)', 10],
-            ['Insurance (health, auto, home)', 11],
-            ['Personal care (haircuts, spa treatments, grooming products)', 12],
-            ['Gifts and donations (birthday presents, charity donations)', 13],
-            ['Household supplies (cleaning products, toiletries)', 14],
-            ['Other Expenses', 15],
-            ['Cancel operation', 'cancel']
-        ])
-
-        self.expenses = [
-            'Food',
-            'Housing',
-            'Transportation',
-            'Health and wellness',
-            'Entertainment',
-            'Shopping',
-            'Travel',
-            'Utilities',
-            'Education',
-            'Debt payments',
-            'Insurance',
-            'Personal care',
-            'Gifts and donations',
-            'Household supplies',
-            'Other Expenses'
-        ]
+        self.expenses_table.add_rows(self.categories.menu_rows())
+        self.expenses_table.add_row(['Cancel operation', 'cancel'])
 
     @staticmethod
     def get_date():
@@ -186,11 +206,22 @@ class ExpenseManager:
         date_obj = dt.datetime.strptime(date, "%Y-%m-%d")
         return date_obj.strftime("%d %B %Y")
 
+    def enter_currency(self):
+        currencies = self.storage.rates.currencies
+        while True:
+            currency = input(f"Enter currency ({', '.join(currencies)}), "
+                             f"press Enter for {self.storage.rates.base}: ").strip().upper()
+            if currency == "":
+                return self.storage.rates.base
+            if currency in currencies:
+                return currency
+            print(f"There is no exchange rate for {currency}. Choose one of: {', '.join(currencies)}\n")
+
     @staticmethod
-    def enter_amount():
+    def enter_amount(currency):
         while True:
             try:
-                amount = float(input("Enter amount of money you've spent: $").strip().lower())
+                amount = float(input(f"Enter amount of money you've spent ({currency}): ").strip().lower())
             except ValueError:
                 print("You should enter a number! (e.g - 8.50)\n")
                 continue
@@ -199,57 +230,45 @@ class ExpenseManager:
                 continue
             return amount
 
-    @staticmethod
-    def check_command(comm):
+    def check_command(self, comm):
+        # The command is the ID of a category, the category name is returned
         try:
-            comm = int(comm)
+            category = self.categories.get(int(comm))
         except ValueError:
-            print("Command is not valid. Please enter a number from 1 to 15 or 'cancel' to cancel operation")
+            print("Command is not valid. Please enter a number from the table or 'cancel' to cancel operation")
+            return False
+        if category is None:
+            print("There is no such category. Enter a number from the table or 'cancel' to cancel operation")
             return False
-        if 1 <= comm <= 15:
-            return comm
-        print("There is only 15 commands. Enter a number from 1 to 15 or 'cancel' to cancel operation")
-        return False
+        return category.name
+
+    @staticmethod
+    def print_budget_event(event):
+        color = 'red' if event.threshold >= 100 else 'yellow'
+        print(colored(describe_event(event), color, attrs={"bold"}))
 
     def initialize_file_with_format(self):
         """
-        Initialize the JSON file with a predefined format.
+        Initialize the user directory with a predefined format.
 
         Returns:
             None
 
-        Method initializes the JSON file associated with the user with a predefined format.
+        Method initializes the directory associated with the user with an empty manifest.
         """
-        with open(f'users/{self.user}.json', 'w') as json_file:
-            data = {
-                'date': {},
-                'month': {}
-            }
-            json.dump(data, json_file, indent=4)
+        self.storage.initialize_layout()
 
     def check_emptiness(self):
         """
-        Check if the JSON file is empty or not in the desired format.
+        Check if the user directory is empty or not in the desired format.
 
         Returns:
             None
 
-        Method checks if the JSON file associated with the user is empty or not in the desired format.
+        Method checks if the manifest associated with the user is missing, not in the desired
+        format or of an older schema version, which is upgraded in place.
         """
-        try:
-            with open(f'users/{self.user}.json', 'r') as json_file:
-                try:
-                    loaded_data = json.load(json_file)
-                    if 'date' in loaded_data and 'month' in loaded_data \
-                            and isinstance(loaded_data['date'], dict) \
-                            and isinstance(loaded_data['month'], dict):
-                        pass  # Data is in the desired format
-                    else:
-                        self.initialize_file_with_format()  # Reinitialize the file
-                except json.JSONDecodeError:
-                    self.initialize_file_with_format()  # File is empty or not valid JSON
-        except FileNotFoundError:
-            self.initialize_file_with_format()  # File doesn't exist, create with format
+        self.storage.check_layout()
 
     def logo_table_expenses(self, date):
         """
@@ -269,63 +288,27 @@ class ExpenseManager:
         logo = colored(self.user, attrs={"bold"})
         print(f"Username: {logo}\n")
 
-    def save_expense(self, expense, amount, date):
+    def save_expense(self, expense, amount, date, note=None, tags=None, currency=None):
         """
-        Save the expense to the JSON file.
+        Save the expense to the month shard of the date.
 
         Parameters:
             expense (str): The expense category.
             amount (float): The amount spent.
             date (str): The date of the expense.
+            note (str, optional): A free-text note, e.g. 'dentist'.
+            tags (list, optional): Tags of the expense.
+            currency (str, optional): The currency of the amount. Defaults to the base currency.
 
         Returns:
-            None
+            str: The ID of the saved record.
 
-        Method saves the expense and amount to the JSON file associated with the user.
+        Method saves the expense and amount to the month shard associated with the user
+        and checks the running month and category totals against the limits.
         """
-        # Read existing data from the JSON file
-        try:
-            with open(f"users/{self.user}.json", "r") as file:
-                data = json.load(file)
-        except (FileNotFoundError, json.JSONDecodeError):
-            data = {}
-
-        # Extract month and year from the date
-        date_obj = dt.datetime.strptime(date, "%Y-%m-%d")
-        month_year = date_obj.strftime("%B %Y")
-
-        # Update data for the specific date
-        if 'date' not in data:
-            data['date'] = {}
-        if date in data['date']:
-            # If expense already exists for the date, update the amount
-            if expense in data['date'][date]:
-                data['date'][date][expense] += amount
-            else:
-                # If expense doesn't exist for the date, add it
-                data['date'][date][expense] = amount
-        else:
-            # If there is no existing data for the date, create a new entry
-            data['date'][date] = {expense: amount}
-
-        # Update data for the specific month
-        if 'month' not in data:
-            data['month'] = {}
-
-        if month_year in data['month']:
-            if 'expenses' in data['month'][month_year] and expense in data['month'][month_year]['expenses']:
-                # If the expense exists for the month, update its amount
-                data['month'][month_year]['expenses'][expense] += amount
-            else:
-                # If the expense doesn't exist for the month, create a new entry
-                data['month'][month_year]['expenses'][expense] = amount
-        else:
-            # If month doesn't exist, create a new entry
-            data['month'][month_year] = {'limit': None, 'expenses': {expense: amount}}
-
-            # Write the updated data back to the JSON file
-        with open(f"users/{self.user}.json", "w") as file:
-            json.dump(data, file, indent=4)
+        expense_id, _, _ = save_with_budgets(self.storage, self.budget_engine, self.category_budgets,
+                                             expense, amount, date, note, tags, currency)
+        return expense_id
 
     def add_expenses(self, date=""):
         """
@@ -357,19 +340,29 @@ class ExpenseManager:
                     return
                 correct_input = self.check_command(exp_choice)
             clear_screen()
-            print(f"You have selected {self.expenses[correct_input - 1]} expense.\n")
-            amount = self.enter_amount()
+            print(f"You have selected {correct_input} expense.\n")
+            currency = self.enter_currency()
+            amount = self.enter_amount(currency)
+            note = input("Enter a note for this expense (optional): ").strip()
+            tags = input("Enter tags separated by commas (optional): ").strip()
             clear_screen()
-            choice = input(f"Do you want to add {self.expenses[correct_input - 1]} "
-                           f"expense with ${amount} of money spent at {f_date}? (y/n) ").lower().strip()
+            choice = input(f"Do you want to add {correct_input} "
+                           f"expense with {format_amount(amount, currency)} of money spent at {f_date}? (y/n) "
+                           ).lower().strip()
             while choice != 'y' and choice != 'n':
                 print("You should enter only 'y' to save expense or 'n' to cancel it!")
-                choice = input(f"Do you want to add {self.expenses[correct_input - 1]} "
-                               f"expense with ${amount} of money spent at {f_date}?").lower().strip()
+                choice = input(f"Do you want to add {correct_input} "
+                               f"expense with {format_amount(amount, currency)} of money spent at {f_date}?"
+                               ).lower().strip()
             if choice == 'n':
                 print("Expense wasn't saved to your list!\n")
                 continue
-            self.save_expense(self.expenses[correct_input - 1], amount, date)
+            try:
+                self.save_expense(correct_input, amount, date, note, tags, currency)
+            except ValueError as error:
+                print(f"{error} Expense wasn't saved to your list!\n")
+                input("Press to continue...")
+                continue
             print()
             choice = input("Do you want to add another expense? (y/n) ").strip().lower()
             while choice != 'y' and choice != 'n':
@@ -381,6 +374,207 @@ class ExpenseManager:
             else:
                 print()
 
+    def delete_expense(self, expense_id):
+        """
+        Delete a saved expense.
+
+        Parameters:
+            expense_id (str): The ID of the expense record.
+
+        Returns:
+            dict: The deleted record, or None if there is no such record.
+
+        Method takes the amount back out of the stored totals and the rolling budgets.
+        """
+        record, month_info = self.storage.delete_record(expense_id)
+        if record is not None:
+            self.category_budgets.record_expense(record['category'], -record['base'], record['date'], month_info)
+        return record
+
+    def edit_expense(self, expense_id, expense=None, amount=None, date=None, note=None, tags=None):
+        """
+        Edit a saved expense.
+
+        Parameters:
+            expense_id (str): The ID of the expense record.
+            expense (str, optional): The new category.
+            amount (float, optional): The new amount.
+            date (str, optional): The new date.
+            note (str, optional): The new note.
+            tags (list, optional): The new tags.
+
+        Returns:
+            str: The ID of the record, which changes when it moves to another month, or None.
+
+        Method updates the stored totals and checks the limits again.
+        """
+        old_record = self.storage.get_record(expense_id)
+        if old_record is None:
+            return None
+        new_id, month_info = self.storage.update_record(expense_id, expense, amount, date, note, tags)
+        new_record = self.storage.get_record(new_id)
+
+        old_month_info = month_info
+        if month_key(old_record['date']) != month_key(new_record['date']):
+            old_month_info = self.storage.get_month_info(month_key(old_record['date']))
+        self.category_budgets.record_expense(old_record['category'], -old_record['base'],
+                                             old_record['date'], old_month_info)
+        self.category_budgets.record_expense(new_record['category'], new_record['base'],
+                                             new_record['date'], month_info)
+        self.budget_engine.check_month(self.storage, month_key(new_record['date']), month_info)
+        return new_id
+
+    def manage_expenses(self):
+        """
+        Edit or delete the expenses of a date.
+
+        Returns:
+            None
+
+        Method lists the expenses saved for the selected date and lets the user
+        change the amount of one of them or delete it.
+        """
+        clear_screen()
+        date = self.get_date()
+        if date is None:
+            clear_screen()
+            print("You have successfully canceled operation!\n")
+            input("Press to continue...")
+            return
+
+        while True:
+            records = self.storage.list_records(date)
+            clear_screen()
+            if not records:
+                print(f"No expenses found for {self.format_date(date)}.\n")
+                input("Press to continue...")
+                return
+
+            table = PrettyTable(["No.", "Category", "Price", "Note"])
+            table.padding_width = 2
+            table.align["Price"] = "r"
+            table.align["Category"] = 'l'
+            table.align["Note"] = 'l'
+            for number, record in enumerate(records, start=1):
+                table.add_row([number, record['category'], format_amount(record['amount'], record['currency']),
+                               record['note']])
+            print(f"Expenses for {self.format_date(date)}")
+            print(table)
+
+            choice = input("\nEnter the number of the expense (type 'cancel' to cancel): ").strip().lower()
+            if choice == 'cancel':
+                return
+            try:
+                record = records[int(choice) - 1]
+                if int(choice) < 1:
+                    raise IndexError
+            except (ValueError, IndexError):
+                print("Invalid input! Enter a number from the table.")
+                input("Press to continue...")
+                continue
+
+            action = input("Enter 'e' to edit the amount or 'd' to delete the expense: ").strip().lower()
+            while action != 'e' and action != 'd':
+                print("You should enter only 'e' to edit or 'd' to delete the expense!")
+                action = input("Enter your choice: ").strip().lower()
+
+            if action == 'd':
+                self.delete_expense(record['id'])
+                print(f"{record['category']} expense of {format_amount(record['amount'], record['currency'])} "
+                      f"was deleted.")
+            else:
+                amount = self.enter_amount(record['currency'])
+                self.edit_expense(record['id'], amount=amount)
+                print(f"{record['category']} expense was changed to {format_amount(amount, record['currency'])}.")
+            input("Press to continue...")
+
+    @staticmethod
+    def enter_rule_date(prompt):
+        while True:
+            date_input = input(prompt).strip()
+            if date_input == "":
+                return None
+            try:
+                return parser.parse(date_input).date().strftime("%Y-%m-%d")
+            except ValueError:
+                print("Invalid date format! Please enter a date in format YYYY-MM-DD.\n")
+
+    def add_recurring(self):
+        """
+        Add a recurring expense, e.g. rent or a subscription.
+
+        Returns:
+            None
+
+        Method asks for the category, amount, frequency and dates of the rule.
+        Occurrences up to today are saved at once, later ones when they are due.
+        """
+        self.logo_table_expenses("recurring expense")
+        correct_input = False
+        while not correct_input:
+            exp_choice = input("Enter which expense repeats: ").lower().strip()
+            if exp_choice == 'cancel':
+                return
+            correct_input = self.check_command(exp_choice)
+        expense = correct_input
+        clear_screen()
+        print(f"You have selected {expense} expense.\n")
+        currency = self.enter_currency()
+        amount = self.enter_amount(currency)
+        frequency = input(f"Enter how often it repeats ({', '.join(FREQUENCIES)}): ").strip().lower()
+        while frequency not in FREQUENCIES:
+            print(f"You should enter one of: {', '.join(FREQUENCIES)}")
+            frequency = input("Enter your choice: ").strip().lower()
+        start = self.enter_rule_date("Enter the date of the first payment, press Enter for today: ") or str(TODAY)
+        end = self.enter_rule_date("Enter the last date of the payments (optional): ")
+        note = input("Enter a note for this expense (optional): ").strip()
+        try:
+            rule = self.recurring.add_rule(expense, amount, frequency, start, end, note, currency, TODAY)
+        except ValueError as error:
+            print(f"{error} Recurring expense wasn't saved!\n")
+        else:
+            print(f"Recurring expense saved: {rule.describe(self.storage.rates.base)}\n")
+        input("Press to continue...")
+
+    def manage_recurring(self):
+        """
+        List, add and remove recurring expenses.
+
+        Returns:
+            None
+        """
+        while True:
+            clear_screen()
+            rules = list(self.recurring.rules.values())
+            if rules:
+                table = PrettyTable(["No.", "Recurring expense"])
+                table.align["Recurring expense"] = 'l'
+                for number, rule in enumerate(rules, start=1):
+                    table.add_row([number, rule.describe(self.storage.rates.base)])
+                print(table)
+            else:
+                print("You have no recurring expenses.")
+
+            choice = input("\nEnter 'a' to add, the number of an expense to remove it, "
+                           "or 'cancel' to go back: ").strip().lower()
+            if choice == 'cancel':
+                return
+            if choice == 'a':
+                self.add_recurring()
+                continue
+            try:
+                rule = rules[int(choice) - 1]
+                if int(choice) < 1:
+                    raise IndexError
+            except (ValueError, IndexError):
+                print("Invalid input! Enter 'a' or a number from the table.")
+                input("Press to continue...")
+                continue
+            self.recurring.remove_rule(rule.rule_id)
+            print(f"Recurring expense removed: {rule.describe(self.storage.rates.base)}. "
+                  "Saved expenses are kept.")
+            input("Press to continue...")
+
     def set_limit(self, select_month_func):
         """
         Set a spending limit for a specific month.
@@ -393,24 +587,23 @@ class ExpenseManager:
 
         Method allows the user to set a spending limit for a specific month.
         """
-        # Load data from JSON file
-        with open(f"users/{self.user}.json", "r") as file:
-            data = json.load(file)
-
         clear_screen()
 
         # Get the current month
         selected_month = select_month_func("set a limit for")
+        month_name = month_name_from_key(selected_month)
 
         clear_screen()
 
+        current_limit = self.storage.get_limit(selected_month)
+
         while True:
             clear_screen()
 
-            if 'limit' in data['month'].get(selected_month, {}):
-                print(f"The limit for {selected_month} is ${data['month'][selected_month]['limit']}\n")
+            if current_limit is not None:
+                print(f"The limit for {month_name} is {format_amount(current_limit, self.storage.rates.base)}\n")
 
-            limit_input = input(f"Enter the new limit for {selected_month} (type 'cancel' to cancel): ")
+            limit_input = input(f"Enter the new limit for {month_name} (type 'cancel' to cancel): ")
 
             if limit_input.lower() == 'cancel':
                 print("Operation cancelled.")
@@ -424,27 +617,22 @@ class ExpenseManager:
                 input("Press to continue...")
                 continue  # Restart the loop to prompt the user again
 
-            # Add or update the limit for the selected month
-            data['month'].setdefault(selected_month, {})['limit'] = new_limit
-
-            # Check if there are expenses for the selected month
-            if 'expenses' not in data['month'][selected_month]:
-                data['month'][selected_month]['expenses'] = {}
-
-            # Write the updated data back to the JSON file
-            with open(f"users/{self.user}.json", "w") as file:
-                json.dump(data, file, indent=4)
+            # Add or update the limit for the selected month in the manifest
+            month_info = self.storage.set_limit(selected_month, new_limit)
+            self.budget_engine.check_month(self.storage, selected_month, month_info)
             break  # Exit the loop if input is valid
 
 
 class ExpensesReport:
 
-    def __init__(self, user):
+    def __init__(self, user, save_expense=None):
         """
         Initialize an ExpensesReport object.
 
         Parameters:
             user (str): The username associated with the report.
+            save_expense (callable, optional): Saves the due recurring expenses with the budget checks of
+                                               the user. Defaults to a budget-checked save of its own.
 
         Returns:
             None
@@ -452,6 +640,14 @@ class ExpensesReport:
         Method initializes an ExpensesReport object with a PrettyTable for displaying report commands.
         """
         self.user = user
+        self.storage = ShardedUserStorage(user)
+        self.currency = self.storage.rates.base
+        if save_expense is None:
+            budget_engine = BudgetEngine(handlers=[ExpenseManager.print_budget_event])
+            save_expense = functools.partial(save_with_budgets, self.storage, budget_engine,
+                                             CategoryBudgetTracker(self.storage, budget_engine))
+        self.recurring = RecurringScheduler(self.storage, save_expense)
+        self.cache = report_cache
         self.report_table = PrettyTable()
         self.report_table.field_names = ["Name of the command", "Command"]
         self.report_table.padding_width = 5
@@ -463,19 +659,40 @@ class ExpensesReport:
             ["Cancel report sending", 'e']
         ])
 
+    def select_currency(self):
+        """
+        Select the currency the reports are displayed in.
+
+        Returns:
+            None
+
+        An empty input or 'cancel' keeps the current currency.
+        """
+        clear_screen()
+        currencies = self.storage.rates.currencies
+        print(f"Reports are displayed in {self.currency}.\n")
+        while True:
+            currency = input(f"Enter the report currency ({', '.join(currencies)}), "
+                             f"press Enter or type 'cancel' to keep {self.currency}: ").strip().upper()
+            if currency in ("", "CANCEL"):
+                return
+            if currency in currencies:
+                self.currency = currency
+                return
+            print(f"There is no exchange rate for {currency}.\n")
+
     @staticmethod
     def select_another_month(message):
         clear_screen()
         while True:
-            user_input = input(f"Enter the month you want to {message} (e.g., 'May 2024'): ").strip()
+            user_input = input(f"Enter the month you want to {message} (e.g., 'May 2024' or '2024-05'): ").strip()
             try:
-                formatted_month = dt.datetime.strptime(user_input, "%B %Y").strftime("%B %Y")
-                return formatted_month
+                return parse_month_key(user_input)
             except ValueError:
                 clear_screen()
                 print(
                     "Invalid input! "
-                    "Please enter the month and year in the format 'Month Year' (e.g., 'May 2024')\n")
+                    "Please enter the month and year in the format 'Month Year' (e.g., 'May 2024') or 'YYYY-MM'\n")
 
     def select_month(self, message):
         """
@@ -485,14 +702,14 @@ class ExpensesReport:
             message (str): The message indicating the action to be performed.
 
         Returns:
-            str: The selected month in the format 'Month Year'.
+            str: The key of the selected month in the format 'YYYY-MM'.
 
         Method prompts the user to either select the current month or another month.
         """
 
-        current_month = dt.datetime.now().strftime("%B %Y")
+        current_month = dt.datetime.now().strftime("%Y-%m")
         change_month = input(
-            f"Do you want to {message} {current_month}? (y/n): ").lower().strip()
+            f"Do you want to {message} {month_name_from_key(current_month)}? (y/n): ").lower().strip()
         if change_month == 'y':
             return current_month
         elif change_month == 'n':
@@ -538,9 +755,13 @@ class ExpensesReport:
     @staticmethod
     def get_month_report_info(month_data):
         report_info = []
+        currency = month_data['currency']
+        categories = get_category_registry()
 
         total_amount = 0
-        num_expenses = len(month_data.get('expenses', {}))
+        # Subcategories are listed under their parent, whose total includes them
+        rows = categories.rollup(month_data.get('expenses', {}))
+        num_expenses = len(rows)
 
         if num_expenses >= 3:
             table = PrettyTable(["Category", "Price"])
@@ -552,31 +773,39 @@ class ExpensesReport:
             table.align["Price"] = "r"  # Right align Price column
             table.align["Category"] = 'l'  # Left align Category column
 
-            for expense, amount in month_data['expenses'].items():
-                table.add_row([expense, f"${amount:.2f}"])
-                total_amount += amount
+            for expense, amount, depth in rows:
+                table.add_row(["  " * depth + expense, format_amount(amount, currency)])
+                if depth == 0:
+                    total_amount += amount
 
             table.add_row(["-" * 30, "-" * 10])  # Adjust as needed
-            table.add_row(["Total", f"${total_amount:.2f}"])
+            table.add_row(["Total", format_amount(total_amount, currency)])
 
             report_info.append(table)
         else:
-            expenses_info = "\n".join([f"{expense}: ${amount:.2f}"
-                                       for expense, amount in month_data.get('expenses', {}).items()])
+            expenses_info = "\n".join([f"{'  ' * depth}{expense}: {format_amount(amount, currency)}"
+                                       for expense, amount, depth in rows])
             report_info.append("Expenses:\n" + expenses_info)
 
-            total_amount = sum(month_data.get('expenses', {}).values())
+            total_amount = month_data.get('total', sum(month_data.get('expenses', {}).values()))
             if num_expenses > 1:
-                report_info.append(f"Total: ${total_amount:.2f}")
+                report_info.append(f"Total: {format_amount(total_amount, currency)}")
 
         if 'limit' in month_data and isinstance(month_data['limit'], float):
             limit = month_data['limit']
-            report_info.append(f"Limit: ${limit:.2f}")
+            report_info.append(f"Limit: {format_amount(limit, currency)}")
             amount_available = limit - total_amount
-            report_info.append(f"Amount available: ${amount_available:.2f}")
+            report_info.append(f"Amount available: {format_amount(amount_available, currency)}")
         else:
             report_info.append("No limit set for this month.")
 
+        projected = month_data.get('projected')
+        if projected:
+            projected_info = "\n".join([f"{categories.decode(expense)}: {format_amount(amount, currency)}"
+                                         for expense, amount in projected.items()])
+            report_info.append("Upcoming recurring expenses:\n" + projected_info)
+            report_info.append(f"Projected total: {format_amount(total_amount + sum(projected.values()), currency)}")
+
         return "\n\n".join([str(table) for table in report_info])
 
     def short_month_data(self):
@@ -589,10 +818,6 @@ class ExpensesReport:
         Method displays short data for the selected month, including total amount spent and limit information.
         """
 
-        # Load data from JSON file
-        with open(f"users/{self.user}.json", "r") as file:
-            data = json.load(file)
-
         clear_screen()
 
         selected_month = self.select_month("get information about")
@@ -600,28 +825,32 @@ class ExpensesReport:
         clear_screen()
 
         # Extract data for the current month
-        selected_month_data = data['month'].get(selected_month)
+        selected_month_data = self.get_month_data(selected_month)
 
+        month_name = month_name_from_key(selected_month)
         if selected_month_data is None:
-            print(f"No data found for {selected_month}.\n")
+            print(f"No data found for {month_name}.\n")
             input("Press to continue...")
             return
 
         # Get the limit for the current month, if set
         limit = selected_month_data.get('limit')
 
-        # Calculate total amount spent
-        expenses_only = selected_month_data.get('expenses', {})
-        total_spent = sum(expenses_only.values())
+        # Running total of the month kept by the storage
+        total_spent = selected_month_data['total']
+        currency = selected_month_data['currency']
 
         # Print results
-        print(f"Total amount spent in {selected_month}: ${total_spent:.2f}")
+        print(f"Total amount spent in {month_name}: {format_amount(total_spent, currency)}")
         if limit and isinstance(limit, float):
-            print(f"Limit set for {selected_month}: ${limit:.2f}")
+            print(f"Limit set for {month_name}: {format_amount(limit, currency)}")
             amount_available = limit - total_spent
-            print(f"Amount available: ${amount_available:.2f}")
+            print(f"Amount available: {format_amount(amount_available, currency)}")
         else:
             print("No limit set for this month.")
+        projected = selected_month_data.get('projected')
+        if projected:
+            print(f"Upcoming recurring expenses: {format_amount(sum(projected.values()), currency)}")
 
         input("Press to continue...")
 
@@ -630,19 +859,83 @@ class ExpensesReport:
         Get data for the selected month.
 
         Parameters:
-            s_month (str): The selected month.
+            s_month (str): The key of the selected month in the format 'YYYY-MM'.
 
         Returns:
-            dict: Data for the selected month.
+            dict: Data for the selected month in the report currency.
+
+        Method retrieves data for the selected month from its month shard. Recurring
+        expenses due by today are saved first, later ones in the month are projected.
+        """
+        return self.cached_report('month_data', (s_month,),
+                                  lambda storage: self.add_projection(s_month, self.get_stored_month_data(s_month, storage)))
 
-        Method retrieves data for the selected month from the JSON file.
+    def cached_report(self, report, params, compute):
         """
-        # Load data from JSON file
-        with open(f"users/{self.user}.json", "r") as file:
-            data = json.load(file)
+        Get a report from the report cache, computing it when the data of the user changed.
+
+        Parameters:
+            report (str): The report type.
+            params (tuple): The parameters of the report.
+            compute (callable): Computes the report from the storage it is given.
+
+        Returns:
+            The report.
 
-        # Extract data for the selected month
-        return data['month'].get(s_month)
+        Reports also depend on the report currency, today's date and the recurring
+        expenses, which are part of the cache key. A report is computed from a
+        pinned snapshot, so concurrent writes never show up halfway through it.
+        """
+        # Due recurring expenses are saved first, so the generation read next includes them
+        self.recurring.materialize(TODAY)
+        params = params + (self.currency, str(TODAY), self.recurring.version)
+
+        def compute_pinned():
+            with self.storage.snapshot() as snapshot:
+                return compute(snapshot)
+
+        return self.cache.get_or_compute(self.storage.user_directory, report, params, self.storage.generation,
+                                         compute_pinned)
+
+    def add_projection(self, s_month, month_data):
+        first_day, last_day = month_days(s_month)
+        upcoming = self.recurring.project(first_day, last_day)
+        if not upcoming:
+            return month_data
+        currency = month_data['currency'] if month_data else self.currency
+        try:
+            projected = self.storage.rates.category_totals(upcoming, currency)
+        except ValueError:
+            return month_data
+        if month_data is None:
+            month_data = {'limit': None, 'total': 0, 'expenses': {}, 'currency': currency}
+        month_data['projected'] = projected
+        return month_data
+
+    def get_stored_month_data(self, s_month, storage=None):
+        storage = storage or self.storage
+        month_data = storage.get_month_data(s_month)
+        if month_data is None:
+            return None
+        month_data['currency'] = storage.rates.base
+        if self.currency == storage.rates.base:
+            return month_data
+
+        # The records are converted in bulk, once for every currency they were entered in
+        first_day, last_day = month_days(s_month)
+        first_day = dt.datetime.combine(first_day, dt.time())
+        last_day = dt.datetime.combine(min(last_day, TODAY), dt.time())
+        try:
+            expenses = storage.rates.category_totals(storage.get_records(first_day, last_day),
+                                                          self.currency)
+            limit = month_data.get('limit')
+            if isinstance(limit, float):
+                limit = storage.rates.convert_many([limit], [last_day.strftime("%Y-%m-%d")],
+                                                        storage.rates.base, self.currency)[0]
+        except ValueError as error:
+            print(f"{error} The report is shown in {storage.rates.base}.\n")
+            return month_data
+        return {'limit': limit, 'total': sum(expenses.values()), 'expenses': expenses, 'currency': self.currency}
 
     def display_month_data(self):
         """
@@ -660,28 +953,149 @@ class ExpensesReport:
         # Check if data exists for the selected month
         if month_data:
             clear_screen()
-            print(f"Month: {selected_month}")
+            print(f"Month: {month_name_from_key(selected_month)}")
 
-            report_info = self.get_month_report_info(month_data)
+            # The rendered report is reused until the data of the user changes
+            report_info = self.cached_report('month_report', (selected_month,),
+                                             lambda storage: self.get_month_report_info(month_data))
             print(report_info)
         else:
             clear_screen()
-            print(f"No data found for {selected_month}.\n")
+            print(f"No data found for {month_name_from_key(selected_month)}.\n")
 
         input("Press to continue...")
 
+    def months_overview(self, count=OVERVIEW_MONTHS):
+        """
+        Display the totals and limits of the last months.
+
+        Parameters:
+            count (int, optional): The number of calendar months, the current one included. Defaults to 6.
+
+        Returns:
+            None
+
+        Method reads the months from the month index of the manifest, no month shard is opened.
+        """
+        report = self.cached_report('months_overview', (count,),
+                                    lambda storage: self.render_months_overview(
+                                        storage.last_months(count, TODAY.strftime("%Y-%m")), storage.rates.base))
+        clear_screen()
+        print(report)
+        print()
+        input("Press to continue...")
+
     @staticmethod
-    def calculate_category_totals(data, start_date, end_date):
-        category_totals = {}
-        current_date = end_date
-        while current_date >= start_date:
-            current_date_str = current_date.strftime("%Y-%m-%d")
-            if current_date_str in data['date']:
-                expenses_for_date = data['date'][current_date_str]
-                for category, amount in expenses_for_date.items():
-                    category_totals[category] = category_totals.get(category, 0) + amount
-            current_date -= dt.timedelta(days=1)
-        return category_totals
+    def render_months_overview(months, currency):
+        if not months:
+            return "No expenses were recorded in these months."
+        table = PrettyTable(["Month", "Total", "Limit", "Available"])
+        table.align["Month"] = 'l'
+        for column in ("Total", "Limit", "Available"):
+            table.align[column] = 'r'
+        for key, month_info in reversed(months):
+            limit = month_info['limit']
+            has_limit = isinstance(limit, (int, float))
+            table.add_row([month_name_from_key(key), format_amount(month_info['total'], currency),
+                           format_amount(limit, currency) if has_limit else "-",
+                           format_amount(limit - month_info['total'], currency) if has_limit else "-"])
+        return f"Totals in {currency}\n{table}"
+
+    @staticmethod
+    def get_amount_bound(prompt):
+        while True:
+            amount_input = input(prompt).strip()
+            if amount_input == "":
+                return None
+            try:
+                return float(amount_input)
+            except ValueError:
+                print("You should enter a number! (e.g - 8.50)\n")
+
+    def search_report(self):
+        """
+        Search expenses by keywords, tags, amount and date range.
+
+        Returns:
+            None
+
+        Method prompts for the search criteria, every one of them is optional,
+        and displays the matching expenses.
+        """
+        clear_screen()
+        print("Leave a field empty to skip it.\n")
+        text = input("Enter keywords (e.g., 'dentist'): ").strip()
+        tags = input("Enter tags separated by commas: ").strip()
+        min_amount = self.get_amount_bound(f"Enter minimal amount ({self.storage.rates.base}): ")
+        max_amount = self.get_amount_bound(f"Enter maximal amount ({self.storage.rates.base}): ")
+        start_date = input("Enter start date (e.g., '2024-03-01'): ").strip()
+        end_date = input("Enter end date (e.g., '2024-03-31'): ").strip()
+
+        try:
+            start_date = parser.parse(start_date).date() if start_date else None
+            end_date = parser.parse(end_date).date() if end_date else None
+        except ValueError:
+            clear_screen()
+            print("Invalid date format!".upper())
+            input("Press to continue... ")
+            return
+
+        results = search_expenses(self.storage, text, tags, min_amount, max_amount, start_date, end_date)
+
+        clear_screen()
+        if not results:
+            print("No expenses found.\n")
+            input("Press to continue...")
+            return
+
+        table = PrettyTable(["Date", "Category", "Price", "Note", "Tags"])
+        table.padding_width = 2
+        table.align["Price"] = "r"
+        table.align["Category"] = 'l'
+        table.align["Note"] = 'l'
+        for result in results:
+            table.add_row([result['date'], result['category'], format_amount(result['amount'], result['currency']),
+                           result['note'], ", ".join(result['tags'])])
+        print(table)
+        print(f"\nFound {len(results)} expense(s).\n")
+        input("Press to continue...")
+
+    def get_range_data(self, start_date, end_date, storage=None):
+        """
+        Get the expenses of a range of dates in the report currency.
+
+        Parameters:
+            start_date (datetime): The first date of the range.
+            end_date (datetime): The last date of the range.
+            storage (ShardedUserStorage, optional): The storage or snapshot to read. Defaults to the user's storage.
+
+        Returns:
+            tuple: Expenses by date and category ID, totals by category ID and the currency used.
+        """
+        storage = storage or self.storage
+        base = storage.rates.base
+        if self.currency != base:
+            records = storage.get_records(start_date, end_date)
+            try:
+                amounts = storage.rates.convert_records(records, self.currency)
+            except ValueError as error:
+                print(f"{error} The report is shown in {base}.\n")
+                input("Press to continue...")
+            else:
+                categories = get_category_registry()
+                dates = {}
+                category_totals = {}
+                # Keyed by category ID, like the totals of the storage
+                for record, amount in zip(records, amounts):
+                    key = categories.key(record['category'])
+                    expenses_for_date = dates.setdefault(record['date'], {})
+                    expenses_for_date[key] = expenses_for_date.get(key, 0) + amount
+                    category_totals[key] = category_totals.get(key, 0) + amount
+                return dates, category_totals, self.currency
+
+        # Only the month shards overlapped by the range are read, and
+        # category totals come from the week, month, quarter and year rollups
+        return storage.get_dates(start_date, end_date), range_totals(storage, start_date, end_date), base
 
     def days_report(self):
         """
@@ -692,9 +1106,6 @@ class ExpensesReport:
 
         Method displays the days report, including expenses for each day and category totals.
         """
-        with open(f"users/{self.user}.json", "r") as file:
-            data = json.load(file)
-
         clear_screen()
 
         start_date = self.get_date_range("Enter start date for the expense report (e.g., '2024-04-01'): ")
@@ -711,44 +1122,72 @@ class ExpensesReport:
             input("Press to continue...")
             return
 
-        start_date = dt.datetime.strptime(start_date, "%Y-%m-%d")
-        end_date = dt.datetime.strptime(end_date, "%Y-%m-%d")
+        report = self.cached_report('days_report', (start_date, end_date),
+                                    lambda storage: self.render_days_report(dt.datetime.strptime(start_date, "%Y-%m-%d"),
+                                                                            dt.datetime.strptime(end_date, "%Y-%m-%d"),
+                                                                            storage))
 
-        category_totals = self.calculate_category_totals(data, start_date, end_date)
+        clear_screen()
+        print(report)
+        print()
+        input("Press to continue...")
+
+    def render_days_report(self, start_date, end_date, storage=None):
+        """
+        Render the days report.
+
+        Parameters:
+            start_date (datetime): The first date of the report.
+            end_date (datetime): The last date of the report.
+            storage (ShardedUserStorage, optional): The storage or snapshot to read. Defaults to the user's storage.
+
+        Returns:
+            str: The expenses for each day and the category totals.
+        """
+        dates, category_totals, currency = self.get_range_data(start_date, end_date, storage)
+        data = {'date': dates}
+        categories = get_category_registry()
 
         current_date = end_date
 
         start_date_str = start_date.strftime("%d %B %Y")
         end_date_str = end_date.strftime("%d %B %Y")
 
-        clear_screen()
-        print(f"Expenses report for time period from {start_date_str} to {end_date_str}")
+        lines = [f"Expenses report for time period from {start_date_str} to {end_date_str}"]
 
         while current_date >= start_date:
             current_date_str = current_date.strftime("%Y-%m-%d")
             if current_date_str in data['date']:
                 expenses_for_date = data['date'][current_date_str]
-                print()
-                print("----------------------------------------------------------------------------------")
-                print(f"{current_date.strftime('%d %B %Y')} expenses:")
+                lines.append("")
+                lines.append("----------------------------------------------------------------------------------")
+                lines.append(f"{current_date.strftime('%d %B %Y')} expenses:")
                 for category, amount in expenses_for_date.items():
-                    print(f"  {category}: ${amount:.2f}")
+                    lines.append(f"  {categories.decode(category)}: {format_amount(amount, currency)}")
             current_date -= dt.timedelta(days=1)
 
-        print("----------------------------------------------------------------------------------")
-        print("\nTotal expenses for each category:")
-        for category, total in category_totals.items():
-            print(f"  {category}: ${total:.2f}")
+        lines.append("----------------------------------------------------------------------------------")
+        lines.append("\nTotal expenses for each category:")
+        for category, total, depth in categories.rollup(category_totals):
+            lines.append(f"  {'  ' * depth}{category}: {format_amount(total, currency)}")
 
         total_all_expenses = sum(category_totals.values())
-        print(f"\nTotal for all expenses: ${total_all_expenses:.2f}")
+        lines.append(f"\nTotal for all expenses: {format_amount(total_all_expenses, currency)}")
+        return "\n".join(lines)
 
-        print()
-        input("Press to continue...")
 
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Track your expenses.")
+    arg_parser.add_argument('--user', default='default')
+    add_profile_arguments(arg_parser)
+    args = arg_parser.parse_args()
 
-# Create an instance without specifying a username
-expense_tracker = ExpenseTracker(user='default')
+    # Interactive operations are timed with the CPU clock, so waiting for the keyboard is left out
+    try:
+        expense_tracker = ExpenseTracker(user=args.user, profiler=profiler_from_args(args, cpu_time=True))
 
-# Run the expense tracker
-expense_tracker.run()
+        # Run the expense tracker
+        expense_tracker.run()
+    except SchemaError as error:
+        # Data of a newer version is left alone rather than read wrong or reset
+        sys.exit(str(error))
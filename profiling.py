@@ -0,0 +1,164 @@
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import argparse
+import importlib
+import contextlib
+import tracemalloc
+
+PROFILE_DIRECTORY = 'profiles'
+TOP_ENTRIES = 30
+ALL_OPERATIONS = 'all'
+
+
+class Profiler:
+    def __init__(self, operations=None, users=None, directory=PROFILE_DIRECTORY, cpu_time=False, limit=TOP_ENTRIES):
+        """
+        Initializes a new Profiler object.
+
+        Parameters:
+            operations (list, optional): The names of the operations to profile, 'all' for every one.
+                                         Nothing is profiled by default.
+            users (list, optional): Only profile operations of these users. Defaults to every user.
+            directory (str, optional): Where the reports go. Defaults to 'profiles'.
+            cpu_time (bool, optional): Time with the CPU clock, so time spent waiting for the
+                                       keyboard is left out. Defaults to the wall clock.
+            limit (int, optional): The number of hotspots and allocation sites reported. Defaults to 30.
+
+        Returns:
+            None
+
+        Operations which are not selected run without any profiling overhead.
+        """
+        self.operations = set(operations or [])
+        self.users = set(users or [])
+        self.directory = directory
+        self.cpu_time = cpu_time
+        self.limit = limit
+
+    def selected(self, operation, user=None):
+        if not self.operations:
+            return False
+        if self.users and user not in self.users:
+            return False
+        return ALL_OPERATIONS in self.operations or operation in self.operations
+
+    def report_path(self, operation, user, extension):
+        directory = os.path.join(self.directory, operation)
+        os.makedirs(directory, exist_ok=True)
+        name = time.strftime("%Y%m%d-%H%M%S") + (f"-{user}" if user else "")
+        return os.path.join(directory, f"{name}.{extension}")
+
+    @contextlib.contextmanager
+    def profile(self, operation, user=None):
+        """
+        Profile a block of code if its operation is selected.
+
+        Parameters:
+            operation (str): The name of the operation, e.g. 'display_month_data'.
+            user (str, optional): The user the operation runs for.
+
+        Returns:
+            context manager: Writes 'profiles/<operation>/<time>[-<user>].txt' with the hotspots
+                             and top allocations, and a '.prof' file for pstats or other viewers.
+        """
+        if not self.selected(operation, user):
+            yield None
+            return
+
+        # The elapsed time of the report is measured with the clock of the profile
+        clock = time.process_time if self.cpu_time else time.perf_counter
+        profiler = cProfile.Profile(clock) if self.cpu_time else cProfile.Profile()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        started = clock()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            elapsed = clock() - started
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            # The snapshots themselves are not part of the operation
+            own = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+            allocations = after.filter_traces(own).compare_to(before.filter_traces(own), 'lineno')
+            self.write_report(operation, user, profiler, allocations, elapsed, peak)
+
+    def write_report(self, operation, user, profiler, allocations, elapsed, peak):
+        stats_path = self.report_path(operation, user, 'prof')
+        profiler.dump_stats(stats_path)
+
+        hotspots = io.StringIO()
+        stats = pstats.Stats(profiler, stream=hotspots).strip_dirs()
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        stats.sort_stats('tottime').print_stats(self.limit)
+
+        lines = [f"Operation: {operation}" + (f", user: {user}" if user else ""),
+                 f"Elapsed: {elapsed * 1000:.1f} ms, peak traced memory: {peak / 1024:.1f} KiB",
+                 f"Clock: {'CPU' if self.cpu_time else 'wall'}", "",
+                 f"Top {self.limit} allocation sites (size and count of the blocks still allocated):"]
+        for allocation in allocations[:self.limit]:
+            lines.append(f"  {allocation}")
+        lines += ["", "Hotspots by cumulative and by own time:", hotspots.getvalue()]
+
+        report_path = stats_path[:-len('prof')] + 'txt'
+        with open(report_path, 'w') as report:
+            report.write("\n".join(lines))
+        print(f"Profile of {operation} written to {report_path}", file=sys.stderr)
+        return report_path
+
+
+def parse_selection(value):
+    # '--profile display_month_data,days_report' or '--profile all'
+    return [operation.strip() for operation in (value or '').split(',') if operation.strip()]
+
+
+def add_profile_arguments(arg_parser, default=None):
+    arg_parser.add_argument('--profile', nargs='?', const=default or ALL_OPERATIONS, default=None,
+                            metavar='OPERATIONS',
+                            help=f"profile these operations, comma separated (default: {default or ALL_OPERATIONS})")
+    arg_parser.add_argument('--profile-user', action='append', default=[],
+                            help="only profile operations of this user, may be repeated")
+    arg_parser.add_argument('--profile-dir', default=PROFILE_DIRECTORY)
+
+
+def profiler_from_args(args, cpu_time=False):
+    return Profiler(parse_selection(args.profile), args.profile_user, args.profile_dir, cpu_time)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Profile a headless command, e.g. 'python profiling.py --user alice stats -- --workers 1'. "
+                    "Options of the profiler go before the command. Work done in worker processes "
+                    "of the command is not included.")
+    arg_parser.add_argument('command', help="the module of the command, e.g. stats, export, backup")
+    arg_parser.add_argument('arguments', nargs=argparse.REMAINDER, help="the arguments of the command")
+    arg_parser.add_argument('--user', default=None, help="the user the command runs for, used in the report name")
+    arg_parser.add_argument('--profile-dir', default=PROFILE_DIRECTORY)
+    arg_parser.add_argument('--limit', type=int, default=TOP_ENTRIES)
+
+    args = arg_parser.parse_args()
+
+    arguments = args.arguments[1:] if args.arguments[:1] == ['--'] else args.arguments
+    module = importlib.import_module(args.command)
+    profiler = Profiler([args.command], directory=args.profile_dir, limit=args.limit)
+    sys.argv = [f"{args.command}.py"] + arguments
+    with profiler.profile(args.command, args.user):
+        try:
+            module.main()
+        except SystemExit as exit_error:
+            if exit_error.code not in (None, 0):
+                raise
+
+
+if __name__ == '__main__':
+    main()
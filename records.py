@@ -0,0 +1,69 @@
+from categories import get_category_registry
+
+RECORD_COLUMNS = ('day', 'category', 'amount', 'note', 'tags', 'deleted', 'currency', 'base')
+
+
+def record_id(key, position):
+    return f"{key}.{position}"
+
+
+def parse_record_id(expense_id):
+    key, position = expense_id.rsplit('.', 1)
+    return key, int(position)
+
+
+def empty_records():
+    return {column: [] for column in RECORD_COLUMNS}
+
+
+def append_record(records, day, category, amount, note, tags, currency, base_amount=None):
+    """
+    Append an expense record to the columns of a month shard.
+
+    Parameters:
+        records (dict): One list per column of 'RECORD_COLUMNS'.
+        day (int): The day of the month.
+        category (str): The expense category, stored as its ID.
+        amount (float): The amount spent.
+        note (str): A free-text note.
+        tags (list): Normalized tags.
+        currency (str): The currency of the amount.
+        base_amount (float, optional): The amount in the base currency. Defaults to 'amount'.
+
+    Returns:
+        int: The position of the record, which is also the last part of its ID.
+    """
+    records['day'].append(day)
+    records['category'].append(get_category_registry().encode(category))
+    records['amount'].append(amount)
+    records['note'].append(note)
+    records['tags'].append(tags)
+    records['deleted'].append(0)
+    records['currency'].append(currency)
+    records['base'].append(amount if base_amount is None else base_amount)
+    return len(records['day']) - 1
+
+
+def upgrade_columns(records, base):
+    # Records saved before currencies existed were all in the base currency
+    count = len(records['day'])
+    if 'currency' not in records:
+        records['currency'] = [base] * count
+    if 'base' not in records:
+        records['base'] = list(records['amount'])
+
+
+def read_record(shard, key, position):
+    records = shard['records']
+    if position < 0 or position >= len(records['day']) or records['deleted'][position]:
+        return None
+    return {
+        'id': record_id(key, position),
+        'date': f"{key}-{records['day'][position]:02d}",
+        'category': get_category_registry().decode(records['category'][position]),
+        'amount': records['amount'][position],
+        'note': records['note'][position],
+        'tags': records['tags'][position],
+        'currency': records['currency'][position],
+        'base': records['base'][position]
+    }
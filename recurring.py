@@ -0,0 +1,300 @@
+import os
+import argparse
+import calendar
+import datetime as dt
+import functools
+
+from storage import USERS_DIRECTORY, ShardedUserStorage, sharded_users
+from currency import format_amount
+from budget import BudgetEngine, CategoryBudgetTracker, save_with_budgets, describe_event
+
+RECURRING_FILE = 'recurring.json'
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+RECURRING_TAG = 'recurring'
+
+
+def add_months(date_obj, months, day):
+    # The same day of a later month, the last day of the month when it is shorter
+    month_index = date_obj.month - 1 + months
+    year = date_obj.year + month_index // 12
+    month = month_index % 12 + 1
+    return dt.date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+class RecurringRule:
+    def __init__(self, rule_id, category, amount, frequency, start, end=None, note='', currency=None):
+        """
+        Initializes a new RecurringRule object.
+
+        Parameters:
+            rule_id (int): The ID of the rule, unique for the user.
+            category (str): The expense category.
+            amount (float): The amount of every occurrence.
+            frequency (str): 'daily', 'weekly' or 'monthly'.
+            start (str): The date of the first occurrence in the format 'YYYY-MM-DD'.
+            end (str, optional): The last possible date of an occurrence.
+            note (str, optional): The note of every occurrence.
+            currency (str, optional): The currency of the amount. Defaults to the base currency.
+
+        Returns:
+            None
+
+        A monthly rule starting on the 31st falls on the last day of shorter months.
+        """
+        if frequency not in FREQUENCIES:
+            raise ValueError(f"Unknown frequency {frequency!r}, use one of {', '.join(FREQUENCIES)}.")
+        self.rule_id = rule_id
+        self.category = category
+        self.amount = amount
+        self.frequency = frequency
+        self.start = start
+        self.end = end
+        self.note = note
+        self.currency = currency
+
+    def occurrences(self, start_date, end_date):
+        """
+        Get the dates of the occurrences in a range.
+
+        Parameters:
+            start_date (date): The first date of the range.
+            end_date (date): The last date of the range.
+
+        Returns:
+            list: Dates in the format 'YYYY-MM-DD'.
+        """
+        first = dt.date.fromisoformat(self.start)
+        if self.end:
+            end_date = min(end_date, dt.date.fromisoformat(self.end))
+        start_date = max(start_date, first)
+        if start_date > end_date:
+            return []
+
+        if self.frequency == 'daily':
+            current = start_date
+            step = dt.timedelta(days=1)
+        elif self.frequency == 'weekly':
+            current = start_date + dt.timedelta(days=(first.weekday() - start_date.weekday()) % 7)
+            step = dt.timedelta(days=7)
+        else:
+            months = (start_date.year - first.year) * 12 + start_date.month - first.month
+            current = add_months(first, months, first.day)
+            if current < start_date:
+                months += 1
+                current = add_months(first, months, first.day)
+            step = None
+
+        dates = []
+        while current <= end_date:
+            dates.append(current.isoformat())
+            if step is not None:
+                current += step
+            else:
+                months += 1
+                current = add_months(first, months, first.day)
+        return dates
+
+    def describe(self, base):
+        until = f" until {self.end}" if self.end else ""
+        return (f"{self.category}, {format_amount(self.amount, self.currency or base)} "
+                f"{self.frequency} from {self.start}{until}")
+
+    def to_dict(self):
+        return {'id': self.rule_id, 'category': self.category, 'amount': self.amount, 'frequency': self.frequency,
+                'start': self.start, 'end': self.end, 'note': self.note, 'currency': self.currency}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['category'], data['amount'], data['frequency'], data['start'],
+                   data.get('end'), data.get('note', ''), data.get('currency'))
+
+
+class RecurringScheduler:
+    def __init__(self, storage, save_expense=None):
+        """
+        Initializes a new RecurringScheduler object.
+
+        Parameters:
+            storage (ShardedUserStorage): The storage of the user.
+            save_expense (callable, optional): Saves one occurrence with (expense, amount, date, note,
+                                               tags, currency). Defaults to 'storage.save_expense'.
+
+        Returns:
+            None
+
+        Rules are stored in 'users/<user>/recurring.json' with a watermark, the
+        last date whose occurrences are all saved, and a revision counted up by
+        every change. Occurrences are saved lazily
+        up to the requested date, never in the future, and every one only once.
+        """
+        self.storage = storage
+        self.save_expense = save_expense or storage.save_expense
+        self.recurring_file = os.path.join(storage.user_directory, RECURRING_FILE)
+        self.rules = {}
+        self.watermark = None
+        self.done = []
+        self.revision = 0
+        self.load()
+
+    def load(self):
+        data = self.storage.read_json(self.recurring_file, {})
+        if not isinstance(data, dict):
+            data = {}
+        self.rules = {}
+        for rule_data in data.get('rules', []):
+            rule = RecurringRule.from_dict(rule_data)
+            self.rules[rule.rule_id] = rule
+        self.watermark = data.get('watermark')
+        # Rules already saved for the date after the watermark when a run was interrupted
+        self.done = data.get('done', [])
+        self.revision = data.get('revision', 0)
+
+    @property
+    def version(self):
+        # Changes whenever rules are added or removed or occurrences are saved. Rule IDs are reused
+        # once the newest rule is removed, so they can't tell a replaced rule from the old one.
+        return self.revision
+
+    def save(self):
+        self.storage.ensure_directory()
+        self.revision += 1
+        self.storage.write_json(self.recurring_file, {
+            'rules': [rule.to_dict() for rule in self.rules.values()],
+            'watermark': self.watermark,
+            'done': self.done,
+            'revision': self.revision
+        })
+
+    def add_rule(self, category, amount, frequency, start, end=None, note='', currency=None, today=None):
+        """
+        Add a recurring expense.
+
+        Parameters:
+            category (str): The expense category.
+            amount (float): The amount of every occurrence.
+            frequency (str): 'daily', 'weekly' or 'monthly'.
+            start (str): The date of the first occurrence in the format 'YYYY-MM-DD'.
+            end (str, optional): The last possible date of an occurrence.
+            note (str, optional): The note of every occurrence.
+            currency (str, optional): The currency of the amount.
+            today (date, optional): The current date. Defaults to today.
+
+        Returns:
+            RecurringRule: The new rule.
+
+        Occurrences of the new rule up to today are saved at once.
+        """
+        today = today or dt.date.today()
+        with self.storage.exclusive():
+            self.load()
+            rule = RecurringRule(max(self.rules, default=0) + 1, category, amount, frequency, start, end, note,
+                                 currency)
+            if self.watermark is not None:
+                # Older rules are already saved up to the watermark, the new one catches up alone
+                for date in rule.occurrences(dt.date.min, dt.date.fromisoformat(self.watermark)):
+                    self.save_occurrence(rule, date)
+            self.rules[rule.rule_id] = rule
+            self.save()
+            self.materialize(today)
+        return rule
+
+    def remove_rule(self, rule_id):
+        # Occurrences which are already saved stay, like any other expense
+        with self.storage.exclusive():
+            self.load()
+            if self.rules.pop(rule_id, None) is None:
+                return False
+            self.save()
+        return True
+
+    def save_occurrence(self, rule, date):
+        self.save_expense(rule.category, rule.amount, date, rule.note, [RECURRING_TAG], rule.currency)
+
+    def materialize(self, through_date):
+        """
+        Save the occurrences of every rule up to a date.
+
+        Parameters:
+            through_date (date): The last date to save, later dates are never saved.
+
+        Returns:
+            int: The number of saved occurrences.
+
+        The watermark moves forward after every date, and the rules done for
+        the current date are remembered, so an interrupted run never saves an
+        occurrence twice. The whole run holds the lock of the user, so a run of
+        another process, e.g. the cron job, waits and then starts from the
+        watermark this one left.
+        """
+        through_date = min(through_date, dt.date.today())
+        with self.storage.exclusive():
+            # Another scheduler of the user may have saved occurrences or changed the rules since
+            self.load()
+            if not self.rules:
+                return 0
+            if self.watermark is None:
+                start_date = min(dt.date.fromisoformat(rule.start) for rule in self.rules.values())
+            else:
+                start_date = dt.date.fromisoformat(self.watermark) + dt.timedelta(days=1)
+            if start_date > through_date:
+                return 0
+
+            due = {}
+            for rule in self.rules.values():
+                for date in rule.occurrences(start_date, through_date):
+                    due.setdefault(date, []).append(rule)
+
+            saved = 0
+            for date in sorted(due):
+                for rule in due[date]:
+                    if rule.rule_id in self.done:
+                        continue
+                    self.save_occurrence(rule, date)
+                    self.done.append(rule.rule_id)
+                    self.save()
+                    saved += 1
+                self.watermark = date
+                self.done = []
+            self.watermark = through_date.isoformat()
+            self.save()
+            return saved
+
+    def project(self, start_date, end_date):
+        """
+        Get the occurrences of a range which are not saved yet.
+
+        Parameters:
+            start_date (date): The first date of the range.
+            end_date (date): The last date of the range.
+
+        Returns:
+            list: Records with 'date', 'category', 'amount', 'currency' and 'rule', nothing is written.
+        """
+        self.load()
+        if self.watermark is not None:
+            start_date = max(start_date, dt.date.fromisoformat(self.watermark) + dt.timedelta(days=1))
+        return [{'date': date, 'category': rule.category, 'amount': rule.amount,
+                 'currency': rule.currency or self.storage.rates.base, 'rule': rule.rule_id}
+                for rule in self.rules.values() for date in rule.occurrences(start_date, end_date)]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Save the due recurring expenses of every user.")
+    arg_parser.add_argument('users', nargs='*', help="users to update (all users by default)")
+    arg_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+
+    args = arg_parser.parse_args()
+
+    today = dt.date.today()
+    # Saved occurrences count against the limits and budgets like any other expense
+    engine = BudgetEngine(handlers=[lambda event: print(f"{event.user}: {describe_event(event)}")])
+    for user in args.users or sharded_users(args.users_dir):
+        storage = ShardedUserStorage(user, args.users_dir)
+        save_expense = functools.partial(save_with_budgets, storage, engine, CategoryBudgetTracker(storage, engine))
+        saved = RecurringScheduler(storage, save_expense).materialize(today)
+        if saved:
+            print(f"Saved {saved} recurring expense(s) of {user}.")
+
+
+if __name__ == '__main__':
+    main()
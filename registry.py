@@ -0,0 +1,149 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+REGISTRY_FILE = 'registry.sqlite'
+MANIFEST_NAME = 'manifest.json'
+FAN_OUT_LEVELS = 2
+
+
+def hashed_directory(user):
+    """
+    Get the fan-out directory of a user, relative to the users directory.
+
+    Parameters:
+        user (str): The username.
+
+    Returns:
+        str: E.g. '3f/a2/alice', so no directory holds more than 256 entries
+             before the user level.
+    """
+    digest = hashlib.sha1(user.encode('utf-8')).hexdigest()
+    return os.path.join(*[digest[level * 2:level * 2 + 2] for level in range(FAN_OUT_LEVELS)], user)
+
+
+class UserRegistry:
+    def __init__(self, users_directory):
+        """
+        Initializes a new UserRegistry object.
+
+        Parameters:
+            users_directory (str): The root directory of user data.
+
+        Returns:
+            None
+
+        Users and their directories are kept in 'users/registry.sqlite', so a
+        user is found with one primary key lookup and batch jobs list users
+        without listing directories. Users created before the registry keep
+        their flat 'users/<user>/' directory and are registered on first use
+        of the registry.
+        """
+        self.users_directory = users_directory
+        self.path = os.path.join(users_directory, REGISTRY_FILE)
+        self.lock = threading.Lock()
+        self.directories = {}
+        os.makedirs(users_directory, exist_ok=True)
+        new = not os.path.exists(self.path)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS users ("
+                                "name TEXT PRIMARY KEY, directory TEXT NOT NULL, created REAL NOT NULL)")
+        self.connection.commit()
+        if new:
+            self.register_many((name, name) for name in self.flat_users())
+
+    def flat_users(self):
+        # Users with a 'users/<user>/manifest.json' written before the registry existed
+        with os.scandir(self.users_directory) as entries:
+            for entry in entries:
+                if entry.is_dir() and os.path.isfile(os.path.join(entry.path, MANIFEST_NAME)):
+                    yield entry.name
+
+    def register_many(self, users):
+        """
+        Register users with their directories.
+
+        Parameters:
+            users (iterable): Pairs (user, directory relative to the users directory).
+
+        Returns:
+            None
+
+        Users which are already registered keep their directory.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.executemany("INSERT OR IGNORE INTO users (name, directory, created) VALUES (?, ?, ?)",
+                                        ((user, directory, now) for user, directory in users))
+            self.connection.commit()
+
+    def register(self, user, directory):
+        self.register_many([(user, os.path.relpath(directory, self.users_directory))])
+        with self.lock:
+            self.directories.pop(user, None)
+
+    def lookup(self, user):
+        """
+        Get the registered directory of a user.
+
+        Parameters:
+            user (str): The username.
+
+        Returns:
+            str: The directory, or None if the user is not registered.
+        """
+        with self.lock:
+            if user not in self.directories:
+                row = self.connection.execute("SELECT directory FROM users WHERE name = ?", (user,)).fetchone()
+                if row is None:
+                    return None
+                self.directories[user] = os.path.join(self.users_directory, row[0])
+            return self.directories[user]
+
+    def user_directory(self, user):
+        # New users get the fan-out layout
+        return self.lookup(user) or os.path.join(self.users_directory, hashed_directory(user))
+
+    def users(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT name FROM users ORDER BY name")]
+
+    def rebuild(self):
+        """
+        Register every user directory found on disk.
+
+        Returns:
+            int: The number of users found.
+
+        Walks the whole tree, for a registry restored from an older backup or lost.
+        """
+        found = []
+        for directory, subdirectories, names in os.walk(self.users_directory):
+            # Pinned versions of a user hold manifests too
+            subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+            if MANIFEST_NAME in names and directory != self.users_directory:
+                found.append((os.path.basename(directory), os.path.relpath(directory, self.users_directory)))
+                subdirectories.clear()
+        self.register_many(found)
+        with self.lock:
+            self.directories.clear()
+        return len(found)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+registries = {}
+registries_lock = threading.Lock()
+
+
+def get_registry(users_directory):
+    # The registry of a users directory is opened once per process, a forked worker opens its own
+    path = (os.path.abspath(users_directory), os.getpid())
+    with registries_lock:
+        if path not in registries:
+            registries[path] = UserRegistry(users_directory)
+        return registries[path]
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from console import ScriptedConsole, use_console
+
+FLOWS = ('run', 'add_expenses', 'days_report')
+PERCENTILES = (50, 90, 99)
+
+
+def load_script(path):
+    """
+    Load a recorded session.
+
+    Parameters:
+        path (str): A JSON file with 'user', 'flow' (one of 'FLOWS'), 'keystrokes' and,
+                    for 'add_expenses', an optional 'date'.
+
+    Returns:
+        dict: The script, with its file name as 'name'.
+
+    Raises:
+        ValueError: If the flow is unknown or there are no keystrokes.
+    """
+    with open(path, 'r') as json_file:
+        script = json.load(json_file)
+    script.setdefault('name', os.path.basename(path))
+    script.setdefault('flow', 'run')
+    if script['flow'] not in FLOWS:
+        raise ValueError(f"Unknown flow {script['flow']!r} in {path}, use one of {', '.join(FLOWS)}.")
+    if not isinstance(script.get('keystrokes'), list):
+        raise ValueError(f"{path} has no 'keystrokes' list.")
+    return script
+
+
+def start_flow(script):
+    # main is imported here, so only the replaying process needs its dependencies
+    import main
+
+    user = script.get('user', 'default')
+    if script['flow'] == 'run':
+        return main.ExpenseTracker(user).run()
+    if script['flow'] == 'add_expenses':
+        return main.ExpenseManager(user).add_expenses(script.get('date', ''))
+    return main.ExpensesReport(user).days_report()
+
+
+def replay_session(script, workdir=None):
+    """
+    Replay one recorded session and time every step.
+
+    Parameters:
+        script (dict): The script, see 'load_script'.
+        workdir (str, optional): The directory holding 'users/', e.g. a copy of production data.
+
+    Returns:
+        dict: 'name', 'user', 'flow', 'steps' (prompt, input, seconds and characters rendered),
+              'seconds', 'completed', 'keystrokes_left', 'error' and 'transcript'.
+
+    A session is completed when the flow returns by itself. A script that runs
+    out of keystrokes earlier ends like a closed terminal.
+    """
+    if workdir:
+        os.chdir(workdir)
+    console = ScriptedConsole(script['keystrokes'])
+    completed = False
+    error = None
+    started = time.perf_counter()
+    with use_console(console):
+        try:
+            start_flow(script)
+            completed = True
+        except EOFError:
+            pass
+        except Exception as exception:
+            error = f"{type(exception).__name__}: {exception}"
+    return {
+        'name': script['name'],
+        'user': script.get('user', 'default'),
+        'flow': script['flow'],
+        'steps': console.steps,
+        'seconds': time.perf_counter() - started,
+        'completed': completed,
+        'keystrokes_left': len(console.keystrokes) - console.position,
+        'error': error,
+        'transcript': console.transcript
+    }
+
+
+def replay_sessions(scripts, workers=None, workdir=None):
+    """
+    Replay sessions in parallel.
+
+    Parameters:
+        scripts (list): Scripts, see 'load_script'.
+        workers (int, optional): The number of worker processes. Defaults to the number of cores.
+        workdir (str, optional): The directory holding 'users/'.
+
+    Returns:
+        list: The results of 'replay_session', in the order of the scripts.
+
+    Every session runs in its own process, because a replayed session owns
+    'sys.stdin' and 'sys.stdout' of its process.
+    """
+    if not scripts:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(replay_session, scripts, [workdir] * len(scripts)))
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summarize(results):
+    """
+    Summarize the step latencies of replayed sessions.
+
+    Parameters:
+        results (list): The results of 'replay_session'.
+
+    Returns:
+        dict: 'sessions', 'completed', 'failed', 'steps', the latency percentiles of all steps in
+              seconds and the slowest prompts with their worst latency.
+    """
+    seconds = [step['seconds'] for result in results for step in result['steps'] if step['seconds'] is not None]
+    slowest = {}
+    for result in results:
+        for step in result['steps']:
+            if step['seconds'] is not None and step['seconds'] > slowest.get(step['prompt'], -1):
+                slowest[step['prompt']] = step['seconds']
+    return dict({
+        'sessions': len(results),
+        'completed': sum(1 for result in results if result['completed']),
+        'failed': [f"{result['name']}: {result['error']}" for result in results if result['error']],
+        'steps': len(seconds),
+        'slowest_prompts': sorted(slowest.items(), key=lambda item: item[1], reverse=True)[:5]
+    }, **{f'p{percent}': percentile(seconds, percent) for percent in PERCENTILES})
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Replay recorded sessions and measure the UI latency.")
+    arg_parser.add_argument('scripts', nargs='+', help="session scripts (JSON)")
+    arg_parser.add_argument('--repeat', type=int, default=1, help="replay every script this many times")
+    arg_parser.add_argument('--workers', type=int, default=None, help="worker processes (all cores by default)")
+    arg_parser.add_argument('--workdir', default=None, help="directory holding 'users/' (current by default)")
+    arg_parser.add_argument('--transcripts', default=None, help="directory to write the session output to")
+    arg_parser.add_argument('--json', action='store_true', help="print the results as JSON")
+
+    args = arg_parser.parse_args()
+
+    scripts = [load_script(path) for path in args.scripts] * args.repeat
+    workdir = os.path.abspath(args.workdir) if args.workdir else None
+    results = replay_sessions(scripts, args.workers, workdir)
+
+    if args.transcripts:
+        os.makedirs(args.transcripts, exist_ok=True)
+        for number, result in enumerate(results):
+            with open(os.path.join(args.transcripts, f"{number:04d}-{result['name']}.txt"), 'w') as transcript:
+                transcript.write(result['transcript'])
+
+    summary = summarize(results)
+    if args.json:
+        for result in results:
+            result.pop('transcript')
+        print(json.dumps({'summary': summary, 'sessions': results}, indent=4))
+        return
+
+    for result in results:
+        status = "completed" if result['completed'] else result['error'] or "ran out of keystrokes"
+        print(f"{result['name']} ({result['flow']}, {result['user']}): {len(result['steps'])} steps "
+              f"in {result['seconds'] * 1000:.1f} ms, {status}")
+    if summary['p50'] is not None:
+        print("\nStep latency (p50 / p90 / p99): "
+              + " / ".join(f"{summary[f'p{percent}'] * 1000:.1f} ms" for percent in PERCENTILES))
+        print("Slowest prompts:")
+        for prompt, seconds in summary['slowest_prompts']:
+            print(f"  {seconds * 1000:.1f} ms  {prompt or '(no prompt)'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+
+REPORT_CACHE_SIZE = 256
+
+
+class ReportCache:
+    def __init__(self, max_entries=REPORT_CACHE_SIZE):
+        """
+        Initializes a new ReportCache object.
+
+        Parameters:
+            max_entries (int, optional): The number of reports kept. Defaults to 256.
+
+        Returns:
+            None
+
+        A report is stored under (user directory, report type, parameters)
+        together with the data generation it was computed at. The directory
+        tells apart users of the same name in different users directories. A
+        report is reused while the generation of the user stays the same, a
+        lookup at a newer generation is a miss and replaces it. The least recently used report is evicted
+        when the cache is full.
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(user_directory, report, params):
+        # The working directory may change between lookups, e.g. in tests
+        return os.path.abspath(user_directory), report, params
+
+    def get(self, user_directory, report, params, generation):
+        key = self.key(user_directory, report, params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_directory, report, params, generation, value):
+        key = self.key(user_directory, report, params)
+        with self.lock:
+            self.entries[key] = (generation, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, user_directory, report, params, generation, compute):
+        """
+        Get a report, computing it if the cached one is missing or out of date.
+
+        Parameters:
+            user_directory (str): The directory of the user, e.g. 'storage.user_directory'.
+            report (str): The report type, e.g. 'month_data'.
+            params (tuple): Hashable parameters of the report.
+            generation (int): The current data generation of the user.
+            compute (callable): Computes the report, called without arguments.
+
+        Returns:
+            The report. None is a valid result and is cached too.
+        """
+        key = self.key(user_directory, report, params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = compute()
+        self.put(user_directory, report, params, generation, value)
+        return value
+
+    def invalidate(self, user_directory):
+        user_directory = os.path.abspath(user_directory)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == user_directory]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+# The cache every report of the process shares
+report_cache = ReportCache()
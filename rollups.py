@@ -0,0 +1,198 @@
+import datetime as dt
+
+GRANULARITIES = ('week', 'quarter', 'year')
+
+
+def week_key(date_obj):
+    iso_year, iso_week, _ = date_obj.isocalendar()
+    return f"{iso_year:04d}-W{iso_week:02d}"
+
+
+def quarter_key(date_obj):
+    return f"{date_obj.year:04d}-Q{(date_obj.month - 1) // 3 + 1}"
+
+
+def year_key(date_obj):
+    return f"{date_obj.year:04d}"
+
+
+def rollup_keys(date_obj):
+    return {'week': week_key(date_obj), 'quarter': quarter_key(date_obj), 'year': year_key(date_obj)}
+
+
+def empty_rollups():
+    return {granularity: {} for granularity in GRANULARITIES}
+
+
+def add_total(totals, category, amount):
+    """
+    Add an amount to the total of a category, dropping totals that fall to zero.
+
+    Parameters:
+        totals (dict): Totals by category.
+        category (str): The category.
+        amount (float): The amount, negative to take an expense back out.
+
+    Returns:
+        None
+    """
+    total = totals.get(category, 0) + amount
+    if abs(total) < 1e-9:
+        totals.pop(category, None)
+    else:
+        totals[category] = total
+
+
+def add_expense(rollups, expense, amount, date):
+    """
+    Add an expense to the week, quarter and year rollups of its date.
+
+    Parameters:
+        rollups (dict): Category totals by granularity and period key.
+        expense (str): The expense category.
+        amount (float): The amount spent, negative to take the expense back out.
+        date (str): The date of the expense in the format 'YYYY-MM-DD'.
+
+    Returns:
+        None
+    """
+    for granularity, key in rollup_keys(dt.date.fromisoformat(date)).items():
+        totals = rollups.setdefault(granularity, {}).setdefault(key, {})
+        add_total(totals, expense, amount)
+        if not totals:
+            del rollups[granularity][key]
+
+
+def rollup_year(period):
+    # Rollups are kept in one file per year, a period belongs to the year its key starts with
+    return period[:4]
+
+
+def split_rollups(rollups):
+    """
+    Split rollups into the rollups of every year.
+
+    Parameters:
+        rollups (dict): Category totals by granularity and period key.
+
+    Returns:
+        dict: Rollups by year, like 'rollups-<year>.json' holds them.
+    """
+    years = {}
+    for granularity, periods in rollups.items():
+        for period, totals in periods.items():
+            year = years.setdefault(rollup_year(period), empty_rollups())
+            year[granularity][period] = totals
+    return years
+
+
+def build_rollups(dates):
+    """
+    Build the rollups from daily data.
+
+    Parameters:
+        dates (dict): Expenses by date in the format 'YYYY-MM-DD'.
+
+    Returns:
+        dict: Category totals by granularity and period key.
+    """
+    rollups = empty_rollups()
+    for date, expenses_for_date in dates.items():
+        for expense, amount in expenses_for_date.items():
+            add_expense(rollups, expense, amount, date)
+    return rollups
+
+
+def next_month_start(date_obj):
+    if date_obj.month == 12:
+        return dt.date(date_obj.year + 1, 1, 1)
+    return dt.date(date_obj.year, date_obj.month + 1, 1)
+
+
+def quarter_end(date_obj):
+    last_month = ((date_obj.month - 1) // 3 + 1) * 3
+    return next_month_start(dt.date(date_obj.year, last_month, 1)) - dt.timedelta(days=1)
+
+
+def cover_range(start_date, end_date):
+    """
+    Split a range of dates into the largest materialized periods.
+
+    Parameters:
+        start_date (date): The first date of the range.
+        end_date (date): The last date of the range.
+
+    Returns:
+        list: Tuples (granularity, key), where granularity is 'year', 'quarter',
+              'month', 'week' or 'day'. Month keys are 'YYYY-MM', day keys 'YYYY-MM-DD'.
+
+    Whole years, quarters and months are taken at month starts. Between them
+    whole ISO weeks that stay inside one month are used, and the rest are
+    single days, so any range needs only a few dozen pieces.
+    """
+    pieces = []
+    cursor = start_date
+    while cursor <= end_date:
+        month_end = next_month_start(cursor) - dt.timedelta(days=1)
+        if cursor.day == 1 and month_end <= end_date:
+            year_end = dt.date(cursor.year, 12, 31)
+            if cursor.month == 1 and year_end <= end_date:
+                pieces.append(('year', year_key(cursor)))
+                cursor = year_end
+            elif cursor.month % 3 == 1 and quarter_end(cursor) <= end_date:
+                pieces.append(('quarter', quarter_key(cursor)))
+                cursor = quarter_end(cursor)
+            else:
+                pieces.append(('month', cursor.strftime("%Y-%m")))
+                cursor = month_end
+        elif cursor.weekday() == 0 and cursor + dt.timedelta(days=6) <= min(end_date, month_end):
+            pieces.append(('week', week_key(cursor)))
+            cursor += dt.timedelta(days=6)
+        else:
+            pieces.append(('day', cursor.isoformat()))
+        cursor += dt.timedelta(days=1)
+    return pieces
+
+
+def range_totals(storage, start_date, end_date):
+    """
+    Get category totals of a range of dates from the materialized rollups.
+
+    Parameters:
+        storage (ShardedUserStorage): The storage of the user.
+        start_date (date): The first date of the range.
+        end_date (date): The last date of the range.
+
+    Returns:
+        dict: Totals by category ID of every date in the range, both ends included.
+
+    Weeks only count when they fit inside one month, so a week rollup never
+    holds days of a neighbouring month. Only the shards of the partial days
+    at the ends of the range are opened.
+    """
+    if isinstance(start_date, dt.datetime):
+        start_date = start_date.date()
+    if isinstance(end_date, dt.datetime):
+        end_date = end_date.date()
+
+    manifest = storage.load_manifest()
+    pieces = cover_range(start_date, end_date)
+    rollups = storage.load_rollups({rollup_year(key) for granularity, key in pieces if granularity in GRANULARITIES})
+    shards = {}
+    category_totals = {}
+
+    for granularity, key in pieces:
+        if granularity == 'day':
+            month = key[:7]
+            if month not in manifest['months']:
+                continue
+            if month not in shards:
+                shards[month] = storage.load_shard(month)['date']
+            totals = shards[month].get(key, {})
+        elif granularity == 'month':
+            totals = manifest['months'].get(key, {}).get('categories', {})
+        else:
+            totals = rollups[rollup_year(key)].get(granularity, {}).get(key, {})
+        for category, amount in totals.items():
+            category_totals[category] = category_totals.get(category, 0) + amount
+    return category_totals
@@ -0,0 +1,69 @@
+SCHEMA_VERSION = 'schema_version'
+
+# Migrations by file kind and by the version they upgrade to
+MIGRATIONS = {}
+
+
+class SchemaError(Exception):
+    pass
+
+
+def migration(kind, version):
+    """
+    Register the migration which upgrades a file of a kind to a version.
+
+    Parameters:
+        kind (str): The kind of file, e.g. 'manifest' or 'shard'.
+        version (int): The version the migration upgrades to, from the version before it.
+
+    Returns:
+        function: A decorator for a function which upgrades the loaded file in place,
+            called with the file and the context passed to 'upgrade'.
+    """
+    def register(upgrade_function):
+        MIGRATIONS.setdefault(kind, {})[version] = upgrade_function
+        return upgrade_function
+    return register
+
+
+def current_version(kind):
+    return max(MIGRATIONS.get(kind, {0: None}))
+
+
+def file_version(data):
+    # Files written before versioning have no version, they are version 0
+    return data.get(SCHEMA_VERSION, 0) if isinstance(data, dict) else 0
+
+
+def stamp(kind, data):
+    # New files are written at the current version, nothing is left to upgrade
+    data[SCHEMA_VERSION] = current_version(kind)
+    return data
+
+
+def upgrade(kind, data, context=None):
+    """
+    Upgrade a loaded file to the current version of its kind.
+
+    Parameters:
+        kind (str): The kind of file.
+        data (dict): The loaded file, upgraded in place.
+        context (dict, optional): What the migrations need beyond the file, e.g. the base currency.
+
+    Returns:
+        bool: True if the file was upgraded, False if it was already current.
+
+    Raises:
+        SchemaError: If the file was written by a newer version of the application.
+    """
+    version = file_version(data)
+    target = current_version(kind)
+    if version > target:
+        raise SchemaError(f"The {kind} has schema version {version}, this version of the "
+                          f"application reads up to {target}. Update the application.")
+    if version == target:
+        return False
+    for step in range(version + 1, target + 1):
+        MIGRATIONS[kind][step](data, context or {})
+        data[SCHEMA_VERSION] = step
+    return True
@@ -0,0 +1,194 @@
+import re
+
+from records import read_record
+
+
+def tokenize(text):
+    """
+    Split free text into lowercase search terms.
+
+    Parameters:
+        text (str): The text of a note or a query.
+
+    Returns:
+        set: The terms of the text.
+    """
+    return set(re.findall(r'[a-z0-9]+', (text or '').lower()))
+
+
+def normalize_tags(tags):
+    """
+    Normalize tags given as a list or as a comma separated string.
+
+    Parameters:
+        tags (list or str): The tags.
+
+    Returns:
+        list: Unique lowercase tags without the leading '#', in input order.
+    """
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    normalized = []
+    for tag in tags or []:
+        tag = tag.strip().lstrip('#').lower()
+        if tag and tag not in normalized:
+            normalized.append(tag)
+    return normalized
+
+
+def index_entry(shard, position, entry):
+    """
+    Add an expense entry to the inverted index of its month shard.
+
+    Parameters:
+        shard (dict): The month shard holding the entry.
+        position (int): The position of the entry in the shard.
+        entry (dict): The entry with 'category', 'note' and 'tags'.
+
+    Returns:
+        tuple: Sets of terms and tags which the month did not have before.
+    """
+    index = shard.setdefault('index', {'terms': {}, 'tags': {}})
+    new_terms = set()
+    new_tags = set()
+    for term in tokenize(entry.get('note')) | tokenize(entry['category']):
+        if term not in index['terms']:
+            index['terms'][term] = []
+            new_terms.add(term)
+        index['terms'][term].append(position)
+    for tag in entry.get('tags', []):
+        if tag not in index['tags']:
+            index['tags'][tag] = []
+            new_tags.add(tag)
+        index['tags'][tag].append(position)
+    return new_terms, new_tags
+
+
+def unindex_entry(shard, position, entry):
+    """
+    Remove an expense entry from the inverted index of its month shard.
+
+    Parameters:
+        shard (dict): The month shard holding the entry.
+        position (int): The position of the entry in the shard.
+        entry (dict): The entry with 'category', 'note' and 'tags' as it was indexed.
+
+    Returns:
+        None
+
+    The term dictionary of the user is left alone, a month listed for a term
+    it no longer has only costs one extra shard read on search.
+    """
+    index = shard.setdefault('index', {'terms': {}, 'tags': {}})
+    for kind, values in (('terms', tokenize(entry.get('note')) | tokenize(entry['category'])),
+                         ('tags', entry.get('tags', []))):
+        for value in values:
+            postings = index[kind].get(value)
+            if postings and position in postings:
+                postings.remove(position)
+                if not postings:
+                    del index[kind][value]
+
+
+def candidate_months(terms_index, terms, tags):
+    # Months which contain every requested term and tag, None when nothing restricts them
+    months = None
+    for kind, values in (('terms', terms), ('tags', tags)):
+        for value in values:
+            value_months = set(terms_index.get(kind, {}).get(value, []))
+            months = value_months if months is None else months & value_months
+    return months
+
+
+def amounts_overlap(month_info, min_amount, max_amount):
+    # Months saved before the bounds were kept have none and are always searched
+    if 'min_amount' not in month_info:
+        return True
+    if min_amount is not None and month_info['max_amount'] < min_amount:
+        return False
+    if max_amount is not None and month_info['min_amount'] > max_amount:
+        return False
+    return True
+
+
+def search_expenses(storage, text=None, tags=None, min_amount=None, max_amount=None,
+                    start_date=None, end_date=None):
+    """
+    Search the expenses of a user.
+
+    Parameters:
+        storage (ShardedUserStorage): The storage of the user.
+        text (str, optional): Keywords which must all appear in the note or the category.
+        tags (list, optional): Tags which must all be set on the expense.
+        min_amount (float, optional): The smallest amount in the base currency.
+        max_amount (float, optional): The largest amount in the base currency.
+        start_date (date, optional): The first date.
+        end_date (date, optional): The last date.
+
+    Returns:
+        list: Matching records with 'id', 'date', 'category', 'amount', 'note' and 'tags', newest first.
+
+    The term dictionary of the user picks the months containing every keyword
+    and tag, then the postings of those month shards pick the records. Months
+    outside the date range, and months whose amount bounds in the manifest
+    don't reach the amount range, are never opened.
+    """
+    terms = tokenize(text)
+    tags = normalize_tags(tags)
+
+    manifest = storage.load_manifest()
+    if terms or tags:
+        months = candidate_months(storage.load_terms(), terms, tags)
+    else:
+        months = set(manifest['months'])
+    if min_amount is not None or max_amount is not None:
+        months = {month for month in months if amounts_overlap(manifest['months'].get(month, {}),
+                                                               min_amount, max_amount)}
+
+    start_str = start_date.strftime("%Y-%m-%d") if start_date else None
+    end_str = end_date.strftime("%Y-%m-%d") if end_date else None
+
+    # Month keys sort like the dates they contain
+    if start_str:
+        months = {month for month in months if month >= start_str[:7]}
+    if end_str:
+        months = {month for month in months if month <= end_str[:7]}
+
+    start_day = int(start_str[8:10]) if start_str else None
+    end_day = int(end_str[8:10]) if end_str else None
+
+    results = []
+    for month in sorted(months, reverse=True):
+        shard = storage.load_shard(month)
+        records = shard['records']
+        index = shard.get('index', {'terms': {}, 'tags': {}})
+
+        positions = None
+        for kind, values in (('terms', terms), ('tags', tags)):
+            for value in values:
+                postings = set(index[kind].get(value, []))
+                positions = postings if positions is None else positions & postings
+        if positions is None:
+            positions = range(len(records['day']))
+
+        # Filters run on the record columns, only matches are turned into dicts.
+        # Amounts are compared in the base currency.
+        amounts = records['base']
+        days = records['day']
+        deleted = records['deleted']
+        for position in positions:
+            if deleted[position]:
+                continue
+            if min_amount is not None and amounts[position] < min_amount:
+                continue
+            if max_amount is not None and amounts[position] > max_amount:
+                continue
+            if start_day and month == start_str[:7] and days[position] < start_day:
+                continue
+            if end_day and month == end_str[:7] and days[position] > end_day:
+                continue
+            results.append((position, read_record(shard, month, position)))
+
+    results.sort(key=lambda result: (result[1]['date'], result[0]), reverse=True)
+    return [record for _, record in results]
+
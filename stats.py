@@ -0,0 +1,215 @@
+import json
+import math
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import USERS_DIRECTORY, ShardedUserStorage, month_key_from_name, sharded_users, legacy_users
+from currency import format_amount, get_rate_table
+from categories import get_category_registry
+from jsonstream import LegacyUserFile
+
+CHUNK_SIZE = 500
+PERCENTILES = (50, 90, 99)
+RELATIVE_ACCURACY = 0.01
+
+
+class QuantileSketch:
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        """
+        Initializes a new QuantileSketch object.
+
+        Parameters:
+            relative_accuracy (float, optional): The relative error of a quantile. Defaults to 1%.
+
+        Returns:
+            None
+
+        Values are counted in logarithmic buckets, so two sketches merge by
+        adding their bucket counts and the size does not grow with the data.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        bucket = math.ceil(math.log(value, self.gamma))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        Get a quantile.
+
+        Parameters:
+            q (float): The quantile between 0 and 1.
+
+        Returns:
+            float: The value, or None if the sketch is empty.
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if rank < seen:
+                return 2 * self.gamma ** bucket / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+def empty_partial():
+    return {'users': 0, 'months': {}, 'categories': {}, 'monthly': QuantileSketch(), 'by_category': {}}
+
+
+def user_months(users_directory, user):
+    # Month totals and category totals of a user, from the manifest or from a single-file history.
+    # The files are read as they are, whatever their version, so the totals are keyed by category ID here.
+    registry = get_category_registry()
+    storage = ShardedUserStorage(user, users_directory)
+    manifest = storage.read_json(storage.manifest_file, None)
+    if isinstance(manifest, dict) and isinstance(manifest.get('months'), dict):
+        for key, month_info in manifest['months'].items():
+            categories = month_info.get('categories')
+            if categories is None:
+                categories = storage.load_shard(key)['expenses']
+            yield key, registry.keyed(categories)
+        return
+    # Large single-file histories are streamed, the daily entries are skipped unparsed
+    for month_name, month_data in LegacyUserFile(storage.legacy_file).iter_months():
+        try:
+            key = month_key_from_name(month_name)
+        except ValueError:
+            continue
+        yield key, registry.keyed(month_data.get('expenses', {}))
+
+
+def map_users(users_directory, users):
+    """
+    Aggregate the spending of a chunk of users.
+
+    Parameters:
+        users_directory (str): The root directory of user data.
+        users (list): The usernames of the chunk.
+
+    Returns:
+        dict: A partial aggregate with sums and counts by month and category and quantile sketches.
+
+    Runs in a worker process. Only manifests are read, shards only for
+    months recorded before the manifest kept category totals.
+    """
+    partial = empty_partial()
+    for user in users:
+        partial['users'] += 1
+        for key, categories in user_months(users_directory, user):
+            total = sum(categories.values())
+            month = partial['months'].setdefault(key, [0, 0])
+            month[0] += total
+            month[1] += 1
+            partial['monthly'].add(total)
+            for category, amount in categories.items():
+                totals = partial['categories'].setdefault(category, [0, 0])
+                totals[0] += amount
+                totals[1] += 1
+                partial['by_category'].setdefault(category, QuantileSketch()).add(amount)
+    return partial
+
+
+def reduce_partials(result, partial):
+    result['users'] += partial['users']
+    for kind in ('months', 'categories'):
+        for key, (total, count) in partial[kind].items():
+            totals = result[kind].setdefault(key, [0, 0])
+            totals[0] += total
+            totals[1] += count
+    result['monthly'].merge(partial['monthly'])
+    for category, sketch in partial['by_category'].items():
+        result['by_category'].setdefault(category, QuantileSketch()).merge(sketch)
+    return result
+
+
+def aggregate(users_directory=USERS_DIRECTORY, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Aggregate the spending of every user with a process pool.
+
+    Parameters:
+        users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+        workers (int, optional): The number of worker processes. Defaults to the number of cores.
+        chunk_size (int, optional): The number of users a worker handles at once. Defaults to 500.
+
+    Returns:
+        dict: The merged aggregate.
+    """
+    users = sorted(set(sharded_users(users_directory)) | set(legacy_users(users_directory)))
+    chunks = [users[start:start + chunk_size] for start in range(0, len(users), chunk_size)]
+    result = empty_partial()
+    if not chunks:
+        return result
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial in executor.map(map_users, [users_directory] * len(chunks), chunks):
+            reduce_partials(result, partial)
+    return result
+
+
+def summarize(result):
+    def percentiles(sketch):
+        return {f'p{percentile}': sketch.quantile(percentile / 100) for percentile in PERCENTILES}
+
+    # Categories are summed by ID and shown by name
+    categories = get_category_registry()
+    by_name = {categories.decode(category): dict({'total': total, 'users': count},
+                                                 **percentiles(result['by_category'][category]))
+               for category, (total, count) in result['categories'].items()}
+    return {
+        'users': result['users'],
+        'months': {key: {'total': total, 'users': count}
+                   for key, (total, count) in sorted(result['months'].items())},
+        'categories': dict(sorted(by_name.items())),
+        'monthly_spending': percentiles(result['monthly'])
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Aggregate the spending of all users.")
+    arg_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+    arg_parser.add_argument('--workers', type=int, default=None, help="worker processes (all cores by default)")
+    arg_parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    arg_parser.add_argument('--json', action='store_true', help="print the result as JSON")
+
+    args = arg_parser.parse_args()
+
+    summary = summarize(aggregate(args.users_dir, args.workers, args.chunk_size))
+    if args.json:
+        print(json.dumps(summary, indent=4))
+        return
+
+    # Every user converts to the base currency of the shared rate table
+    base = get_rate_table().base
+    print(f"Users: {summary['users']}")
+    print("\nSpending by month:")
+    for key, month in summary['months'].items():
+        print(f"  {key}: {format_amount(month['total'], base)} ({month['users']} users)")
+    print("\nSpending by category (per user and month, p50 / p90 / p99):")
+    for category, totals in summary['categories'].items():
+        print(f"  {category}: {format_amount(totals['total'], base)}, "
+              + " / ".join(format_amount(totals[f'p{percentile}'], base) for percentile in PERCENTILES))
+    monthly = summary['monthly_spending']
+    if monthly['p50'] is not None:
+        print("\nMonthly spending of a user (p50 / p90 / p99): "
+              + " / ".join(format_amount(monthly[f'p{percentile}'], base) for percentile in PERCENTILES))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1713 @@
+import os
+import json
+import copy
+import time
+import bisect
+import argparse
+import functools
+import threading
+import contextlib
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+
+import schema
+import rollups
+import search
+from records import (RECORD_COLUMNS, record_id, parse_record_id, empty_records, append_record, read_record,
+                     upgrade_columns)
+from currency import get_rate_table
+from categories import get_category_registry
+from changefeed import ChangeLog
+from jsonstream import iter_legacy
+from registry import get_registry
+from versions import VersionStore, get_user_lock
+
+USERS_DIRECTORY = 'users'
+MANIFEST_FILE = 'manifest.json'
+TERMS_FILE = 'terms.json'
+ROLLUPS_FILE = 'rollups-{year}.json'
+FLUSH_EVENTS = 50
+FLUSH_WINDOW_MS = 500
+# Merged fields which are set rather than added to, and the ones where the highest or the lowest value wins
+REPLACED_FIELDS = ('limit',)
+HIGHEST_FIELDS = ('modified', 'schema_version', 'max_amount')
+LOWEST_FIELDS = ('min_amount',)
+SORTED_FIELDS = ('index', 'rollup_years')
+MIGRATION_OPEN_SHARDS = 12
+UPGRADE_CHUNK_SIZE = 100
+MIGRATED_SUFFIX = '.migrated'
+
+
+def month_key(date):
+    """
+    Get the shard key of a date.
+
+    Parameters:
+        date (str): The date in the format 'YYYY-MM-DD'.
+
+    Returns:
+        str: The month key in the format 'YYYY-MM'.
+    """
+    return date[:7]
+
+
+def month_key_from_name(month_name):
+    return dt.datetime.strptime(month_name, "%B %Y").strftime("%Y-%m")
+
+
+def month_name_from_key(key):
+    # Month names are for display only, the storage is keyed by 'YYYY-MM'
+    return dt.datetime.strptime(key, "%Y-%m").strftime("%B %Y")
+
+
+def parse_month_key(text):
+    """
+    Get the month key of a month entered by a user.
+
+    Parameters:
+        text (str): The month in the format 'YYYY-MM' or 'Month Year', e.g. '2024-05' or 'May 2024'.
+
+    Returns:
+        str: The month key in the format 'YYYY-MM'.
+
+    Raises:
+        ValueError: If the text is not a month in either format.
+    """
+    for month_format in ("%Y-%m", "%B %Y"):
+        try:
+            return dt.datetime.strptime(text.strip(), month_format).strftime("%Y-%m")
+        except ValueError:
+            pass
+    raise ValueError(f"{text!r} is not a month, use 'YYYY-MM' or 'Month Year'.")
+
+
+def shift_month(key, months):
+    # '2024-11' shifted by 3 is '2025-02', by -11 it is '2023-12'
+    position = int(key[:4]) * 12 + int(key[5:7]) - 1 + months
+    return f"{position // 12:04d}-{position % 12 + 1:02d}"
+
+
+def month_days(key):
+    """
+    Get the first and the last day of a month.
+
+    Parameters:
+        key (str): The month key in the format 'YYYY-MM'.
+
+    Returns:
+        tuple: The first and the last day as dates.
+    """
+    first_day = dt.date(int(key[:4]), int(key[5:7]), 1)
+    next_key = shift_month(key, 1)
+    return first_day, dt.date(int(next_key[:4]), int(next_key[5:7]), 1) - dt.timedelta(days=1)
+
+
+def publishes(method):
+    # Writers hold the lock of the user exclusively while they replace files,
+    # so a pinned version never holds half of a change
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.user_lock.exclusive():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def merge_changes(base, mine, theirs, field=None):
+    """
+    Merge the changes of a buffered file into the file another writer saved meanwhile.
+
+    Parameters:
+        base (any): The file as it was loaded into the buffer.
+        mine (any): The file with the buffered changes.
+        theirs (any): The file as it is on disk now.
+        field (str, optional): The name of the merged field.
+
+    Returns:
+        The merged file.
+
+    Totals are added up, so the amounts of both writers count. Limits take
+    the buffered value, timestamps the latest one and amount bounds the widest. Lists are merged as sets:
+    items the buffer added or removed are added or removed on disk too.
+    """
+    if mine == base:
+        return theirs
+    if isinstance(mine, dict):
+        base = base if isinstance(base, dict) else {}
+        merged = dict(theirs) if isinstance(theirs, dict) else {}
+        for key in set(base) | set(mine):
+            if key in mine:
+                merged[key] = merge_changes(base.get(key), mine[key], merged.get(key), key)
+            elif isinstance(base[key], (int, float)) and isinstance(merged.get(key), (int, float)):
+                # Totals which went down to zero are removed, the other writer's part is kept
+                rest = merged[key] - base[key]
+                if abs(rest) < 1e-9:
+                    del merged[key]
+                else:
+                    merged[key] = rest
+            elif isinstance(base[key], dict) and isinstance(merged.get(key), dict):
+                # So are emptied totals of a date or a period
+                rest = merge_changes(base[key], {}, merged[key], key)
+                if rest:
+                    merged[key] = rest
+                else:
+                    del merged[key]
+            else:
+                merged.pop(key, None)
+        return merged
+    if isinstance(mine, list):
+        base = base if isinstance(base, list) else []
+        theirs = theirs if isinstance(theirs, list) else []
+        merged = [item for item in theirs if item in mine or item not in base]
+        merged += [item for item in mine if item not in base and item not in merged]
+        # The month index and the rollup years stay sorted
+        return sorted(merged) if field in SORTED_FIELDS else merged
+    if field in REPLACED_FIELDS:
+        return mine
+    is_number = isinstance(mine, (int, float)) and not isinstance(mine, bool)
+    if is_number and isinstance(theirs, (int, float)):
+        if field in HIGHEST_FIELDS:
+            return max(mine, theirs)
+        if field in LOWEST_FIELDS:
+            return min(mine, theirs)
+        return theirs + mine - (base if isinstance(base, (int, float)) else 0)
+    return mine
+
+
+def merge_shard(base, mine, theirs):
+    """
+    Merge the changes of a buffered month shard into the shard another writer saved meanwhile.
+
+    Parameters:
+        base (dict): The shard as it was loaded into the buffer.
+        mine (dict): The shard with the buffered changes.
+        theirs (dict): The shard as it is on disk now.
+
+    Returns:
+        tuple: The merged shard and the number of positions the records added by the buffer moved by.
+
+    Records the buffer edited or deleted keep their position. Records it
+    added go after the ones the other writer added, so their positions move
+    by that many. The daily and month totals are merged like in
+    'merge_changes' and the postings of every changed record are indexed again.
+    """
+    if mine == base:
+        return theirs, 0
+    merged = copy.deepcopy(theirs)
+    categories = get_category_registry()
+    base_records = base['records']
+    mine_records = mine['records']
+    records = merged['records']
+    base_count = len(base_records['day'])
+    offset = len(records['day']) - base_count
+
+    def entry(position):
+        return {'category': categories.decode(records['category'][position]),
+                'note': records['note'][position], 'tags': records['tags'][position]}
+
+    for position in range(min(base_count, len(records['day']))):
+        changed = [column for column in RECORD_COLUMNS
+                   if mine_records[column][position] != base_records[column][position]]
+        if not changed:
+            continue
+        if not records['deleted'][position]:
+            search.unindex_entry(merged, position, entry(position))
+        for column in changed:
+            records[column][position] = mine_records[column][position]
+        if not records['deleted'][position]:
+            search.index_entry(merged, position, entry(position))
+    for position in range(base_count, len(mine_records['day'])):
+        for column in RECORD_COLUMNS:
+            records[column].append(mine_records[column][position])
+        if not records['deleted'][-1]:
+            search.index_entry(merged, len(records['day']) - 1, entry(len(records['day']) - 1))
+
+    merged['date'] = merge_changes(base['date'], mine['date'], merged['date'])
+    merged['expenses'] = merge_changes(base['expenses'], mine['expenses'], merged['expenses'])
+    # Change times are timestamps, the latest one wins
+    modified = merged.setdefault('modified', {})
+    for date, stamp in mine.get('modified', {}).items():
+        if stamp != base.get('modified', {}).get(date):
+            modified[date] = max(stamp, modified.get(date, stamp))
+    return merged, offset
+
+
+def upgrade_records(shard, base):
+    """
+    Build the expense records of a shard written before records existed.
+
+    Parameters:
+        shard (dict): The month shard.
+        base (str): The base currency, which all amounts of the shard are in.
+
+    Returns:
+        tuple: Sets of terms and tags which the month did not have before, for the term dictionary.
+
+    Entries saved with notes and tags become records at the same positions,
+    so their search postings stay valid. Whatever the daily sums hold beyond
+    those entries becomes one record per date and category.
+    """
+    new_terms = set()
+    new_tags = set()
+    records = empty_records()
+    recorded = {}
+    for entry in shard.pop('entries', []):
+        append_record(records, int(entry['date'][8:10]), entry['category'], entry['amount'],
+                      entry.get('note', ''), entry.get('tags', []), base)
+        date_totals = recorded.setdefault(entry['date'], {})
+        date_totals[entry['category']] = date_totals.get(entry['category'], 0) + entry['amount']
+
+    for date, expenses_for_date in sorted(shard['date'].items()):
+        for category, amount in expenses_for_date.items():
+            rest = amount - recorded.get(date, {}).get(category, 0)
+            if abs(rest) < 1e-9:
+                continue
+            position = append_record(records, int(date[8:10]), category, rest, '', [], base)
+            terms, tags = search.index_entry(shard, position, {'category': category, 'note': '', 'tags': []})
+            new_terms |= terms
+            new_tags |= tags
+    shard['records'] = records
+    return new_terms, new_tags
+
+
+@schema.migration('shard', 1)
+def upgrade_shard_records(shard, context):
+    # Shards written before the expense records and their currency columns existed
+    shard.setdefault('date', {})
+    shard.setdefault('expenses', {})
+    if 'records' not in shard:
+        new_terms, new_tags = upgrade_records(shard, context['base'])
+        # The caller adds them to the term dictionary, which the migration can't reach
+        context.setdefault('terms', set()).update(new_terms)
+        context.setdefault('tags', set()).update(new_tags)
+    upgrade_columns(shard['records'], context['base'])
+
+
+@schema.migration('manifest', 1)
+def index_months(manifest, context):
+    # Manifests written before the month index, months keyed by their name move to 'YYYY-MM'.
+    # Months saved before the running totals get them from their shard.
+    months = {}
+    for key, month_info in manifest['months'].items():
+        try:
+            months[parse_month_key(key)] = month_info
+        except ValueError:
+            months[key] = month_info
+            continue
+        if 'total' not in month_info or 'categories' not in month_info:
+            expenses = context['load_shard'](parse_month_key(key))['expenses']
+            month_info.setdefault('total', sum(expenses.values()))
+            month_info.setdefault('categories', dict(expenses))
+    manifest['months'] = months
+    manifest['index'] = sorted(months)
+
+
+@schema.migration('shard', 2)
+def key_shard_categories(shard, context):
+    # Daily and month totals saved by category name are keyed by category ID, like the records
+    categories = get_category_registry()
+    shard['date'] = {date: categories.keyed(expenses_for_date) for date, expenses_for_date in shard['date'].items()}
+    shard['expenses'] = categories.keyed(shard['expenses'])
+
+
+@schema.migration('manifest', 2)
+def key_month_categories(manifest, context):
+    # Category totals of the months saved by category name are keyed by category ID
+    categories = get_category_registry()
+    for month_info in manifest['months'].values():
+        if 'categories' in month_info:
+            month_info['categories'] = categories.keyed(month_info['categories'])
+
+
+@schema.migration('rollups', 1)
+def key_rollup_categories(year_rollups, context):
+    # Rollup files written before the totals were keyed by category ID
+    categories = get_category_registry()
+    for granularity in rollups.GRANULARITIES:
+        periods = year_rollups.get(granularity, {})
+        for period, totals in periods.items():
+            periods[period] = categories.keyed(totals)
+
+
+def list_terms(terms, key, new_terms, new_tags):
+    # The term dictionary lists the months of every term and tag
+    for kind, values in (('terms', new_terms), ('tags', new_tags)):
+        for value in values:
+            months = terms[kind].setdefault(value, [])
+            if key not in months:
+                months.append(key)
+
+
+def new_shard():
+    return schema.stamp('shard', {'date': {}, 'expenses': {}, 'records': empty_records()})
+
+
+def new_manifest():
+    return schema.stamp('manifest', {'months': {}, 'index': [], 'rollup_years': []})
+
+
+class ShardedUserStorage:
+    def __init__(self, user, users_directory=USERS_DIRECTORY, rates=None, change_feed=None):
+        """
+        Initializes a new ShardedUserStorage object.
+
+        Parameters:
+            user (str): The username of the current user.
+            users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+            rates (RateTable, optional): Exchange rates. Defaults to the table of 'rates.json'.
+            change_feed (ChangeFeed, optional): Receives the changes. Defaults to the module feed of 'changefeed'.
+
+        Returns:
+            None
+
+        Every user gets a directory with one 'YYYY-MM.json' shard per month, a
+        small 'manifest.json' with the list of months and their limits and one
+        'rollups-YYYY.json' with the week, quarter and year totals per year. The
+        directory is found in the user registry, new users get the fan-out
+        layout 'users/<xx>/<yy>/<user>/'.
+        """
+        self.user = user
+        self.users_directory = users_directory
+        self.rates = rates if rates is not None else get_rate_table()
+        self.registry = get_registry(users_directory)
+        self.user_directory = self.registry.user_directory(user)
+        self.legacy_file = os.path.join(users_directory, f'{user}.json')
+        self.manifest_file = os.path.join(self.user_directory, MANIFEST_FILE)
+        self.terms_file = os.path.join(self.user_directory, TERMS_FILE)
+        self.changes = ChangeLog(user, self.user_directory, change_feed)
+        self.user_lock = get_user_lock(self.user_directory)
+        self.versions = VersionStore(self.user_directory, self.user_lock)
+
+    @staticmethod
+    def read_json(path, default):
+        try:
+            with open(path, 'r') as json_file:
+                return json.load(json_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default
+
+    @staticmethod
+    def write_json(path, data):
+        # Write to a temporary file first so a crash never leaves a half-written shard
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump(data, json_file, indent=4)
+        os.replace(tmp_path, path)
+
+    @property
+    def registered(self):
+        return self.registry.lookup(self.user) is not None
+
+    def ensure_directory(self):
+        # The directory is created and registered once, registered users skip the file system
+        if not self.registered:
+            os.makedirs(self.user_directory, exist_ok=True)
+            self.registry.register(self.user, self.user_directory)
+
+    def shard_path(self, key):
+        return os.path.join(self.user_directory, f'{key}.json')
+
+    def load_manifest(self):
+        manifest = self.read_json(self.manifest_file, None)
+        if not isinstance(manifest, dict) or not isinstance(manifest.get('months'), dict):
+            return new_manifest()
+        return self.upgrade_file('manifest', self.manifest_file, manifest)
+
+    def save_manifest(self, manifest):
+        self.write_json(self.manifest_file, manifest)
+
+    def rollup_path(self, year):
+        return os.path.join(self.user_directory, ROLLUPS_FILE.format(year=year))
+
+    def load_rollup_year(self, year):
+        year_rollups = self.read_json(self.rollup_path(year), None)
+        if not isinstance(year_rollups, dict):
+            return rollups.empty_rollups()
+        self.upgrade_file('rollups', self.rollup_path(year), year_rollups)
+        for granularity in rollups.GRANULARITIES:
+            year_rollups.setdefault(granularity, {})
+        return year_rollups
+
+    def save_rollup_year(self, year, year_rollups):
+        self.write_json(self.rollup_path(year), year_rollups)
+
+    def load_terms(self):
+        terms = self.read_json(self.terms_file, None)
+        if not isinstance(terms, dict):
+            return {'terms': {}, 'tags': {}}
+        return terms
+
+    def save_terms(self, terms):
+        self.write_json(self.terms_file, terms)
+
+    def load_shard(self, key):
+        shard = self.read_json(self.shard_path(key), None)
+        if not isinstance(shard, dict):
+            return new_shard()
+        return self.upgrade_file('shard', self.shard_path(key), shard)
+
+    def save_shard(self, key, shard):
+        self.write_json(self.shard_path(key), shard)
+
+    def upgrade_file(self, kind, path, data):
+        """
+        Upgrade a loaded file to the current schema version.
+
+        Parameters:
+            kind (str): 'manifest', 'shard' or 'rollups'.
+            path (str): The path the file was loaded from.
+            data (dict): The loaded file, upgraded in place.
+
+        Returns:
+            dict: The upgraded file.
+
+        Raises:
+            SchemaError: If the file was written by a newer version of the application.
+
+        A file of an older version is upgraded in memory and the upgraded form
+        is saved, so only its first read pays for the migration.
+        """
+        if schema.upgrade(kind, data, self.upgrade_context()):
+            self.persist_upgrade(kind, path)
+        return data
+
+    def upgrade_context(self):
+        # What the migrations need beyond the file: the base currency of the amounts and, for the
+        # months of old manifests, their shards
+        return {'base': self.rates.base, 'load_shard': self.load_shard}
+
+    def persist_upgrade(self, kind, path):
+        """
+        Save the upgraded form of a file.
+
+        Parameters:
+            kind (str): 'manifest', 'shard' or 'rollups'.
+            path (str): The path of the file.
+
+        Returns:
+            bool: True if the file was upgraded on disk, False if it was already current or is missing.
+
+        The file is read again under the lock of the user, so a change a writer
+        saved since the first read is upgraded instead of overwritten. The data
+        itself doesn't change, so neither does the generation. Terms of records
+        a shard upgrade builds go to the term dictionary before the shard is
+        written, a month listed too early only costs one extra shard read on search.
+        """
+        with self.user_lock.exclusive():
+            data = self.read_json(path, None)
+            context = self.upgrade_context()
+            if not isinstance(data, dict) or not schema.upgrade(kind, data, context):
+                return False
+            if context.get('terms') or context.get('tags'):
+                # Written past the buffer of a BufferedUserStorage, which merges its terms with the file
+                terms = ShardedUserStorage.load_terms(self)
+                list_terms(terms, os.path.basename(path)[:-len('.json')], context.get('terms', ()),
+                           context.get('tags', ()))
+                ShardedUserStorage.save_terms(self, terms)
+            self.write_json(path, data)
+            return True
+
+    def record_change(self, kind, data):
+        # Changes are logged once the files they describe are written
+        self.changes.append([(kind, data, time.time())])
+
+    def exclusive(self):
+        # Held by callers which read and write files of the user next to the storage, e.g. the budgets
+        return self.user_lock.exclusive()
+
+    @property
+    def generation(self):
+        # The data version of the user: the last sequence number of the change log,
+        # so it goes up with every saved expense or limit, also from other processes
+        return self.changes.last_seq()
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Pin the current version of the user's data for reading.
+
+        Returns:
+            context manager: A read-only SnapshotStorage of the version, released when the block ends.
+
+        Long reports read every month from the same version, while writers
+        keep publishing new ones. The version is deleted once no reader holds it.
+        """
+        if not os.path.isdir(self.user_directory):
+            # Nothing was written yet, there is nothing a writer could change under the reader
+            yield SnapshotStorage(self, self.user_directory, 0)
+            return
+        with self.user_lock.shared():
+            generation = self.generation
+            directory, holder = self.versions.pin(generation)
+        try:
+            yield SnapshotStorage(self, directory, generation)
+        finally:
+            self.versions.release(holder)
+
+    @publishes
+    def initialize_layout(self):
+        """
+        Create an empty user directory with an empty manifest.
+
+        Returns:
+            None
+        """
+        self.ensure_directory()
+        self.save_manifest(new_manifest())
+        self.record_change('reinitialized', {})
+
+    def check_layout(self):
+        """
+        Make sure the sharded layout of the user exists.
+
+        Returns:
+            None
+
+        Raises:
+            SchemaError: If the manifest was written by a newer version of the application.
+
+        Method migrates the single-file format if the user still has one,
+        otherwise creates an empty layout when the manifest is missing or broken.
+        A broken manifest is kept next to the new one, so it can be restored from a backup.
+        A manifest of an older schema version is upgraded, never replaced.
+        """
+        manifest = self.read_json(self.manifest_file, None)
+        if isinstance(manifest, dict) and isinstance(manifest.get('months'), dict):
+            self.upgrade_file('manifest', self.manifest_file, manifest)
+            return
+        if os.path.exists(self.manifest_file):
+            broken_file = f'{self.manifest_file}.broken-{int(time.time())}'
+            os.replace(self.manifest_file, broken_file)
+            print(f"The manifest of {self.user} is broken and was moved to {broken_file}. "
+                  f"Run 'python backup.py restore {self.user}' to restore the last snapshot.")
+        if os.path.exists(self.legacy_file):
+            migrate_user(self.user, self.users_directory)
+        else:
+            self.initialize_layout()
+
+    @staticmethod
+    def add_month(manifest, key):
+        # New months go into the sorted month index, so ranges never scan every month
+        month_info = manifest['months'].get(key)
+        if month_info is None:
+            month_info = manifest['months'][key] = {'limit': None}
+            bisect.insort(manifest.setdefault('index', []), key)
+        return month_info
+
+    def month_entry(self, manifest, key, shard):
+        # Months recorded before the running totals existed get them from the shard once
+        month_info = self.add_month(manifest, key)
+        if 'total' not in month_info:
+            month_info['total'] = sum(shard['expenses'].values())
+        if 'categories' not in month_info:
+            month_info['categories'] = dict(shard['expenses'])
+        if 'min_amount' not in month_info:
+            for amount in shard['records']['base']:
+                self.widen_amounts(month_info, amount)
+        return month_info
+
+    def apply_amount(self, manifest, shard, key, date, category, amount, year_rollups):
+        """
+        Add an amount to every aggregate derived from the records.
+
+        Parameters:
+            manifest (dict): The manifest of the user.
+            shard (dict): The month shard of the date.
+            key (str): The month key in the format 'YYYY-MM'.
+            date (str): The date in the format 'YYYY-MM-DD'.
+            category (str): The expense category, the totals are keyed by its ID.
+            amount (float): The amount, negative to take a record back out.
+            year_rollups (dict): The rollups of the years changed so far, by year. Saved with 'save_rollups'.
+
+        Returns:
+            dict: The updated manifest entry of the month.
+
+        The daily, month, category and rollup totals are all updated in O(1).
+        The date and the month are stamped with the time of the change, so an
+        incremental export finds them without reading unchanged shards.
+        """
+        category = get_category_registry().key(category)
+        month_info = self.month_entry(manifest, key, shard)
+        modified = time.time()
+        shard.setdefault('modified', {})[date] = modified
+        month_info['modified'] = modified
+        expenses_for_date = shard['date'].setdefault(date, {})
+        rollups.add_total(expenses_for_date, category, amount)
+        if not expenses_for_date:
+            del shard['date'][date]
+        rollups.add_total(shard['expenses'], category, amount)
+        rollups.add_total(month_info['categories'], category, amount)
+        month_info['total'] += amount
+        if abs(month_info['total']) < 1e-9:
+            month_info['total'] = 0
+        for granularity, period in rollups.rollup_keys(dt.date.fromisoformat(date)).items():
+            year = rollups.rollup_year(period)
+            if year not in year_rollups:
+                year_rollups[year] = self.changed_rollup_year(manifest, year)
+            totals = year_rollups[year][granularity].setdefault(period, {})
+            rollups.add_total(totals, category, amount)
+            if not totals:
+                del year_rollups[year][granularity][period]
+        return month_info
+
+    def changed_rollup_year(self, manifest, year):
+        # A file of a year the manifest doesn't list is left over from before a reinitialization
+        if year in manifest.get('rollup_years', []):
+            return self.load_rollup_year(year)
+        return rollups.empty_rollups()
+
+    @staticmethod
+    def widen_amounts(month_info, amount):
+        # The amount bounds of a month only ever widen, so they hold every amount saved in it.
+        # Searches by amount skip the months whose bounds don't overlap.
+        month_info['min_amount'] = min(month_info.get('min_amount', amount), amount)
+        month_info['max_amount'] = max(month_info.get('max_amount', amount), amount)
+
+    def save_rollups(self, manifest, year_rollups):
+        # Only the years a change touched are written, the manifest lists the years with a file
+        for year, rollups_of_year in sorted(year_rollups.items()):
+            self.save_rollup_year(year, schema.stamp('rollups', rollups_of_year))
+            years = manifest.setdefault('rollup_years', [])
+            if year not in years:
+                bisect.insort(years, year)
+
+    def load_manifest_with_rollups(self):
+        manifest = self.load_manifest()
+        if 'rollup_years' not in manifest:
+            # Rollups are built once from the history recorded before them, one file per year
+            manifest['rollup_years'] = []
+            self.ensure_directory()
+            self.save_rollups(manifest, rollups.split_rollups(rollups.build_rollups(self.load_all()['date'])))
+        return manifest
+
+    def add_terms(self, key, new_terms, new_tags):
+        if not new_terms and not new_tags:
+            return
+        # The term dictionary only changes when a month sees a term for the first time
+        terms = self.load_terms()
+        list_terms(terms, key, new_terms, new_tags)
+        self.save_terms(terms)
+
+    def save_expense(self, expense, amount, date, note=None, tags=None, currency=None):
+        """
+        Save the expense to the month shard of the date.
+
+        Parameters:
+            expense (str): The expense category.
+            amount (float): The amount spent.
+            date (str): The date of the expense in the format 'YYYY-MM-DD'.
+            note (str, optional): A free-text note.
+            tags (list, optional): Tags of the expense.
+            currency (str, optional): The currency of the amount. Defaults to the base currency.
+
+        Returns:
+            dict: The updated manifest entry of the month with 'limit', 'total', 'categories' and 'alerted'.
+
+        Only the shard of one month is rewritten. The manifest keeps the running
+        totals of the month and of its categories, so limits are checked without summing the shard.
+        """
+        return self.add_record(expense, amount, date, note, tags, currency)[1]
+
+    @publishes
+    def add_record(self, expense, amount, date, note=None, tags=None, currency=None):
+        """
+        Save an expense record and update the aggregates derived from it.
+
+        Parameters:
+            expense (str): The expense category.
+            amount (float): The amount spent.
+            date (str): The date of the expense in the format 'YYYY-MM-DD'.
+            note (str, optional): A free-text note.
+            tags (list, optional): Tags of the expense.
+            currency (str, optional): The currency of the amount. Defaults to the base currency.
+
+        Returns:
+            tuple: The ID of the new record and the updated manifest entry of the month.
+
+        Raises:
+            ValueError: If there is no exchange rate for the currency at the date.
+
+        The record keeps the amount as entered, all aggregates are in the base currency.
+        """
+        currency = (currency or self.rates.base).upper()
+        base_amount = self.rates.to_base(amount, currency, date)
+
+        key = month_key(date)
+        manifest = self.load_manifest_with_rollups()
+        shard = self.load_shard(key)
+
+        tags = search.normalize_tags(tags)
+        position = append_record(shard['records'], int(date[8:10]), expense, amount, note or '', tags,
+                                 currency, base_amount)
+        new_terms, new_tags = search.index_entry(shard, position, {'category': expense, 'note': note, 'tags': tags})
+        year_rollups = {}
+        month_info = self.apply_amount(manifest, shard, key, date, expense, base_amount, year_rollups)
+        self.widen_amounts(month_info, base_amount)
+
+        self.ensure_directory()
+        self.save_shard(key, shard)
+        self.add_terms(key, new_terms, new_tags)
+        self.save_rollups(manifest, year_rollups)
+        self.save_manifest(manifest)
+        self.record_change('expense_added', read_record(shard, key, position))
+        return record_id(key, position), month_info
+
+    def get_record(self, expense_id):
+        """
+        Get an expense record.
+
+        Parameters:
+            expense_id (str): The record ID, e.g. '2024-05.3'.
+
+        Returns:
+            dict: The record with 'id', 'date', 'category', 'amount', 'note' and 'tags', or None if there is none.
+        """
+        try:
+            key, position = parse_record_id(expense_id)
+        except ValueError:
+            return None
+        if key not in self.load_manifest()['months']:
+            return None
+        return read_record(self.load_shard(key), key, position)
+
+    def list_records(self, date):
+        """
+        Get the expense records of a date.
+
+        Parameters:
+            date (str): The date in the format 'YYYY-MM-DD'.
+
+        Returns:
+            list: Records in the order they were saved.
+        """
+        key = month_key(date)
+        if key not in self.load_manifest()['months']:
+            return []
+        shard = self.load_shard(key)
+        day = int(date[8:10])
+        records = shard['records']
+        return [read_record(shard, key, position) for position in range(len(records['day']))
+                if records['day'][position] == day and not records['deleted'][position]]
+
+    def get_records(self, start_date, end_date):
+        """
+        Get the expense records of a range of dates.
+
+        Parameters:
+            start_date (datetime): The first date of the range.
+            end_date (datetime): The last date of the range.
+
+        Returns:
+            list: Records ordered by date, opening only the shards the range overlaps.
+        """
+        start_str = start_date.strftime("%Y-%m-%d")
+        end_str = end_date.strftime("%Y-%m-%d")
+
+        records = []
+        for key in self.month_keys(month_key(start_str), month_key(end_str)):
+            shard = self.load_shard(key)
+            for position in range(len(shard['records']['day'])):
+                record = read_record(shard, key, position)
+                if record is not None and start_str <= record['date'] <= end_str:
+                    records.append(record)
+        records.sort(key=lambda record: record['date'])
+        return records
+
+    @publishes
+    def delete_record(self, expense_id):
+        """
+        Delete an expense record.
+
+        Parameters:
+            expense_id (str): The record ID.
+
+        Returns:
+            tuple: The deleted record and the updated manifest entry of its month, or (None, None).
+
+        The record is only marked as deleted, so the IDs of the other records stay
+        valid, and its amount is taken out of the aggregates in O(1).
+        """
+        record = self.get_record(expense_id)
+        if record is None:
+            return None, None
+        key, position = parse_record_id(expense_id)
+        manifest = self.load_manifest_with_rollups()
+        shard = self.load_shard(key)
+
+        shard['records']['deleted'][position] = 1
+        search.unindex_entry(shard, position, record)
+        year_rollups = {}
+        month_info = self.apply_amount(manifest, shard, key, record['date'], record['category'], -record['base'],
+                                       year_rollups)
+
+        self.save_shard(key, shard)
+        self.save_rollups(manifest, year_rollups)
+        self.save_manifest(manifest)
+        self.record_change('expense_deleted', record)
+        return record, month_info
+
+    @publishes
+    def update_record(self, expense_id, expense=None, amount=None, date=None, note=None, tags=None, currency=None):
+        """
+        Edit an expense record.
+
+        Parameters:
+            expense_id (str): The record ID.
+            expense (str, optional): The new category.
+            amount (float, optional): The new amount.
+            date (str, optional): The new date in the format 'YYYY-MM-DD'.
+            note (str, optional): The new note.
+            tags (list, optional): The new tags.
+            currency (str, optional): The new currency.
+
+        Returns:
+            tuple: The ID of the record and the updated manifest entry of its month, or (None, None).
+
+        Raises:
+            ValueError: If there is no exchange rate for the currency at the date.
+
+        Fields which are not given keep their value. A record moved to another
+        month is deleted there and saved again, so it gets a new ID.
+        """
+        record = self.get_record(expense_id)
+        if record is None:
+            return None, None
+        changed = {
+            'category': record['category'] if expense is None else expense,
+            'amount': record['amount'] if amount is None else amount,
+            'date': record['date'] if date is None else date,
+            'note': record['note'] if note is None else note,
+            'tags': record['tags'] if tags is None else search.normalize_tags(tags),
+            'currency': record['currency'] if currency is None else currency.upper()
+        }
+        changed['base'] = self.rates.to_base(changed['amount'], changed['currency'], changed['date'])
+
+        key, position = parse_record_id(expense_id)
+        if month_key(changed['date']) != key:
+            self.delete_record(expense_id)
+            return self.add_record(changed['category'], changed['amount'], changed['date'],
+                                   changed['note'], changed['tags'], changed['currency'])
+
+        manifest = self.load_manifest_with_rollups()
+        shard = self.load_shard(key)
+        records = shard['records']
+
+        year_rollups = {}
+        self.apply_amount(manifest, shard, key, record['date'], record['category'], -record['base'], year_rollups)
+        search.unindex_entry(shard, position, record)
+        records['day'][position] = int(changed['date'][8:10])
+        records['category'][position] = get_category_registry().encode(changed['category'])
+        records['amount'][position] = changed['amount']
+        records['note'][position] = changed['note']
+        records['tags'][position] = changed['tags']
+        records['currency'][position] = changed['currency']
+        records['base'][position] = changed['base']
+        new_terms, new_tags = search.index_entry(shard, position, changed)
+        month_info = self.apply_amount(manifest, shard, key, changed['date'], changed['category'], changed['base'],
+                                       year_rollups)
+        self.widen_amounts(month_info, changed['base'])
+
+        self.save_shard(key, shard)
+        self.add_terms(key, new_terms, new_tags)
+        self.save_rollups(manifest, year_rollups)
+        self.save_manifest(manifest)
+        self.record_change('expense_updated', read_record(shard, key, position))
+        return expense_id, month_info
+
+    def load_rollups(self, years):
+        """
+        Get the week, quarter and year rollups of some years.
+
+        Parameters:
+            years (set): The years, as strings.
+
+        Returns:
+            dict: Category totals by granularity and period key, by year.
+
+        Only the files of the given years are read. Rollups of a history
+        recorded before them are built from it.
+        """
+        manifest = self.load_manifest()
+        if 'rollup_years' in manifest:
+            return {year: self.load_rollup_year(year) if year in manifest['rollup_years'] else rollups.empty_rollups()
+                    for year in years}
+        split = rollups.split_rollups(rollups.build_rollups(self.load_all()['date']))
+        return {year: split.get(year, rollups.empty_rollups()) for year in years}
+
+    def get_month_info(self, key):
+        month_info = self.load_manifest()['months'].get(key)
+        return dict(month_info) if month_info is not None else None
+
+    @publishes
+    def mark_alerted(self, key, thresholds):
+        """
+        Remember which budget thresholds were already reported for a month.
+
+        Parameters:
+            key (str): The month key in the format 'YYYY-MM'.
+            thresholds (list): Thresholds in percent.
+
+        Returns:
+            None
+        """
+        manifest = self.load_manifest()
+        month_info = self.add_month(manifest, key)
+        month_info['alerted'] = sorted(set(month_info.get('alerted', [])) | set(thresholds))
+        self.save_manifest(manifest)
+
+    def get_limit(self, key):
+        manifest = self.load_manifest()
+        return manifest['months'].get(key, {}).get('limit')
+
+    @publishes
+    def set_limit(self, key, limit):
+        """
+        Set a spending limit for a month.
+
+        Parameters:
+            key (str): The month key in the format 'YYYY-MM'.
+            limit (float): The new limit.
+
+        Returns:
+            dict: The updated manifest entry of the month.
+        """
+        manifest = self.load_manifest()
+        month_info = self.add_month(manifest, key)
+        month_info['limit'] = limit
+        if 'total' not in month_info:
+            month_info['total'] = sum(self.load_shard(key)['expenses'].values())
+        if 'categories' not in month_info:
+            month_info['categories'] = dict(self.load_shard(key)['expenses'])
+        # A new limit starts the threshold alerts over
+        month_info['alerted'] = []
+        self.ensure_directory()
+        self.save_manifest(manifest)
+        self.record_change('limit_set', {'month': key, 'limit': limit})
+        return month_info
+
+    def get_month_data(self, key):
+        """
+        Get data for a month.
+
+        Parameters:
+            key (str): The month key in the format 'YYYY-MM'.
+
+        Returns:
+            dict: The month data with 'limit', 'total' and 'expenses' by category ID, or None if the month has no data.
+
+        Method reads the manifest and the shard of the selected month only.
+        """
+        manifest = self.load_manifest()
+        if key not in manifest['months']:
+            return None
+        shard = self.load_shard(key)
+        month_info = manifest['months'][key]
+        total = month_info.get('total')
+        if total is None:
+            total = sum(shard['expenses'].values())
+        return {'limit': month_info.get('limit'), 'total': total, 'expenses': shard['expenses']}
+
+    def month_keys(self, start_key=None, end_key=None):
+        """
+        Get the recorded months of a range from the month index.
+
+        Parameters:
+            start_key (str, optional): The first month in the format 'YYYY-MM'. Defaults to the first recorded one.
+            end_key (str, optional): The last month in the format 'YYYY-MM'. Defaults to the last recorded one.
+
+        Returns:
+            list: Month keys, oldest first.
+        """
+        index = self.load_manifest()['index']
+        start = bisect.bisect_left(index, start_key) if start_key else 0
+        end = bisect.bisect_right(index, end_key) if end_key else len(index)
+        return index[start:end]
+
+    def get_months(self, start_key=None, end_key=None):
+        """
+        Get the limit and the totals of every recorded month of a range.
+
+        Parameters:
+            start_key (str, optional): The first month in the format 'YYYY-MM'. Defaults to the first recorded one.
+            end_key (str, optional): The last month in the format 'YYYY-MM'. Defaults to the last recorded one.
+
+        Returns:
+            list: Tuples of the month key and a dict with 'limit', 'total' and 'categories' by ID, oldest first.
+
+        Method reads the manifest only, no month shard is opened.
+        """
+        manifest = self.load_manifest()
+        index = manifest['index']
+        start = bisect.bisect_left(index, start_key) if start_key else 0
+        end = bisect.bisect_right(index, end_key) if end_key else len(index)
+        months = []
+        for key in index[start:end]:
+            month_info = manifest['months'][key]
+            months.append((key, {'limit': month_info.get('limit'), 'total': month_info.get('total', 0),
+                                 'categories': dict(month_info.get('categories', {}))}))
+        return months
+
+    def last_months(self, count, end_key=None):
+        """
+        Get the recorded months of the last calendar months, e.g. the last 6 months.
+
+        Parameters:
+            count (int): The number of calendar months.
+            end_key (str, optional): The last month in the format 'YYYY-MM'. Defaults to the current month.
+
+        Returns:
+            list: The months of 'get_months', oldest first. Months without data are left out.
+        """
+        end_key = end_key or dt.date.today().strftime("%Y-%m")
+        return self.get_months(shift_month(end_key, 1 - count), end_key)
+
+    def get_dates(self, start_date, end_date):
+        """
+        Get expenses for every recorded date of a range.
+
+        Parameters:
+            start_date (datetime): The first date of the range.
+            end_date (datetime): The last date of the range.
+
+        Returns:
+            dict: Expenses by category ID, by date in the format 'YYYY-MM-DD'.
+
+        Method opens only the shards which the range overlaps.
+        """
+        start_str = start_date.strftime("%Y-%m-%d")
+        end_str = end_date.strftime("%Y-%m-%d")
+
+        dates = {}
+        for key in self.month_keys(month_key(start_str), month_key(end_str)):
+            for date, expenses_for_date in self.load_shard(key)['date'].items():
+                if start_str <= date <= end_str:
+                    dates[date] = expenses_for_date
+        return dates
+
+    def load_all(self):
+        """
+        Assemble the whole history of the user.
+
+        Returns:
+            dict: Data with 'date' entries and 'month' entries keyed by 'YYYY-MM', the expenses
+                  keyed by category ID. Callers showing them format the keys with 'month_name_from_key'
+                  and 'CategoryRegistry.decode'.
+        """
+        data = {'date': {}, 'month': {}}
+        for key, month_info in sorted(self.load_manifest()['months'].items()):
+            shard = self.load_shard(key)
+            data['date'].update(shard['date'])
+            data['month'][key] = {'limit': month_info.get('limit'), 'expenses': shard['expenses']}
+        return data
+
+
+class SnapshotStorage(ShardedUserStorage):
+    def __init__(self, storage, directory, generation):
+        """
+        Initializes a new SnapshotStorage object.
+
+        Parameters:
+            storage (ShardedUserStorage): The storage the version was pinned from.
+            directory (str): The version directory.
+            generation (int): The generation of the version.
+
+        Returns:
+            None
+
+        Reads like the storage it came from, but from the files of one
+        version. Writing to it is a programming error.
+        """
+        self.user = storage.user
+        self.users_directory = storage.users_directory
+        self.rates = storage.rates
+        self.registry = storage.registry
+        self.user_directory = directory
+        self.legacy_file = storage.legacy_file
+        self.manifest_file = os.path.join(directory, MANIFEST_FILE)
+        self.terms_file = os.path.join(directory, TERMS_FILE)
+        self.changes = storage.changes
+        self.user_lock = storage.user_lock
+        self.versions = storage.versions
+        self.pinned_generation = generation
+
+    @property
+    def generation(self):
+        return self.pinned_generation
+
+    def read_only(self, *args, **kwargs):
+        raise RuntimeError(f"The snapshot of {self.user} at generation {self.pinned_generation} is read-only.")
+
+    write_json = ensure_directory = record_change = read_only
+
+    def persist_upgrade(self, kind, path):
+        # Versions are never changed, their files are upgraded in memory on every read
+        return False
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        yield self
+
+
+class BufferedUserStorage(ShardedUserStorage):
+    def __init__(self, user, users_directory=USERS_DIRECTORY, max_events=FLUSH_EVENTS, window_ms=FLUSH_WINDOW_MS):
+        """
+        Initializes a new BufferedUserStorage object.
+
+        Parameters:
+            user (str): The username of the current user.
+            users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+            max_events (int, optional): Flush after this many buffered writes. Defaults to 50.
+            window_ms (int, optional): Flush this many milliseconds after the first buffered write.
+                                       Defaults to 500, None disables the timer.
+
+        Returns:
+            None
+
+        A write-behind buffer for hot users. Expenses and limits are merged into
+        the in-memory shards and manifest, and every touched file is written once
+        per flush. Reads are served from the merged in-memory state. Every
+        file is merged with the changes other writers saved meanwhile when
+        flushed, and read again after every flush. A record added by the buffer
+        to a month another writer added records to meanwhile gets the next
+        free position on flush, so its ID is final once it is flushed.
+        """
+        super().__init__(user, users_directory)
+        self.max_events = max_events
+        self.window_ms = window_ms
+        self.lock = threading.RLock()
+        self.manifest = None
+        self.terms = None
+        # The files as loaded, to merge the buffered changes with the files on disk
+        self.manifest_base = None
+        self.terms_base = None
+        self.rollup_years = {}
+        self.rollup_bases = {}
+        self.dirty_rollups = set()
+        self.shards = {}
+        self.shard_bases = {}
+        self.dirty_shards = set()
+        self.manifest_dirty = False
+        self.terms_dirty = False
+        self.pending_changes = []
+        self.pending_events = 0
+        self.timer = None
+
+    def load_manifest(self):
+        with self.lock:
+            if self.manifest is None:
+                self.manifest = super().load_manifest()
+                self.manifest_base = copy.deepcopy(self.manifest)
+            return self.manifest
+
+    def save_manifest(self, manifest):
+        with self.lock:
+            self.manifest = manifest
+            self.manifest_dirty = True
+
+    def load_rollup_year(self, year):
+        with self.lock:
+            if year not in self.rollup_years:
+                self.rollup_years[year] = super().load_rollup_year(year)
+                self.rollup_bases[year] = copy.deepcopy(self.rollup_years[year])
+            return self.rollup_years[year]
+
+    def changed_rollup_year(self, manifest, year):
+        with self.lock:
+            year_rollups = super().changed_rollup_year(manifest, year)
+            # A year the buffer starts from empty rollups is merged with the file another writer may have created
+            self.rollup_bases.setdefault(year, copy.deepcopy(year_rollups))
+            return year_rollups
+
+    def save_rollup_year(self, year, year_rollups):
+        with self.lock:
+            self.rollup_years[year] = year_rollups
+            self.dirty_rollups.add(year)
+
+    def load_terms(self):
+        with self.lock:
+            if self.terms is None:
+                self.terms = super().load_terms()
+                self.terms_base = copy.deepcopy(self.terms)
+            return self.terms
+
+    def save_terms(self, terms):
+        with self.lock:
+            self.terms = terms
+            self.terms_dirty = True
+
+    def load_shard(self, key):
+        with self.lock:
+            if key not in self.shards:
+                self.shards[key] = super().load_shard(key)
+                self.shard_bases[key] = copy.deepcopy(self.shards[key])
+            return self.shards[key]
+
+    def save_shard(self, key, shard):
+        with self.lock:
+            self.shards[key] = shard
+            self.dirty_shards.add(key)
+
+    def record_change(self, kind, data):
+        # Changes wait for the flush, so the log never runs ahead of the files
+        with self.lock:
+            self.pending_changes.append((kind, data, time.time()))
+
+    @property
+    def generation(self):
+        # Buffered changes get their sequence numbers when flushed, after whatever other writers logged
+        # meanwhile, so they are flushed before the generation is read
+        with self.lock:
+            if self.pending_changes:
+                self.flush()
+            return super().generation
+
+    def initialize_layout(self):
+        with self.lock:
+            # The empty manifest replaces the one on disk instead of being merged into it
+            self.manifest_base = None
+            super().initialize_layout()
+            self.flush()
+
+    def check_layout(self):
+        with self.lock:
+            # The buffered manifest may not be on disk yet
+            if self.manifest_dirty:
+                return
+            super().check_layout()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        # The buffer lock is taken first, like in every buffered write and in 'flush'
+        with self.lock, self.user_lock.exclusive():
+            yield
+
+    def buffered(self):
+        # Called after every buffered write to apply the flush policy
+        self.pending_events += 1
+        if self.max_events and self.pending_events >= self.max_events:
+            self.flush()
+        elif self.window_ms is not None and self.timer is None:
+            self.timer = threading.Timer(self.window_ms / 1000, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def add_record(self, expense, amount, date, note=None, tags=None, currency=None):
+        with self.lock:
+            result = super().add_record(expense, amount, date, note, tags, currency)
+            self.buffered()
+            return result
+
+    def delete_record(self, expense_id):
+        with self.lock:
+            result = super().delete_record(expense_id)
+            self.buffered()
+            return result
+
+    def update_record(self, expense_id, expense=None, amount=None, date=None, note=None, tags=None, currency=None):
+        with self.lock:
+            result = super().update_record(expense_id, expense, amount, date, note, tags, currency)
+            self.buffered()
+            return result
+
+    def get_record(self, expense_id):
+        with self.lock:
+            return super().get_record(expense_id)
+
+    def list_records(self, date):
+        with self.lock:
+            return super().list_records(date)
+
+    def get_records(self, start_date, end_date):
+        with self.lock:
+            return super().get_records(start_date, end_date)
+
+    def set_limit(self, key, limit):
+        with self.lock:
+            month_info = super().set_limit(key, limit)
+            self.buffered()
+            return month_info
+
+    def mark_alerted(self, key, thresholds):
+        with self.lock:
+            super().mark_alerted(key, thresholds)
+            self.buffered()
+
+    def get_month_info(self, key):
+        with self.lock:
+            return super().get_month_info(key)
+
+    def get_month_data(self, key):
+        with self.lock:
+            return super().get_month_data(key)
+
+    def month_keys(self, start_key=None, end_key=None):
+        with self.lock:
+            return super().month_keys(start_key, end_key)
+
+    def get_months(self, start_key=None, end_key=None):
+        with self.lock:
+            return super().get_months(start_key, end_key)
+
+    def get_dates(self, start_date, end_date):
+        with self.lock:
+            return super().get_dates(start_date, end_date)
+
+    def load_all(self):
+        with self.lock:
+            return super().load_all()
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        # The version is pinned from the files, so buffered writes are flushed first
+        self.flush()
+        with super().snapshot() as snapshot:
+            yield snapshot
+
+    def move_records(self, key, first_position, offset):
+        # The buffered changes name records by ID, the ones added to the month get their new positions
+        for _, data, _ in self.pending_changes:
+            if not isinstance(data, dict) or 'id' not in data:
+                continue
+            record_key, position = parse_record_id(data['id'])
+            if record_key == key and position >= first_position:
+                data['id'] = record_id(key, position + offset)
+
+    def flush(self):
+        """
+        Write the buffered shards and manifest to disk.
+
+        Returns:
+            int: The number of buffered writes that were flushed.
+
+        Shards are written before the manifest, like in 'save_expense', and
+        the buffered changes are logged last. Every file is read again under
+        the lock of the user and the buffered changes merged into it, so the
+        changes of other writers are kept. Everything is dropped from memory
+        afterwards, so the next writes start from the files and the buffer
+        stays small.
+        """
+        # The buffer lock is taken first, like in every buffered write
+        with self.lock, self.user_lock.exclusive():
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.dirty_shards or self.manifest_dirty or self.terms_dirty or self.dirty_rollups:
+                self.ensure_directory()
+            for key in sorted(self.dirty_shards):
+                shard, offset = merge_shard(self.shard_bases[key], self.shards[key],
+                                            ShardedUserStorage.load_shard(self, key))
+                if offset:
+                    self.move_records(key, len(self.shard_bases[key]['records']['day']), offset)
+                ShardedUserStorage.save_shard(self, key, shard)
+            # Files the buffer created rather than loaded, e.g. by 'initialize_layout', replace the ones on disk
+            disk_years = ShardedUserStorage.load_manifest(self).get('rollup_years', [])
+            for year in sorted(self.dirty_rollups):
+                year_rollups = self.rollup_years[year]
+                if year in self.rollup_bases:
+                    theirs = (ShardedUserStorage.load_rollup_year(self, year) if year in disk_years
+                              else rollups.empty_rollups())
+                    year_rollups = merge_changes(self.rollup_bases[year], year_rollups, theirs)
+                ShardedUserStorage.save_rollup_year(self, year, year_rollups)
+            if self.terms_dirty:
+                if self.terms_base is not None:
+                    self.terms = merge_changes(self.terms_base, self.terms, ShardedUserStorage.load_terms(self))
+                ShardedUserStorage.save_terms(self, self.terms)
+            if self.manifest_dirty:
+                if self.manifest_base is not None:
+                    self.manifest = merge_changes(self.manifest_base, self.manifest,
+                                                  ShardedUserStorage.load_manifest(self))
+                ShardedUserStorage.save_manifest(self, self.manifest)
+            self.changes.append(self.pending_changes)
+            self.pending_changes = []
+            flushed = self.pending_events
+            self.dirty_shards.clear()
+            self.manifest_dirty = False
+            self.terms_dirty = False
+            self.pending_events = 0
+            self.shards.clear()
+            self.shard_bases.clear()
+            self.manifest = self.manifest_base = None
+            self.terms = self.terms_base = None
+            self.rollup_years.clear()
+            self.rollup_bases.clear()
+            self.dirty_rollups.clear()
+            return flushed
+
+
+class WriteBehindPool:
+    def __init__(self, users_directory=USERS_DIRECTORY, max_events=FLUSH_EVENTS, window_ms=FLUSH_WINDOW_MS):
+        """
+        Initializes a new WriteBehindPool object.
+
+        Parameters:
+            users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+            max_events (int, optional): Flush a user after this many buffered writes. Defaults to 50.
+            window_ms (int, optional): Flush a user this many milliseconds after its first buffered write.
+
+        Returns:
+            None
+
+        Keeps one BufferedUserStorage per user, so every writer of a user shares its buffer.
+        """
+        self.users_directory = users_directory
+        self.max_events = max_events
+        self.window_ms = window_ms
+        self.lock = threading.Lock()
+        self.buffers = {}
+
+    def get(self, user):
+        with self.lock:
+            if user not in self.buffers:
+                self.buffers[user] = BufferedUserStorage(user, self.users_directory,
+                                                         self.max_events, self.window_ms)
+            return self.buffers[user]
+
+    def flush_all(self):
+        with self.lock:
+            buffers = list(self.buffers.values())
+        return sum(buffer.flush() for buffer in buffers)
+
+
+def migrate_user(user, users_directory=USERS_DIRECTORY):
+    """
+    Migrate one user from 'users/<user>.json' to the sharded layout.
+
+    Parameters:
+        user (str): The username to migrate.
+        users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+
+    Returns:
+        int: The number of month shards written, or None if the user already has a manifest.
+
+    The manifest is written last, so an interrupted migration is simply
+    repeated on the next start. Once it is written the single file is renamed
+    to 'users/<user>.json.migrated', so its stale data is never migrated
+    again over newer changes. Large files are streamed, so memory use stays
+    bounded by a few month shards.
+    """
+    storage = ShardedUserStorage(user, users_directory)
+    with storage.user_lock.exclusive():
+        if not os.path.exists(storage.manifest_file):
+            storage.ensure_directory()
+            shards = write_legacy_shards(storage)
+            # Cached reports and feed consumers see the whole history as new
+            storage.record_change('reinitialized', {})
+        else:
+            shards = None
+        if os.path.exists(storage.legacy_file):
+            os.replace(storage.legacy_file, storage.legacy_file + MIGRATED_SUFFIX)
+    return shards
+
+
+def write_legacy_shards(storage):
+    """
+    Write the month shards and the manifest of a single-file history.
+
+    Parameters:
+        storage (ShardedUserStorage): The storage of the user, with the lock of the user held.
+
+    Returns:
+        int: The number of month shards written.
+    """
+    # Only a few month shards are kept in memory, the others wait on disk until the end
+    shards = {}
+    spilled = set()
+    months = {}
+    user_rollups = rollups.empty_rollups()
+
+    for section, name, value in iter_legacy(storage.legacy_file):
+        if section == 'month':
+            try:
+                months[month_key_from_name(name)] = value
+            except ValueError:
+                pass
+            continue
+        key = month_key(name)
+        shard = shards.pop(key, None)
+        if shard is None:
+            if len(shards) >= MIGRATION_OPEN_SHARDS:
+                oldest = next(iter(shards))
+                storage.write_json(storage.shard_path(oldest), shards.pop(oldest))
+                spilled.add(oldest)
+            shard = storage.read_json(storage.shard_path(key), None) if key in spilled else None
+            shard = shard or {'date': {}}
+        shards[key] = shard
+        shard['date'][name] = value
+        for expense, amount in value.items():
+            rollups.add_expense(user_rollups, get_category_registry().key(expense), amount, name)
+
+    manifest = new_manifest()
+    terms = storage.load_terms()
+    keys = set(shards) | spilled | set(months)
+    for key in sorted(keys):
+        shard = shards.pop(key, None)
+        if shard is None:
+            shard = (storage.read_json(storage.shard_path(key), None) if key in spilled else None) or {'date': {}}
+        month_data = months.get(key, {})
+        shard['expenses'] = dict(month_data.get('expenses', {}))
+        # Months with daily data but no month entry still get their totals
+        if not shard['expenses']:
+            for expenses_for_date in shard['date'].values():
+                for expense, amount in expenses_for_date.items():
+                    shard['expenses'][expense] = shard['expenses'].get(expense, 0) + amount
+        # The upgrade builds the records and keys the totals by category ID
+        context = {'base': storage.rates.base}
+        schema.upgrade('shard', shard, context)
+        list_terms(terms, key, context.get('terms', ()), context.get('tags', ()))
+        manifest['months'][key] = {'limit': month_data.get('limit'),
+                                   'total': sum(shard['expenses'].values()),
+                                   'categories': dict(shard['expenses'])}
+        for amount in shard['records']['base']:
+            storage.widen_amounts(manifest['months'][key], amount)
+        storage.save_shard(key, shard)
+    manifest['index'] = sorted(manifest['months'])
+    storage.save_terms(terms)
+    storage.save_rollups(manifest, rollups.split_rollups(user_rollups))
+    storage.save_manifest(manifest)
+    return len(keys)
+
+
+def upgrade_user(user, users_directory=USERS_DIRECTORY):
+    """
+    Upgrade the manifest, the month shards and the rollup files of a user to the current schema version.
+
+    Parameters:
+        user (str): The username to upgrade.
+        users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+
+    Returns:
+        int: The number of files upgraded on disk.
+
+    Raises:
+        SchemaError: If a file was written by a newer version of the application.
+
+    Files are upgraded one at a time under the lock of the user, like on
+    their first read, so the user can keep working meanwhile.
+    """
+    storage = ShardedUserStorage(user, users_directory)
+
+    def upgrade_path(kind, path):
+        # Current files are only read, the lock is taken for the ones to rewrite
+        data = storage.read_json(path, None)
+        if isinstance(data, dict) and schema.file_version(data) != schema.current_version(kind):
+            return storage.persist_upgrade(kind, path)
+        return False
+
+    # The manifest goes first, its month index lists the shards and the rollup files
+    upgraded = upgrade_path('manifest', storage.manifest_file)
+    for key in storage.month_keys():
+        upgraded += upgrade_path('shard', storage.shard_path(key))
+    for year in storage.load_manifest().get('rollup_years', []):
+        upgraded += upgrade_path('rollups', storage.rollup_path(year))
+    return int(upgraded)
+
+
+def upgrade_chunk(users_directory, users):
+    # Runs in a worker process, a user which can't be upgraded doesn't stop the others
+    result = {'users': 0, 'files': 0, 'errors': []}
+    for user in users:
+        try:
+            result['files'] += upgrade_user(user, users_directory)
+        except (schema.SchemaError, OSError, ValueError) as error:
+            result['errors'].append(f"{user}: {error}")
+            continue
+        result['users'] += 1
+    return result
+
+
+def upgrade_users(users, users_directory=USERS_DIRECTORY, workers=None, chunk_size=UPGRADE_CHUNK_SIZE):
+    """
+    Upgrade the files of many users to the current schema version with a process pool.
+
+    Parameters:
+        users (list): The usernames to upgrade.
+        users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+        workers (int, optional): The number of worker processes. Defaults to the number of cores.
+        chunk_size (int, optional): The number of users a worker handles at once. Defaults to 100.
+
+    Returns:
+        dict: 'users' upgraded, 'files' rewritten and 'errors'.
+
+    Users are upgraded lazily when their files are first read anyway, the
+    bulk upgrade only saves that first read the work. It can run while the
+    application serves the same users.
+    """
+    chunks = [users[start:start + chunk_size] for start in range(0, len(users), chunk_size)]
+    result = {'users': 0, 'files': 0, 'errors': []}
+    if not chunks:
+        return result
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial in executor.map(upgrade_chunk, [users_directory] * len(chunks), chunks):
+            result['users'] += partial['users']
+            result['files'] += partial['files']
+            result['errors'] += partial['errors']
+    return result
+
+
+def legacy_users(users_directory=USERS_DIRECTORY):
+    """
+    Get the users which still have a single-file history.
+
+    Parameters:
+        users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+
+    Returns:
+        list: Usernames, sorted.
+    """
+    if not os.path.isdir(users_directory):
+        return []
+    return sorted(name[:-len('.json')] for name in os.listdir(users_directory)
+                  if name.endswith('.json') and os.path.isfile(os.path.join(users_directory, name)))
+
+
+def sharded_users(users_directory=USERS_DIRECTORY):
+    """
+    Get the users which have the sharded layout.
+
+    Parameters:
+        users_directory (str, optional): The root directory of user data. Defaults to 'users'.
+
+    Returns:
+        list: Usernames, sorted, read from the user registry.
+    """
+    return get_registry(users_directory).users()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Manage the sharded user storage.")
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help="migrate single-file users to the sharded layout")
+    migrate_parser.add_argument('users', nargs='*', help="users to migrate (all single-file users by default)")
+    migrate_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+
+    upgrade_parser = subparsers.add_parser('upgrade', help="upgrade the files of sharded users to the current "
+                                                           "schema version in the background")
+    upgrade_parser.add_argument('users', nargs='*', help="users to upgrade (all sharded users by default)")
+    upgrade_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+    upgrade_parser.add_argument('--workers', type=int, default=None, help="worker processes (all cores by default)")
+    upgrade_parser.add_argument('--chunk-size', type=int, default=UPGRADE_CHUNK_SIZE)
+
+    registry_parser = subparsers.add_parser('rebuild-registry', help="register every user directory on disk")
+    registry_parser.add_argument('--users-dir', default=USERS_DIRECTORY)
+
+    args = arg_parser.parse_args()
+
+    if args.command == 'migrate':
+        for user in args.users or legacy_users(args.users_dir):
+            shards = migrate_user(user, args.users_dir)
+            if shards is None:
+                print(f"Skipped {user}: already migrated.")
+            else:
+                print(f"Migrated {user}: {shards} month shard(s).")
+    elif args.command == 'upgrade':
+        users = args.users or sharded_users(args.users_dir)
+        result = upgrade_users(users, args.users_dir, args.workers, args.chunk_size)
+        print(f"Upgraded {result['files']} file(s) of {result['users']} of {len(users)} user(s).")
+        for error in result['errors']:
+            print(f"Not upgraded: {error}")
+    elif args.command == 'rebuild-registry':
+        print(f"Registered {get_registry(args.users_dir).rebuild()} user(s).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import json
+import threading
+import http.client
+import datetime as dt
+
+import pytest
+
+from api import ApiError, ApiServer, ExpenseApi
+from storage import month_days
+from recurring import RecurringScheduler
+from reportcache import ReportCache
+
+
+@pytest.fixture
+def api(users_directory):
+    with open('rates.json', 'w') as rates_file:
+        json.dump({'base': 'USD', 'rates': {'EUR': {'2024-01-01': 1.1}}}, rates_file)
+    return ExpenseApi(users_directory, ReportCache())
+
+
+@pytest.fixture
+def server(api):
+    server = ApiServer(('127.0.0.1', 0), api)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+    try:
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        data = response.read()
+        return response.status, dict(response.getheaders()), json.loads(data) if data else None
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('amount', [float('nan'), float('inf'), -1, True, '5'])
+def test_add_expense_rejects_amounts_which_are_not_finite_positive_numbers(api, amount):
+    with pytest.raises(ApiError) as error:
+        api.add_expense('alice', {'category': 'Food', 'amount': amount, 'date': '2024-05-01'})
+    assert error.value.status == 400
+
+
+def test_add_expense_accepts_a_lowercase_currency(api):
+    status, response, _ = api.add_expense('alice', {'category': 'Food', 'amount': 10, 'date': '2024-05-01',
+                                                    'currency': 'eur'})
+    assert status == 201
+    assert response['total'] == pytest.approx(11)
+
+
+def test_add_expense_without_a_rate_saves_nothing(api):
+    with pytest.raises(ApiError) as error:
+        api.add_expense('alice', {'category': 'Food', 'amount': 10, 'date': '2024-05-01', 'currency': 'gbp'})
+    assert error.value.status == 400
+    assert api.storage('alice').get_month_data('2024-05') is None
+
+
+def test_nan_in_a_request_body_is_rejected(server):
+    status, _, response = request(server, 'POST', '/users/alice/expenses',
+                                  '{"category": "Food", "amount": NaN, "date": "2024-05-01"}')
+    assert status == 400
+    assert 'positive number' in response['error']
+
+
+@pytest.mark.parametrize('length', ['-1', 'abc'])
+def test_invalid_content_length_is_rejected(server, length):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+    try:
+        connection.putrequest('POST', '/users/alice/expenses')
+        connection.putheader('Content-Length', length)
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == 400
+        assert json.loads(response.read()) == {'error': "Invalid Content-Length."}
+    finally:
+        connection.close()
+
+
+def test_get_is_not_modified_while_the_generation_stays(server):
+    request(server, 'POST', '/users/alice/expenses', json.dumps({'category': 'Food', 'amount': 3,
+                                                                 'date': '2024-05-01'}))
+    status, headers, response = request(server, 'GET', '/users/alice/months/2024-05')
+    assert status == 200
+    assert response['expenses'] == {'Food': 3}
+
+    status, _, _ = request(server, 'GET', '/users/alice/months/2024-05', headers={'If-None-Match': headers['ETag']})
+    assert status == 304
+
+    request(server, 'PUT', '/users/alice/months/2024-05/limit', json.dumps({'limit': 10}))
+    status, new_headers, response = request(server, 'GET', '/users/alice/months/2024-05',
+                                            headers={'If-None-Match': headers['ETag']})
+    assert status == 200
+    assert new_headers['ETag'] != headers['ETag']
+    assert response['limit'] == 10
+
+
+def test_get_saves_due_recurring_expenses_and_projects_later_ones(api, server):
+    today = dt.date.today()
+    month = today.strftime("%Y-%m")
+    first_day, last_day = month_days(month)
+    _, headers, _ = request(server, 'GET', '/users/alice/months')
+    # The rule is added before the month starts, so every occurrence is still due
+    RecurringScheduler(api.storage('alice')).add_rule('Food', 2, 'daily', first_day.isoformat(),
+                                                      today=first_day - dt.timedelta(days=1))
+
+    status, new_headers, response = request(server, 'GET', f'/users/alice/months/{month}',
+                                            headers={'If-None-Match': headers['ETag']})
+    assert status == 200
+    assert new_headers['ETag'] != headers['ETag']
+    assert response['total'] == 2 * today.day
+    assert response['projected'] == ({'Food': 2 * (last_day - today).days} if today < last_day else {})
+
+
+def test_users_of_the_same_name_in_other_directories_share_no_responses(users_directory):
+    cache = ReportCache()
+    first, second = ExpenseApi(users_directory, cache), ExpenseApi('other_users', cache)
+    first.add_expense('alice', {'category': 'Food', 'amount': 3, 'date': '2024-05-01'})
+    second.add_expense('alice', {'category': 'Food', 'amount': 5, 'date': '2024-05-01'})
+
+    assert first.month_data('alice', '2024-05', first.version('alice'))[1]['total'] == 3
+    assert second.month_data('alice', '2024-05', second.version('alice'))[1]['total'] == 5
@@ -0,0 +1,111 @@
+import sys
+import threading
+import datetime as dt
+
+import pytest
+
+import budget
+from budget import BudgetEngine, CategoryBudgetTracker, save_with_budgets
+from currency import RateTable
+
+RATES = {'EUR': {'2024-01-01': 1.1}}
+
+
+def test_save_with_budgets_accepts_a_lowercase_currency(storage_of):
+    storage = storage_of(rates=RateTable(RATES))
+    engine = BudgetEngine()
+    tracker = CategoryBudgetTracker(storage, engine)
+    tracker.set_budget('Food', 20)
+
+    expense_id, month_info, events = save_with_budgets(storage, engine, tracker, 'Food', 10, '2024-05-01',
+                                                       currency='eur')
+
+    assert storage.get_record(expense_id)['currency'] == 'EUR'
+    assert month_info['total'] == pytest.approx(11)
+    assert storage.get_month_data('2024-05')['total'] == pytest.approx(11)
+    assert [event.threshold for event in events] == [50]
+
+
+def test_save_with_budgets_saves_nothing_without_a_rate(storage_of):
+    storage = storage_of(rates=RateTable(RATES))
+    engine = BudgetEngine()
+
+    with pytest.raises(ValueError):
+        save_with_budgets(storage, engine, CategoryBudgetTracker(storage, engine), 'Food', 10, '2024-05-01',
+                          currency='gbp')
+    assert storage.get_month_data('2024-05') is None
+
+
+def test_trackers_of_one_user_count_each_others_spending(storage_of):
+    engine = BudgetEngine()
+    first = CategoryBudgetTracker(storage_of(), engine)
+    first.set_budget('Food', 100, days=30)
+    second = CategoryBudgetTracker(storage_of(), engine)
+    today = dt.date.today().isoformat()
+
+    first.record_expense('Food', 30, today, {})
+    events = second.record_expense('Food', 60, today, {})
+
+    rolling = CategoryBudgetTracker(storage_of(), engine).budgets['1:30d']
+    assert CategoryBudgetTracker(storage_of(), engine).spent(rolling) == 90
+    assert [event.threshold for event in events] == [50, 80]
+
+
+def test_budget_command_sets_lists_and_removes_budgets(users_directory, monkeypatch, capsys):
+    def run(*args):
+        monkeypatch.setattr(sys, 'argv', ['budget.py', *args, '--users-dir', users_directory])
+        budget.main()
+        return capsys.readouterr().out
+
+    assert 'Budget set.' in run('set', 'alice', 'Food', '200')
+    assert run('list', 'alice').startswith('Food: $0.00 of $200.00 spent in this month')
+    assert 'Removed' in run('remove', 'alice', 'Food')
+    assert 'no category budgets' in run('list', 'alice')
+    with pytest.raises(SystemExit):
+        run('set', 'alice', 'Snacks', '10')
+
+
+def test_month_end_command_reports_every_user_with_a_limit(storage_of, users_directory, monkeypatch, capsys):
+    for user, amount in (('alice', 80), ('bob', 30)):
+        storage = storage_of(user)
+        storage.save_expense('Food', amount, '2024-05-01')
+        storage.set_limit('2024-05', 100)
+    storage_of('carol').save_expense('Food', 10, '2024-05-01')
+
+    monkeypatch.setattr(sys, 'argv', ['budget.py', 'month-end', '--month', '2024-05', '--users-dir', users_directory])
+    budget.main()
+
+    assert capsys.readouterr().out.splitlines() == [
+        "alice spent 80% of the limit for May 2024.",
+        "bob spent 30% of the limit for May 2024.",
+        "Evaluated the limits of 2 user(s) for May 2024."
+    ]
+
+
+def test_budgets_of_a_buffered_user_never_wait_for_a_flush(buffer_of):
+    storage = buffer_of()
+    storage.rates = RateTable(RATES)
+    engine = BudgetEngine()
+    today = dt.date.today().isoformat()
+    stop = threading.Event()
+
+    def flush_all_the_time():
+        while not stop.is_set():
+            storage.add_record('Food', 1, today)
+            storage.flush()
+
+    def save_with_new_windows():
+        for _ in range(50):
+            tracker = CategoryBudgetTracker(storage, engine)
+            # A new rolling window reads the buffered history while the tracker holds the lock of the user
+            tracker.set_budget('Food', 1000, days=7)
+            save_with_budgets(storage, engine, tracker, 'Food', 1, today)
+
+    flusher = threading.Thread(target=flush_all_the_time, daemon=True)
+    saver = threading.Thread(target=save_with_new_windows, daemon=True)
+    flusher.start()
+    saver.start()
+    saver.join(timeout=30)
+    stop.set()
+    assert not saver.is_alive()
+    flusher.join(timeout=30)
@@ -0,0 +1,44 @@
+import threading
+import datetime as dt
+
+import pytest
+
+from recurring import RecurringScheduler
+from currency import RateTable
+
+
+@pytest.fixture
+def scheduler_of(storage_of):
+    # A new scheduler on its own storage for every call, like separate processes of the same user
+    def scheduler_of(user='alice'):
+        return RecurringScheduler(storage_of(user, rates=RateTable()))
+    return scheduler_of
+
+
+def test_concurrent_runs_save_every_occurrence_once(storage_of, scheduler_of):
+    scheduler_of().add_rule('Food', 5, 'daily', '2024-05-01', '2024-05-20', today=dt.date(2024, 4, 30))
+    schedulers = [scheduler_of() for _ in range(4)]
+    saved = []
+    threads = [threading.Thread(target=lambda scheduler=scheduler: saved.append(
+        scheduler.materialize(dt.date(2024, 5, 31)))) for scheduler in schedulers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    storage = storage_of(rates=RateTable())
+    assert sum(saved) == 20
+    assert storage.get_month_data('2024-05')['total'] == 100
+
+
+def test_replacing_a_rule_changes_the_version(scheduler_of):
+    scheduler = scheduler_of()
+    rule = scheduler.add_rule('Housing', 500, 'monthly', '2099-01-01')
+    version = scheduler.version
+    scheduler.remove_rule(rule.rule_id)
+    scheduler.add_rule('Food', 7, 'monthly', '2099-01-01')
+
+    other = scheduler_of()
+    assert other.version == scheduler.version != version
+    assert [(upcoming['category'], upcoming['amount']) for upcoming in
+            other.project(dt.date(2099, 1, 1), dt.date(2099, 1, 31))] == [('Food', 7)]
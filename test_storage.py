@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import datetime as dt
+
+from storage import migrate_user
+from rollups import range_totals
+from search import search_expenses
+from export import export_expenses
+
+
+def test_flush_keeps_the_expenses_of_another_writer(storage_of, buffer_of):
+    buffer = buffer_of()
+    buffer.save_expense('Food', 3, '2024-05-01')
+    storage_of().save_expense('Food', 20, '2024-05-01')
+    storage_of().save_expense('Transport', 5, '2024-05-02')
+    buffer.flush()
+
+    storage = storage_of()
+    assert storage.get_month_data('2024-05') == {'limit': None, 'total': 28,
+                                                  'expenses': {'1': 23, 'Transport': 5}}
+    assert storage.get_dates(dt.date(2024, 5, 1), dt.date(2024, 5, 31)) == {'2024-05-01': {'1': 23},
+                                                                            '2024-05-02': {'Transport': 5}}
+
+
+def test_flush_keeps_the_total_of_another_writer_next_to_a_buffered_limit(storage_of, buffer_of):
+    storage_of().save_expense('Food', 20, '2024-05-01')
+    buffer = buffer_of()
+    buffer.set_limit('2024-05', 100)
+    storage_of().save_expense('Food', 5, '2024-05-02')
+    buffer.flush()
+
+    assert storage_of().get_month_data('2024-05')['limit'] == 100
+    assert storage_of().get_month_data('2024-05')['total'] == 25
+
+
+def test_flush_merges_the_rollups_of_a_year_another_writer_started(storage_of, buffer_of):
+    buffer = buffer_of()
+    buffer.save_expense('Food', 3, '2024-05-01')
+    storage_of().save_expense('Food', 20, '2024-06-03')
+    buffer.flush()
+
+    storage = storage_of()
+    assert range_totals(storage, dt.date(2024, 1, 1), dt.date(2024, 12, 31)) == {'1': 23}
+    assert range_totals(storage, dt.date(2024, 4, 1), dt.date(2024, 6, 30)) == {'1': 23}
+    assert storage.load_manifest()['rollup_years'] == ['2024']
+
+
+def test_rollups_of_a_history_recorded_before_them_are_built_once(storage_of):
+    storage = storage_of()
+    os.makedirs(storage.user_directory)
+    storage.write_json(storage.manifest_file, {'months': {'2024-12': {'limit': None}}})
+    storage.write_json(storage.shard_path('2024-12'), {'date': {'2024-12-30': {'Food': 10}},
+                                                      'expenses': {'Food': 10}})
+    storage.save_expense('Food', 5, '2025-01-02')
+
+    assert range_totals(storage, dt.date(2024, 1, 1), dt.date(2025, 12, 31)) == {'1': 15}
+    # 30 December 2024 falls into the first ISO week of 2025
+    assert storage.load_manifest()['rollup_years'] == ['2024', '2025']
+    assert storage.load_rollups({'2025'})['2025']['week'] == {'2025-W01': {'1': 15}}
+
+
+def test_flush_indexes_buffered_entries_after_the_ones_of_another_writer(storage_of, buffer_of):
+    buffer = buffer_of()
+    buffer.save_expense('Food', 3, '2024-05-01', 'lunch')
+    storage_of().save_expense('Food', 20, '2024-05-02', 'market', ['weekly'])
+    buffer.flush()
+
+    storage = storage_of()
+    assert [entry['amount'] for entry in search_expenses(storage, 'lunch')] == [3]
+    assert [entry['amount'] for entry in search_expenses(storage, 'market')] == [20]
+    assert [entry['amount'] for entry in search_expenses(storage, tags=['weekly'])] == [20]
+    assert [entry['amount'] for entry in search_expenses(storage, 'food')] == [20, 3]
+
+
+def test_flush_moves_buffered_records_after_the_ones_of_another_writer(storage_of, buffer_of):
+    storage = storage_of()
+    storage.add_record('Food', 1, '2024-05-01')
+    buffer = buffer_of()
+    buffer.add_record('Food', 3, '2024-05-03', 'lunch')
+    storage.add_record('Food', 20, '2024-05-02')
+    buffer.flush()
+
+    storage = storage_of()
+    assert storage.get_record('2024-05.1')['amount'] == 20
+    assert storage.get_record('2024-05.2')['note'] == 'lunch'
+    assert [record['id'] for record in search_expenses(storage, 'lunch')] == ['2024-05.2']
+
+
+def test_flush_merges_deletes_into_another_writers_shard(storage_of, buffer_of):
+    expense_id, _ = storage_of().add_record('Food', 5, '2024-05-01')
+    buffer = buffer_of()
+    buffer.delete_record(expense_id)
+    storage_of().add_record('Food', 7, '2024-05-01')
+    buffer.flush()
+
+    storage = storage_of()
+    assert [record['amount'] for record in storage.list_records('2024-05-01')] == [7]
+    assert storage.get_month_data('2024-05')['total'] == 7
+    assert storage.load_shard('2024-05')['date'] == {'2024-05-01': {'1': 7}}
+    assert range_totals(storage, dt.date(2024, 5, 1), dt.date(2024, 5, 31)) == {'1': 7}
+
+
+def test_flush_keeps_the_latest_change_time(storage_of, buffer_of):
+    buffer = buffer_of()
+    buffer.add_record('Food', 3, '2024-05-01')
+    storage_of().add_record('Food', 20, '2024-05-01')
+    buffer.flush()
+
+    storage = storage_of()
+    modified = storage.load_manifest()['months']['2024-05']['modified']
+    assert modified <= time.time()
+    assert storage.load_shard('2024-05')['modified'] == {'2024-05-01': modified}
+
+
+def test_flush_logs_the_moved_ids_of_buffered_records(storage_of, buffer_of):
+    buffer = buffer_of()
+    buffered_id, _ = buffer.add_record('Food', 3, '2024-05-03', 'lunch')
+    storage_of().add_record('Food', 20, '2024-05-02')
+    buffer.flush()
+
+    events = [(event.kind, event.data['id']) for event in storage_of().changes.read(0)]
+    assert buffered_id == '2024-05.0'
+    assert events == [('expense_added', '2024-05.0'), ('expense_added', '2024-05.1')]
+    assert storage_of().get_record('2024-05.1')['note'] == 'lunch'
+
+
+def test_totals_saved_by_category_name_are_keyed_by_id(storage_of):
+    storage = storage_of()
+    os.makedirs(storage.user_directory)
+    storage.write_json(storage.manifest_file, {'months': {'2024-05': {'limit': None, 'total': 10,
+                                                                     'categories': {'Food': 10}}},
+                                               'rollup_years': []})
+    storage.write_json(storage.shard_path('2024-05'), {'date': {'2024-05-01': {'Food': 10}},
+                                                      'expenses': {'Food': 10}})
+    storage.save_expense('Food', 5, '2024-05-01')
+
+    assert storage.load_manifest()['months']['2024-05']['categories'] == {'1': 15}
+    assert storage.get_month_data('2024-05')['expenses'] == {'1': 15}
+    assert storage.load_shard('2024-05')['date'] == {'2024-05-01': {'1': 15}}
+
+
+def test_buffered_generation_never_reuses_a_sequence_number(storage_of, buffer_of):
+    buffer = buffer_of()
+    storage = storage_of()
+    buffer.add_record('Food', 3, '2024-05-01')
+    storage.add_record('Food', 20, '2024-05-02')
+    other_generation = storage.generation
+
+    generation = buffer.generation
+    assert generation != other_generation
+    assert generation == storage.generation
+    assert not buffer.pending_changes
+
+
+def test_months_saved_before_the_running_totals_get_them_from_their_shard(storage_of):
+    storage = storage_of()
+    storage.ensure_directory()
+    storage.write_json(storage.manifest_file, {'months': {'2024-04': {'limit': None}, 'May 2024': {'limit': 100}}})
+    for key in ('2024-04', '2024-05'):
+        storage.write_json(storage.shard_path(key), {'date': {f'{key}-01': {'Food': 10}}, 'expenses': {'Food': 10}})
+
+    april = ('2024-04', {'limit': None, 'total': 10, 'categories': {'1': 10}})
+    assert storage.get_months('2024-04', '2024-04') == [april]
+    assert storage.get_months() == [april, ('2024-05', {'limit': 100, 'total': 10, 'categories': {'1': 10}})]
+    assert storage.read_json(storage.manifest_file, None)['months']['2024-05']['total'] == 10
+
+
+def test_search_finds_expenses_of_a_migrated_user(users_directory, storage_of):
+    os.makedirs(users_directory)
+    with open(os.path.join(users_directory, 'bob.json'), 'w') as legacy_file:
+        json.dump({'date': {'2024-05-01': {'Food': 10}},
+                   'month': {'May 2024': {'limit': 100, 'expenses': {'Food': 10}}}}, legacy_file)
+    migrate_user('bob', users_directory)
+
+    storage = storage_of('bob')
+    assert [record['amount'] for record in search_expenses(storage, 'food')] == [10]
+    storage.add_record('Food', 5, '2024-05-02')
+    assert [record['amount'] for record in search_expenses(storage, 'food')] == [5, 10]
+
+
+def test_search_finds_records_built_by_a_shard_upgrade(storage_of):
+    storage = storage_of()
+    storage.ensure_directory()
+    storage.write_json(storage.manifest_file, {'months': {'2024-05': {'limit': None}}})
+    storage.write_json(storage.shard_path('2024-05'), {'date': {'2024-05-01': {'Food': 10}},
+                                                      'expenses': {'Food': 10}})
+
+    storage.get_month_data('2024-05')
+    assert [record['amount'] for record in search_expenses(storage, 'food')] == [10]
+
+
+def test_export_streams_single_file_users_without_migrating_them(users_directory, storage_of):
+    storage_of().save_expense('Food', 3, '2024-05-01')
+    with open(os.path.join(users_directory, 'bob.json'), 'w') as legacy_file:
+        json.dump({'date': {'2024-05-01': {'Food': 10, 'Transport': 2}},
+                   'month': {'May 2024': {'limit': 100, 'expenses': {'Food': 10, 'Transport': 2}}}}, legacy_file)
+
+    assert export_expenses('export.jsonl', 'jsonl', users_directory) == 3
+    with open('export.jsonl') as export_file:
+        rows = [json.loads(line) for line in export_file]
+    assert [(row['user'], row['id'], row['category'], row['amount']) for row in rows] == [
+        ('alice', '2024-05.0', 'Food', 3), ('bob', None, 'Food', 10), ('bob', None, 'Transport', 2)]
+    assert not storage_of('bob').registered
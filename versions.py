@@ -0,0 +1,211 @@
+import os
+import re
+import time
+import shutil
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+VERSIONS_DIRECTORY = '.versions'
+LOCK_FILE = '.lock'
+HOLDER_PREFIX = 'holder-'
+COMPLETE_FILE = 'complete'
+# A holder older than this is left over from a crashed reader on a system where processes can't be checked
+STALE_HOLDER_SECONDS = 24 * 60 * 60
+VERSIONED_FILE = re.compile(r'^(manifest|terms|\d{4}-\d{2}|rollups-\d{4})\.json$')
+
+
+class UserLock:
+    def __init__(self, user_directory):
+        """
+        Initializes a new UserLock object.
+
+        Parameters:
+            user_directory (str): The directory of the user.
+
+        Returns:
+            None
+
+        A readers-writer lock over 'users/<user>/.lock', shared by every
+        process. Writers hold it exclusively while they replace the files of
+        one change, readers hold it shared while they pin a version. Nested
+        use in one thread only locks the file once, the storages of a user
+        share one lock per process through 'get_user_lock'. Without fcntl, e.g. on
+        Windows, only threads of one process are coordinated.
+        """
+        self.path = os.path.join(user_directory, LOCK_FILE)
+        self.thread_lock = threading.RLock()
+        self.lock_file = None
+        self.depth = 0
+
+    @contextlib.contextmanager
+    def hold(self, exclusive):
+        with self.thread_lock:
+            if self.depth == 0 and fcntl is not None:
+                if self.lock_file is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self.lock_file = open(self.path, 'a+')
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if self.depth == 0 and fcntl is not None:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def exclusive(self):
+        return self.hold(True)
+
+    def shared(self):
+        return self.hold(False)
+
+
+user_locks = {}
+user_locks_lock = threading.Lock()
+
+
+def get_user_lock(user_directory):
+    # One lock per user directory and process, so the storages of one user nest instead of waiting
+    # for each other. A forked worker opens its own, an inherited lock file would share its locks.
+    path = (os.path.abspath(user_directory), os.getpid())
+    with user_locks_lock:
+        if path not in user_locks:
+            user_locks[path] = UserLock(user_directory)
+        return user_locks[path]
+
+
+def holder_alive(name):
+    # Holder files are named 'holder-<pid>-<thread>-<number>', None if the process can't be checked
+    path_pid = name[len(HOLDER_PREFIX):].split('-', 1)[0]
+    if os.name == 'nt' or not path_pid.isdigit():
+        return None
+    try:
+        os.kill(int(path_pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class VersionStore:
+    def __init__(self, user_directory, lock):
+        """
+        Initializes a new VersionStore object.
+
+        Parameters:
+            user_directory (str): The directory of the user.
+            lock (UserLock): The lock of the user.
+
+        Returns:
+            None
+
+        A version is 'users/<user>/.versions/<generation>/', hard links to the
+        manifest, the terms, the month shards and the rollups as they were at a generation
+        of the change log. Writers never change a file in place, they replace
+        it, so a linked file never changes and a version costs no copies.
+        Readers register as holders of a version, and a version is deleted
+        once the last holder released it.
+        """
+        self.user_directory = user_directory
+        self.directory = os.path.join(user_directory, VERSIONS_DIRECTORY)
+        self.lock = lock
+        self.counter = 0
+        self.counter_lock = threading.Lock()
+
+    def version_directory(self, generation):
+        return os.path.join(self.directory, str(generation))
+
+    def build(self, generation):
+        # Versions are built next to their final place and renamed, so a version directory is always complete
+        path = self.version_directory(generation)
+        if os.path.exists(os.path.join(path, COMPLETE_FILE)):
+            return path
+        tmp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in os.listdir(self.user_directory):
+            if VERSIONED_FILE.match(name):
+                source = os.path.join(self.user_directory, name)
+                try:
+                    os.link(source, os.path.join(tmp_path, name))
+                except OSError:
+                    shutil.copy2(source, os.path.join(tmp_path, name))
+        open(os.path.join(tmp_path, COMPLETE_FILE), 'w').close()
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another reader built the same version first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return path
+
+    def pin(self, generation):
+        """
+        Pin the current files as the version of a generation.
+
+        Parameters:
+            generation (int): The generation of the change log the files belong to.
+
+        Returns:
+            tuple: The version directory and the holder file to pass to 'release'.
+
+        Must be called with the lock of the user held shared, so no writer is halfway through a change.
+        """
+        path = self.build(generation)
+        with self.counter_lock:
+            self.counter += 1
+            holder = os.path.join(path, f'{HOLDER_PREFIX}{os.getpid()}-{threading.get_ident()}-{self.counter}')
+        open(holder, 'w').close()
+        return path, holder
+
+    def release(self, holder):
+        with self.lock.exclusive():
+            try:
+                os.remove(holder)
+            except FileNotFoundError:
+                pass
+            self.collect()
+
+    def collect(self):
+        """
+        Delete the versions no reader holds anymore.
+
+        Returns:
+            int: The number of deleted versions.
+
+        Holders of processes which no longer run count as released. Must be
+        called with the lock of the user held exclusively.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        now = time.time()
+        deleted = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if '.tmp-' in name:
+                # Left over by a reader that crashed while building
+                if holder_alive(HOLDER_PREFIX + name.split('.tmp-', 1)[1]) is False:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            held = False
+            for entry in os.listdir(path):
+                if not entry.startswith(HOLDER_PREFIX):
+                    continue
+                alive = holder_alive(entry)
+                if alive is None:
+                    try:
+                        alive = now - os.path.getmtime(os.path.join(path, entry)) < STALE_HOLDER_SECONDS
+                    except FileNotFoundError:
+                        alive = False
+                if alive:
+                    held = True
+                    break
+            if not held:
+                shutil.rmtree(path, ignore_errors=True)
+                deleted += 1
+        return deleted